@@ -0,0 +1,173 @@
+import random
+import time
+import typing
+
+PLATFORMS = ["twitch", "youtube", "kick"]
+LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+TACO_TYPES = ["REACT_REWARD", "GIFT", "TQOTD", "WDYCTW", "TECHTHURS", "MENTALMONDAYS", "TACOTUESDAY", "FOOD_POST"]
+SYSTEM_ACTIONS = ["STARTUP", "SHUTDOWN", "MIGRATION", "COMMAND"]
+QUESTION_COLLECTIONS = ["tqotd", "wdyctw", "techthurs", "mentalmondays", "taco_tuesday"]
+BATCH_SIZE = 5000
+
+
+def generate(db, guilds: int = 10, users: int = 1000, log_rows: int = 100000, seed: int = 1) -> typing.Dict[str, int]:
+    """Fill `db` with documents shaped like the ones lib/mongo.py queries.
+
+    `users` is per guild; `log_rows` is split between logs, tacos_log and system_actions. Everything else is
+    scaled from the user count. Returns the number of documents written per collection.
+    """
+    rand = random.Random(seed)
+    now = time.time()
+    writer = Writer(db)
+
+    for g in range(guilds):
+        guild_id = str(100000000000000000 + g)
+        writer.add("guilds", {"guild_id": guild_id, "name": f"guild {g}"})
+        user_ids = [str(200000000000000000 + g * users + u) for u in range(users)]
+
+        for i, user_id in enumerate(user_ids):
+            writer.add(
+                "users",
+                {
+                    "guild_id": guild_id,
+                    "user_id": user_id,
+                    "username": f"user{g}_{i}",
+                    "bot": rand.random() < 0.01,
+                    "system": False,
+                    "timestamp": now - rand.uniform(0, 86400 * 30),
+                },
+            )
+            writer.add("tacos", {"guild_id": guild_id, "user_id": user_id, "count": rand.randint(0, 500)})
+            writer.add(
+                "messages",
+                {
+                    "guild_id": guild_id,
+                    "user_id": user_id,
+                    "messages": [
+                        {"channel_id": str(rand.randint(1, 20)), "message_id": str(m), "timestamp": now - m}
+                        for m in range(rand.randint(0, 50))
+                    ],
+                },
+            )
+            if rand.random() < 0.5:
+                writer.add(
+                    "first_message",
+                    {"guild_id": guild_id, "user_id": user_id, "timestamp": now - rand.uniform(0, 86400 * 2)},
+                )
+            if rand.random() < 0.3:
+                writer.add(
+                    "taco_gifts",
+                    {"guild_id": guild_id, "user_id": user_id, "count": rand.randint(1, 10), "timestamp": now},
+                )
+            for _ in range(rand.randint(0, 5)):
+                writer.add(
+                    "tacos_reactions",
+                    {"guild_id": guild_id, "user_id": user_id, "message_id": str(rand.randint(1, 10**9))},
+                )
+            if rand.random() < 0.1:
+                writer.add("food_posts", {"guild_id": guild_id, "user_id": user_id, "message_id": str(i)})
+            if rand.random() < 0.05:
+                writer.add("birthdays", {"guild_id": guild_id, "user_id": user_id, "month": rand.randint(1, 12)})
+            if rand.random() < 0.05:
+                writer.add("minecraft_users", {"guild_id": guild_id, "user_id": user_id, "whitelist": rand.random() < 0.8})
+            if rand.random() < 0.02:
+                writer.add("twitch_user", {"user_id": user_id, "twitch_name": f"twitch{g}_{i}"})
+            if rand.random() < 0.02:
+                writer.add("stream_team_requests", {"guild_id": guild_id, "user_id": user_id})
+            writer.add("user_join_leave", {"guild_id": guild_id, "user_id": user_id, "action": "JOIN"})
+            if rand.random() < 0.1:
+                writer.add("user_join_leave", {"guild_id": guild_id, "user_id": user_id, "action": "LEAVE"})
+
+        for i in range(max(1, users // 20)):
+            inviter_id = rand.choice(user_ids)
+            uses = rand.randint(0, 20)
+            writer.add(
+                "invite_codes",
+                {
+                    "code": f"code{g}_{i}",
+                    "guild_id": guild_id,
+                    "info": {"id": f"code{g}_{i}", "code": f"code{g}_{i}", "inviter_id": inviter_id, "uses": uses},
+                    "timestamp": now,
+                    "invites": [{"user_id": rand.choice(user_ids), "timestamp": now} for _ in range(uses)],
+                },
+            )
+
+        for i in range(max(1, users // 50)):
+            user_id = rand.choice(user_ids)
+            platform = rand.choice(PLATFORMS)
+            writer.add("live_tracked", {"guild_id": guild_id, "user_id": user_id, "platform": platform})
+            writer.add(
+                "live_activity",
+                {
+                    "guild_id": guild_id,
+                    "user_id": user_id,
+                    "platform": platform,
+                    "status": "ONLINE" if rand.random() < 0.5 else "OFFLINE",
+                },
+            )
+            writer.add("twitch_channels", {"guild_id": guild_id, "channel": f"channel{g}_{i}"})
+            writer.add("twitch_tacos_gifts", {"guild_id": guild_id, "user_id": user_id, "count": rand.randint(1, 5)})
+
+        for collection in QUESTION_COLLECTIONS:
+            for _ in range(max(1, users // 100)):
+                writer.add(
+                    collection,
+                    {"guild_id": guild_id, "answered": rand.sample(user_ids, min(len(user_ids), rand.randint(0, 10)))},
+                )
+
+        for i in range(max(1, users // 20)):
+            writer.add("game_keys", {"guild_id": guild_id, "redeemed_by": rand.choice(user_ids) if i % 3 else None})
+            writer.add("suggestions", {"guild_id": guild_id, "state": rand.choice(["ACTIVE", "APPROVED", "REJECTED"])})
+            writer.add(
+                "trivia_questions",
+                {
+                    "guild_id": guild_id,
+                    "category": rand.choice(["General", "Science", "History"]),
+                    "difficulty": rand.choice(["easy", "medium", "hard"]),
+                    "starter_id": rand.choice(user_ids),
+                    "correct_users": rand.sample(user_ids, min(len(user_ids), 3)),
+                    "incorrect_users": rand.sample(user_ids, min(len(user_ids), 3)),
+                    "timestamp": now,
+                },
+            )
+
+        per_guild = log_rows // max(1, guilds)
+        for _ in range(per_guild // 2):
+            writer.add(
+                "tacos_log",
+                {
+                    "guild_id": guild_id,
+                    "from_user_id": rand.choice(user_ids),
+                    "to_user_id": rand.choice(user_ids),
+                    "count": rand.randint(1, 5),
+                    "type": rand.choice(TACO_TYPES),
+                    "timestamp": now - rand.uniform(0, 86400 * 30),
+                },
+            )
+        for _ in range(per_guild // 3):
+            writer.add("logs", {"guild_id": guild_id, "level": rand.choice(LOG_LEVELS), "message": "benchmark"})
+        for _ in range(per_guild - per_guild // 2 - per_guild // 3):
+            writer.add("system_actions", {"guild_id": guild_id, "action": rand.choice(SYSTEM_ACTIONS), "timestamp": now})
+
+    writer.flush()
+    return writer.counts
+
+
+class Writer:
+    # buffers inserts so large datasets go in as batches
+    def __init__(self, db):
+        self.db = db
+        self.pending = {}
+        self.counts = {}
+
+    def add(self, collection: str, document: dict):
+        self.pending.setdefault(collection, []).append(document)
+        self.counts[collection] = self.counts.get(collection, 0) + 1
+        if len(self.pending[collection]) >= BATCH_SIZE:
+            self.db[collection].insert_many(self.pending.pop(collection))
+
+    def flush(self):
+        for collection, documents in self.pending.items():
+            if documents:
+                self.db[collection].insert_many(documents)
+        self.pending = {}
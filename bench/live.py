@@ -0,0 +1,147 @@
+"""Check lib.live.LiveTracker against a scripted stand-in for a replica set's change streams.
+
+    python -m bench.live
+
+The fake database fails the first watch() like a failover would, then serves streams that apply events,
+drop mid-stream and resync, while a second fake answers like a standalone server. No mongod is needed.
+"""
+import threading
+import time
+import typing
+
+from pymongo.errors import AutoReconnect, OperationFailure
+
+from lib.live import LiveTracker
+
+
+class FakeStream:
+    def __init__(self, events: list, stopped: threading.Event, fail: typing.Optional[Exception] = None):
+        self.events = list(events)
+        self.stopped = stopped
+        self.fail = fail
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.events:
+            return self.events.pop(0)
+        if self.fail is not None:
+            raise self.fail
+        # an open stream with nothing new blocks until the tracker stops
+        self.stopped.wait()
+        raise StopIteration
+
+    def close(self):
+        self.closed = True
+
+
+class FakeReplicaSet:
+    """Serves `streams[collection]` in order from watch(), an exception in the list is raised instead"""
+
+    def __init__(self, documents: dict, streams: dict):
+        self.documents = documents
+        self.streams = streams
+        self.watches = {collection: 0 for collection in streams}
+
+    def watch(self, collection: str, **kwargs):
+        self.watches[collection] += 1
+        stream = self.streams[collection].pop(0)
+        if isinstance(stream, Exception):
+            raise stream
+        return stream
+
+    def get_live_tracked(self):
+        return [dict(document) for document in self.documents["live_tracked"]]
+
+    def get_live_activity_status(self):
+        return [dict(document) for document in self.documents["live_activity"]]
+
+    def owns_guild(self, guild_id) -> bool:
+        return True
+
+
+def change(operation: str, document_id, document: typing.Optional[dict] = None) -> dict:
+    event = {"operationType": operation, "documentKey": {"_id": document_id}}
+    if document is not None:
+        event["fullDocument"] = document
+    return event
+
+
+def wait_for(condition: typing.Callable, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return
+        time.sleep(0.01)
+    raise AssertionError("timed out waiting for the tracker")
+
+
+def check_replica_set():
+    stopped = threading.Event()
+    tracked = [{"_id": 1, "guild_id": "1"}, {"_id": 2, "guild_id": "2"}]
+    activity = [{"_id": 10, "guild_id": "1", "platform": "twitch", "status": "ONLINE"}]
+    db = FakeReplicaSet(
+        {"live_tracked": tracked, "live_activity": activity},
+        {
+            "live_tracked": [
+                AutoReconnect("primary stepped down"),
+                FakeStream(
+                    [change("insert", 3, {"_id": 3, "guild_id": "1"}), change("delete", 2)],
+                    stopped,
+                    fail=AutoReconnect("connection reset"),
+                ),
+                FakeStream([change("insert", 4, {"_id": 4, "guild_id": "2"})], stopped),
+            ],
+            "live_activity": [
+                FakeStream(
+                    [
+                        change("update", 10, {"_id": 10, "guild_id": "1", "platform": "twitch", "status": "OFFLINE"}),
+                        change("insert", 11, {"_id": 11, "guild_id": "2", "platform": "youtube", "status": "ONLINE"}),
+                        # replaying an event must not count it twice
+                        change("insert", 11, {"_id": 11, "guild_id": "2", "platform": "youtube", "status": "ONLINE"}),
+                    ],
+                    stopped,
+                ),
+            ],
+        },
+    )
+    tracker = LiveTracker(db, retry_delay=0.05)
+    tracker._stopped = stopped
+    tracker.start()
+    try:
+        # the resync after the dropped stream reloads the documents, so only the last stream's insert is on top
+        wait_for(lambda: tracker.ready and db.watches["live_tracked"] == 3)
+        wait_for(lambda: sorted(map(tuple, (r.values() for r in tracker.live_now_rows()))) == [("1", 1), ("2", 2)])
+        online = [{"_id": {"guild_id": "2", "platform": "youtube"}, "total": 1}]
+        wait_for(lambda: tracker.live_platform_rows() == online)
+        assert tracker.available, "a failover must not turn the change streams off"
+    finally:
+        tracker.stop()
+
+
+def check_standalone():
+    unsupported = OperationFailure("The $changeStream stage is only supported on replica sets", code=40573)
+    db = FakeReplicaSet(
+        {"live_tracked": [], "live_activity": []},
+        {"live_tracked": [unsupported], "live_activity": [unsupported]},
+    )
+    tracker = LiveTracker(db, retry_delay=0.05)
+    tracker.start()
+    wait_for(lambda: not tracker.available)
+    for thread in tracker._threads:
+        thread.join(1)
+    # neither thread retries once the server said no
+    assert not tracker.ready and all(count <= 1 for count in db.watches.values())
+
+
+def main_cli():
+    check_replica_set()
+    print("replica set: events applied, failover retried and resynced")
+    check_standalone()
+    print("standalone: tracker unavailable, live metrics polled")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,181 @@
+"""Benchmark TacoBotMetrics.fetch() against a synthetic dataset.
+
+    python -m bench.run --mock --guilds 10 --users 1000 --logs 100000 --cycles 5 --output results.json
+    MONGODB_URL=mongodb://localhost:27017 python -m bench.run --guilds 50 --users 5000
+
+Against a mongod the dataset is written to the `tacobot` database, which has to be empty unless `--drop` or
+`--reuse` is given. `--mock` runs against mongomock, which has to be installed separately and does not
+support every stage the real server does (e.g. $setWindowFields for leaderboards.topN).
+
+The results are json; since the exporter logs to stdout as well, use `--output` when comparing runs.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import typing
+
+from prometheus_client import generate_latest, REGISTRY
+
+import main
+from bench import dataset
+
+
+def percentile(values: typing.List[float], p: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summary(values: typing.List[float]) -> dict:
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else 0,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "max": max(values) if values else 0,
+    }
+
+
+def timed(durations: list, fetch: typing.Callable) -> typing.Callable:
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fetch(*args, **kwargs)
+        finally:
+            durations.append(time.perf_counter() - start)
+
+    return wrapper
+
+
+def collector_seconds(histogram) -> typing.Dict[str, typing.Tuple[float, float]]:
+    """The running `(sum, count)` of the exporter's collector_duration_seconds per collector"""
+    totals = {}
+    for metric in histogram.collect():
+        for sample in metric.samples:
+            name = sample.labels.get("collector")
+            if sample.name.endswith("_sum"):
+                totals[name] = (sample.value, totals.get(name, (0, 0))[1])
+            elif sample.name.endswith("_count"):
+                totals[name] = (totals.get(name, (0, 0))[0], sample.value)
+    return totals
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on linux and bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def connect(args, db):
+    if args.mock:
+        import mongomock
+
+        db.client = mongomock.MongoClient()
+        db.connection = db.client.tacobot
+        # mongomock has nothing to ping
+        db.last_health_check = float("inf")
+    else:
+        db.open()
+
+
+def run(args) -> dict:
+    config = main.AppConfig(args.config)
+    config.metrics["mode"] = "poll"
+    config.mongodb["persistent"] = True
+    config.live["changeStreams"] = False
+    config.indexes["checkOnStartup"] = False
+    config.indexes["create"] = False
+    # a snapshot would restore the previous run's series and write into the source tree
+    config.snapshot["enabled"] = False
+
+    app = main.TacoBotMetrics(config)
+    connect(args, app.db)
+
+    generated = {}
+    existing = app.db.connection.list_collection_names()
+    if args.drop:
+        for collection in existing:
+            app.db.connection.drop_collection(collection)
+        existing = []
+    if not args.reuse:
+        if existing:
+            raise SystemExit("the tacobot database is not empty, pass --drop to replace it or --reuse to keep it")
+        start = time.perf_counter()
+        generated = dataset.generate(
+            app.db.connection, guilds=args.guilds, users=args.users, log_rows=args.logs, seed=args.seed
+        )
+        print(f"generated {sum(generated.values())} documents in {time.perf_counter() - start:.1f}s")
+
+    # the exporter's own query timings include reading every row, which happens after fetch() returns a cursor.
+    # the $facet prefetch is timed on its own, its rows are charged to no single collector.
+    durations = {c.name: [] for c in app.collectors}
+    prefetches = []
+    app.db.prefetch = timed(prefetches, app.db.prefetch)
+
+    cycles = []
+    for cycle in range(args.cycles):
+        # every collector runs every cycle, whatever its tier
+        app.scheduler.next_run = {}
+        before = collector_seconds(app.exporter_metrics.collector_duration)
+        start = time.perf_counter()
+        app.fetch()
+        cycles.append(time.perf_counter() - start)
+        after = collector_seconds(app.exporter_metrics.collector_duration)
+        for name, (total, count) in after.items():
+            if name in durations and count > before.get(name, (0, 0))[1]:
+                durations[name].append(total - before.get(name, (0, 0))[0])
+        print(f"cycle {cycle + 1}/{args.cycles} took {cycles[-1]:.3f}s")
+
+    exposition = generate_latest(REGISTRY)
+    app.scheduler.shutdown()
+    app.db.close()
+
+    return {
+        "version": main.dict_get(os.environ, "APP_VERSION", "1.0.0-snapshot"),
+        "sha": main.dict_get(os.environ, "APP_BUILD_SHA", "unknown"),
+        "python": platform.python_version(),
+        "backend": "mongomock" if args.mock else "mongod",
+        "scale": {"guilds": args.guilds, "users": args.users, "logs": args.logs, "seed": args.seed},
+        "documents": generated,
+        "cycle_seconds": summary(cycles),
+        "prefetch_seconds": summary(prefetches),
+        "collector_seconds": {name: summary(values) for name, values in durations.items()},
+        "peak_rss_bytes": peak_rss_bytes(),
+        "exposition_bytes": len(exposition),
+        "exposition_series": sum(1 for line in exposition.decode("utf-8").splitlines() if not line.startswith("#")),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmark the exporter against a synthetic TacoBot dataset")
+    parser.add_argument("--mock", action="store_true", help="run against mongomock instead of MONGODB_URL")
+    parser.add_argument("--guilds", type=int, default=10)
+    parser.add_argument("--users", type=int, default=1000, help="users per guild")
+    parser.add_argument("--logs", type=int, default=100000, help="rows across logs, tacos_log and system_actions")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--config", default="./bench/.configuration.yaml", help="exporter config file, optional")
+    parser.add_argument("--drop", action="store_true", help="drop the tacobot database before generating")
+    parser.add_argument("--reuse", action="store_true", help="benchmark the data already in the database")
+    parser.add_argument("--output", help="write the results here as json instead of stdout")
+    args = parser.parse_args()
+
+    if args.mock:
+        os.environ.setdefault("MONGODB_URL", "mongodb://localhost")
+
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"results written to {args.output}")
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main_cli()
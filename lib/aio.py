@@ -0,0 +1,199 @@
+import asyncio
+import concurrent.futures
+import functools
+import os
+import time
+import traceback
+
+from lib import exposition
+from lib import mongo
+
+
+class AsyncRuntime:
+    """Runs the exporter on an asyncio event loop, with motor for the queries and aiohttp for the endpoints.
+
+    Every cycle the due collectors are planned, their pipelines (batched into $facet queries like the threaded
+    runtime) run concurrently on motor with a timeout, and the rows are handed to the collectors' own fetch
+    through the MongoDatabase prefetch. A pipeline that fails or times out is left to the collector, which
+    runs and retries it itself on the worker pool. Queries that are not a single aggregate (counts, finds and
+    the incremental ranges) take that path too.
+
+    In scrape mode the refresh a scrape triggers runs this same fetch on the loop, and values restored from a
+    snapshot are refreshed in the background at startup. /metrics is rendered, and waits for that refresh, on
+    its own executor, so scrapes queued behind a slow refresh can't take the threads the fetch itself needs.
+
+    Serves /metrics from the exposition cache, /healthz while the loop is responsive and /readyz once values
+    have been collected or restored.
+    """
+
+    def __init__(self, app, port: int, query_timeout: float = 60):
+        try:
+            import motor.motor_asyncio  # noqa: F401
+            from aiohttp import web  # noqa: F401
+        except ImportError as ex:
+            raise RuntimeError(
+                f"metrics.runtime asyncio needs the motor and aiohttp packages (setup/requirements-async.txt): {ex}"
+            )
+        self.app = app
+        self.port = port
+        self.query_timeout = query_timeout
+        self.client = None
+        self.connection = None
+        self.semaphore = None
+        self.warm_start = None
+        self.loop = None
+        # the fetch a scrape started, waited for instead of starting another if it outlived the scrape's timeout
+        self.refreshing = None
+        # ping and prefetch are bounded by the query timeout, the collectors by the cycle budget if there is one
+        self.refresh_timeout = query_timeout + (app.cycle_budget or query_timeout)
+        self.render_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="render")
+
+    def open(self):
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        if "MONGODB_URL" not in os.environ or os.environ["MONGODB_URL"] == "":
+            raise ValueError("MONGODB_URL is not set")
+        settings = self.app.db.settings
+        options = {k: settings[k] for k in mongo.CLIENT_OPTIONS if settings.get(k) is not None}
+        self.client = AsyncIOMotorClient(os.environ["MONGODB_URL"], appname="tacobot-exporter", **options)
+        self.connection = self.client.tacobot
+
+    async def run(self):
+        from aiohttp import web
+
+        self.open()
+        self.semaphore = asyncio.Semaphore(self.app.scheduler.concurrency)
+        self.loop = asyncio.get_running_loop()
+        if self.app.mode == "scrape":
+            # scrapes refresh through this runtime's fetch on the loop instead of the threaded pymongo one.
+            # the scrape collector calls it from the render thread serving /metrics and keeps single-flighting it
+            self.app.scrape_collector.refresh = self.refresh
+
+        server = web.Application()
+        server.router.add_get("/healthz", self.healthz)
+        server.router.add_get("/readyz", self.readyz)
+        server.router.add_get("/{tail:.*}", self.metrics)
+        runner = web.AppRunner(server, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, port=self.port).start()
+        print(f"serving /metrics on :{self.port} from the asyncio runtime")
+
+        try:
+            if self.app.mode == "scrape":
+                print("collecting metrics when /metrics is scraped")
+                if self.app.scrape_collector.warm:
+                    # serve the restored values right away and refresh them in the background
+                    self.warm_start = self.loop.run_in_executor(
+                        self.render_executor, self.app.scrape_collector.refresh_if_stale
+                    )
+                await asyncio.Event().wait()
+            while True:
+                print(f"begin metrics fetch")
+                await self.fetch()
+                print(f"end metrics fetch")
+                await asyncio.sleep(max(1, self.app.scheduler.seconds_until_due()))
+        finally:
+            await runner.cleanup()
+            self.client.close()
+            self.render_executor.shutdown(wait=False)
+
+    def refresh(self):
+        """Run a fetch on the loop and wait for it, from a render thread"""
+        if self.refreshing is None or self.refreshing.done():
+            self.refreshing = asyncio.run_coroutine_threadsafe(self.fetch(), self.loop)
+        try:
+            self.refreshing.result(self.refresh_timeout)
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError(f"refresh still running after {self.refresh_timeout:.0f}s, serving the previous values")
+
+    async def fetch(self):
+        start = time.monotonic()
+        try:
+            if not await self.ping():
+                print("unable to reach mongodb, skipping metrics fetch")
+                return
+
+            due = self.app.due_collectors()
+            deadline = self.app.cycle_deadline(start)
+            # planning may load the user directory, which still reads through pymongo
+            plans = await asyncio.to_thread(self.app.plans, due)
+            self.app.db.clear_prefetched()
+            await asyncio.gather(
+                *(self.prefetch(*query, deadline=deadline) for query in self.app.db.batch(plans, single=True))
+            )
+
+            # the aggregates are answered from the prefetched rows, the pool only maps them and runs what's left
+            await asyncio.to_thread(self.app.run_collectors, due, start, deadline)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.app.observe_cycle(start)
+
+    async def ping(self) -> bool:
+        try:
+            await asyncio.wait_for(self.client.admin.command("ping"), self.query_timeout)
+            return True
+        except asyncio.CancelledError:
+            raise
+        except Exception as ex:
+            print(f"mongodb health check failed: {ex}")
+            return False
+
+    async def prefetch(self, collection: str, pipeline: list, keys: list, options: dict, deadline=None):
+        async with self.semaphore:
+            # the runtime's query timeout, or less when the cycle deadline comes first
+            timeout = self.query_timeout
+            if deadline is not None:
+                timeout = max(0.001, min(timeout, deadline - time.monotonic()))
+            try:
+                target = self.connection[collection]
+                if mongo.collection_options(options):
+                    target = target.with_options(**mongo.collection_options(options))
+                kwargs = mongo.aggregate_options(options)
+                # the collector's maxTimeMS if it is shorter than the timeout
+                kwargs["maxTimeMS"] = min(max(1, int(timeout * 1000)), kwargs.get("maxTimeMS") or float("inf"))
+                cursor = target.aggregate(self.app.db.shard_pipeline(collection, pipeline), **kwargs)
+                rows = await asyncio.wait_for(cursor.to_list(length=None), timeout)
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                print(f"{collection} query timed out after {timeout:.1f}s")
+                return
+            except Exception as ex:
+                print(f"{collection} query failed: {ex}")
+                return
+        self.app.db.provide(keys, rows)
+
+    async def metrics(self, request):
+        from aiohttp import web
+
+        if request.path == "/favicon.ico":
+            return web.Response(body=b"")
+        # rendering is cpu bound and, in scrape mode, runs the refresh, so keep it off the loop and off the
+        # default executor the fetch runs on
+        status, headers, body = await self.loop.run_in_executor(
+            self.render_executor,
+            functools.partial(
+                exposition.respond,
+                self.app.exposition,
+                query_string=request.query_string,
+                accept_encoding=request.headers.get("Accept-Encoding", ""),
+                if_none_match=request.headers.get("If-None-Match", ""),
+            ),
+        )
+        headers = [(name, value) for name, value in headers if name != "Content-Length"]
+        return web.Response(status=int(status.split(" ")[0]), headers=dict(headers), body=body)
+
+    async def healthz(self, request):
+        from aiohttp import web
+
+        return web.Response(text="ok")
+
+    async def readyz(self, request):
+        from aiohttp import web
+
+        if self.app.collected_at is None:
+            return web.Response(status=503, text="no metrics collected yet")
+        return web.Response(text="ok")
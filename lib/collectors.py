@@ -0,0 +1,1041 @@
+from bson.objectid import ObjectId
+from prometheus_client import Gauge, REGISTRY
+from lib.mongo import OTHER, QUERY_OPTIONS, deadline_options
+from lib.windows import RingBuffer, parse_duration
+import datetime
+import pytz
+import time
+import typing
+
+# every collector class, in the order they are applied each cycle
+COLLECTORS = []
+
+guild_labels = [
+    "guild_id",
+]
+
+user_labels = [
+    "guild_id",
+    "user_id",
+    "username",
+]
+
+live_labels = [
+    "guild_id",
+    "user_id",
+    "username",
+    "platform",
+]
+
+
+def register(cls):
+    COLLECTORS.append(cls)
+    return cls
+
+
+class Collector:
+    # collector name, used as the key in the `collectors` config section
+    name = None
+    # gauge name, defaults to the collector name
+    metric = None
+    documentation = ""
+    labelnames = guild_labels
+    # name of the MongoDatabase method that fetches the rows
+    query = None
+    enabled_by_default = True
+    # not split by guild, with sharding only shard 0 exports it
+    global_metric = False
+    # refresh tier: fast for cheap, volatile metrics, slow for expensive or rarely changing ones
+    tier = "default"
+    # per user labels that are set to `other` for the series over the `maxSeries` budget, empty to not enforce one
+    fold_labels = []
+    # zero fills for every guild in `context["known_guilds"]`, so it is applied after guilds in the same cycle
+    needs_guilds = False
+
+    def __init__(
+        self,
+        db,
+        namespace: str = "tacobot",
+        registry=REGISTRY,
+        settings: typing.Optional[dict] = None,
+        users=None,
+    ):
+        self.db = db
+        # shared lib.users.UserDirectory used to resolve usernames
+        self.users = users
+        self.namespace = namespace
+        self.settings = settings or {}
+        self.tier = self.settings.get("tier", self.tier)
+        # label values -> (generation, time) each series was last set, used to evict series that went away
+        self.generation = 0
+        self.seen = {}
+        # label values -> value of the series set during an update, while a series budget is enforced
+        self.pending = None
+        # series folded into `other` by the last update
+        self.dropped = 0
+        # the lib.sharding.GuildSharding version the exported guilds were last checked against
+        self.owned_version = None
+        self.gauge = Gauge(
+            namespace=namespace,
+            name=self.metric or self.name,
+            documentation=self.documentation,
+            labelnames=self.labelnames,
+            registry=registry,
+        )
+
+    def interval(self, tiers: dict) -> float:
+        if self.settings.get("interval"):
+            return float(self.settings["interval"])
+        return float(tiers.get(self.tier, tiers["default"]))
+
+    def query_kwargs(self) -> dict:
+        return {}
+
+    def fetch(self):
+        return getattr(self.db, self.query)(**self.query_kwargs())
+
+    def query_options(self) -> dict:
+        # read preference, read concern, maxTimeMS and allowDiskUse from the collector settings
+        return {name: self.settings[name] for name in QUERY_OPTIONS if self.settings.get(name) not in [None, ""]}
+
+    def run(self, deadline: typing.Optional[float] = None):
+        """Fetch with this collector's query options, with maxTimeMS capped at the `time.monotonic()` deadline"""
+        with self.db.query_options(deadline_options(self.query_options(), deadline)):
+            return self.fetch()
+
+    def deadline(self, start: float, cycle_deadline: typing.Optional[float] = None) -> typing.Optional[float]:
+        """When a cycle started at `start` stops waiting for this collector: its `timeout` or the cycle's deadline"""
+        deadlines = [cycle_deadline] if cycle_deadline is not None else []
+        if self.settings.get("timeout"):
+            deadlines.append(start + float(self.settings["timeout"]))
+        return min(deadlines) if deadlines else None
+
+    def plan(self) -> typing.Optional[tuple]:
+        """The `(collection, pipeline, options)` the next fetch will aggregate, or None when it does not run one
+        aggregate"""
+        with self.db.query_options(self.query_options()):
+            return self.db.capture(getattr(self.db, self.query), **self.query_kwargs())
+
+    def explain_plan(self) -> typing.Optional[tuple]:
+        """The `(collection, pipeline, options)` the index advisor explains for this collector"""
+        return self.plan()
+
+    def update(self, rows, context: dict):
+        """Apply a fetch result to the gauge, then drop the label sets the result no longer contains"""
+        self.generation += 1
+        budget = int(self.settings.get("maxSeries", 0) or 0)
+        if self.fold_labels and budget > 0:
+            self.pending = {}
+            try:
+                self.apply(rows, context)
+                series = self.fold(self.pending, budget)
+            finally:
+                self.pending = None
+            for key, value in series.items():
+                self.set(value, **dict(zip(self.labelnames, key)))
+        else:
+            self.dropped = 0
+            self.apply(rows, context)
+        if self.settings.get("evictStale", True):
+            self.evict()
+        self.evict_unowned()
+
+    def fold(self, series: dict, budget: int) -> dict:
+        """Keep the `budget` largest series and add the rest up into `other` series, one per set of other labels.
+
+        Ties are broken by the label values, so the same rows always keep the same series.
+        """
+        folded = [self.labelnames.index(name) for name in self.fold_labels]
+        ranked = sorted(
+            [key for key in series if any(key[i] != OTHER for i in folded)], key=lambda key: (-(series[key] or 0), key)
+        )
+        result = {key: value for key, value in series.items() if all(key[i] == OTHER for i in folded)}
+        for key in ranked[:budget]:
+            result[key] = series[key]
+        for key in ranked[budget:]:
+            other = tuple(OTHER if i in folded else value for i, value in enumerate(key))
+            result[other] = (result.get(other) or 0) + (series[key] or 0)
+        self.dropped = max(0, len(ranked) - budget)
+        return result
+
+    def set(self, value, **labels):
+        if self.pending is not None:
+            self.pending[tuple(str(labels[name]) for name in self.labelnames)] = value
+            return
+        self.gauge.labels(**labels).set(value)
+        self.seen[tuple(str(labels[name]) for name in self.labelnames)] = (self.generation, time.monotonic())
+
+    def evict(self):
+        # a series is removed once it was missing from a result and has not been seen for the grace period
+        grace = self.settings.get("staleGracePeriod", 0)
+        now = time.monotonic()
+        for key, (generation, seen) in list(self.seen.items()):
+            if generation < self.generation and now - seen >= grace:
+                try:
+                    self.gauge.remove(*key)
+                except KeyError:
+                    pass
+                del self.seen[key]
+
+    def evict_unowned(self):
+        # when the guild list refresh moved a guild to another shard, its owner exports it from now on
+        sharding = self.db.sharding
+        if sharding is None or "guild_id" not in self.labelnames or sharding.version == self.owned_version:
+            return
+        self.owned_version = sharding.version
+        index = self.labelnames.index("guild_id")
+        for key in list(self.seen):
+            if not sharding.includes(key[index]):
+                try:
+                    self.gauge.remove(*key)
+                except KeyError:
+                    pass
+                del self.seen[key]
+
+    def apply(self, rows, context: dict):
+        # default mapping for the `{_id: guild_id, total: n}` rows most pipelines return
+        for row in rows:
+            self.set(row["total"], guild_id=row["_id"])
+
+
+class UserCollector(Collector):
+    labelnames = user_labels
+    fold_labels = ["user_id", "username"]
+
+    def query_kwargs(self) -> dict:
+        return {"exclude": self.users.excluded()}
+
+    def fetch(self):
+        return self.resolve_users(super().fetch())
+
+    def resolve_users(self, rows) -> list:
+        # attach the user from the directory, in the same shape the users $lookup used to produce.
+        # like the lookup, rows for unknown users, bots and system users are dropped.
+        rows = list(rows)
+        keys = [(row["_id"]["guild_id"], row["_id"]["user_id"]) for row in rows if row["_id"]["user_id"] != OTHER]
+        users = self.users.resolve(keys)
+        resolved = []
+        for row in rows:
+            if row["_id"]["user_id"] == OTHER:
+                resolved.append(row)
+                continue
+            user = users.get((row["_id"]["guild_id"], row["_id"]["user_id"]))
+            if user is None or user.bot or user.system:
+                continue
+            row["user"] = [{"user_id": row["_id"]["user_id"], "username": user.username}]
+            resolved.append(row)
+        return resolved
+
+    def resolve_user(self, row) -> dict:
+        # fall back to the user id when the user could not be resolved
+        user = {
+            "user_id": row["_id"]["user_id"],
+            "username": row["_id"]["user_id"],
+        }
+        if row.get("user") is not None and len(row["user"]) > 0:
+            user["username"] = row["user"][0]["username"]
+        return user
+
+    def apply(self, rows, context: dict):
+        for row in rows:
+            user = self.resolve_user(row)
+            labels = {"guild_id": row["_id"]["guild_id"], "user_id": user["user_id"], "username": user["username"]}
+            self.set(row["total"], **labels)
+
+
+class LeaderboardCollector(UserCollector):
+    def limit(self) -> int:
+        return int(self.settings.get("topN", 0) or 0)
+
+    def query_kwargs(self) -> dict:
+        # with topN set, only the top users of each guild are ranked, resolved and exported. `topNMargin` more are
+        # ranked, so the users the directory does not know, and drops, don't leave the leaderboard short
+        limit = self.limit()
+        return {
+            "limit": limit + int(self.settings.get("topNMargin", 0) or 0) if limit else 0,
+            "other": bool(self.settings.get("topNOther", False)),
+            **super().query_kwargs(),
+        }
+
+    def fetch(self):
+        return self.trim(super().fetch())
+
+    def trim(self, rows: list) -> list:
+        # keep the top `topN` resolved users of each guild, with `topNOther` the rest of the margin goes into `other`
+        limit = self.limit()
+        if not limit:
+            return rows
+        fold = bool(self.settings.get("topNOther", False))
+        kept = []
+        counts = {}
+        others = {}
+        for row in rows:
+            if row["_id"]["user_id"] == OTHER:
+                others[row["_id"]["guild_id"]] = dict(row)
+        for row in sorted(rows, key=lambda row: (-(row["total"] or 0), str(row["_id"]["user_id"]))):
+            guild_id = row["_id"]["guild_id"]
+            if row["_id"]["user_id"] == OTHER:
+                continue
+            if counts.get(guild_id, 0) < limit:
+                counts[guild_id] = counts.get(guild_id, 0) + 1
+                kept.append(row)
+            elif fold:
+                other = others.setdefault(guild_id, {"_id": {"guild_id": guild_id, "user_id": OTHER}, "total": 0})
+                other["total"] = (other["total"] or 0) + (row["total"] or 0)
+        return kept + list(others.values())
+
+
+class RangeCollector(Collector):
+    """Reads an append-only collection one range at a time, keeping what it has read in memory.
+
+    Each fetch reads the range from the watermark to the current time less `settleSeconds`, so documents still
+    being written are picked up by the next fetch. Every `reconcileInterval` seconds, on the first fetch and
+    on every fetch with `incremental: false`, the range starts from `reconcile_from()` instead and the state is
+    rebuilt from it. So it is when the shard's guilds change, as the state of a guild that moved between shards
+    was built by its previous owner. Subclasses read a range with `read()` and fold its rows into their state
+    with `commit()`.
+    """
+
+    def __init__(self, db, **kwargs):
+        super().__init__(db, **kwargs)
+        self.watermark = None
+        self.last_reconcile = 0
+        # the lib.sharding.GuildSharding version the state was last rebuilt for
+        self.reconciled_version = None
+
+    def plan(self):
+        # the range depends on the watermark, these scans are already cheap and stay on their own
+        return None
+
+    def explain_plan(self) -> typing.Optional[tuple]:
+        # an incremental range like the ones between reconciles, which is what the timestamp indexes serve
+        until = self.bound(time.time() - self.settings.get("settleSeconds", 5))
+        after = self.watermark
+        if after is None:
+            after = self.bound(time.time() - self.settings.get("reconcileInterval", 3600))
+        with self.db.query_options(self.query_options()):
+            return self.db.capture(self.read, after, until)
+
+    def bound(self, timestamp: float):
+        """The watermark for a unix time"""
+        return timestamp
+
+    def reconcile_from(self, until):
+        """Where a reconcile starts reading, None for the start of the collection"""
+        return None
+
+    def read(self, after, until):
+        return getattr(self.db, self.query)(after=after, until=until)
+
+    def commit(self, rows: list, reconcile: bool, until) -> list:
+        """Fold the rows of a range into the state and return the rows to apply"""
+        raise NotImplementedError
+
+    def fetch(self):
+        until = self.bound(time.time() - self.settings.get("settleSeconds", 5))
+        version = None
+        if self.db.sharding is not None:
+            self.db.sharding.guilds()
+            version = self.db.sharding.version
+        reconcile = (
+            not self.settings.get("incremental", True)
+            or self.watermark is None
+            or version != self.reconciled_version
+            or time.monotonic() - self.last_reconcile >= self.settings.get("reconcileInterval", 3600)
+        )
+        after = self.reconcile_from(until) if reconcile else self.watermark
+
+        rows = list(self.read(after, until))
+        # only commit once the whole range has been read, so a failed fetch is retried from the same point
+        result = self.commit(rows, reconcile, until)
+        self.watermark = until
+        if reconcile:
+            self.last_reconcile = time.monotonic()
+            self.reconciled_version = version
+        return result
+
+
+class IncrementalCollector(RangeCollector):
+    """Keeps running totals for an append-only collection.
+
+    Each fetch only aggregates the documents inserted since the last watermark, an ObjectId, and adds them to
+    the totals held in memory. A reconcile rebuilds the totals from a full scan.
+    """
+
+    def __init__(self, db, **kwargs):
+        super().__init__(db, **kwargs)
+        self.totals = {}
+
+    def bound(self, timestamp: float):
+        return ObjectId.from_datetime(datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc))
+
+    def commit(self, rows: list, reconcile: bool, until) -> list:
+        totals = {} if reconcile else dict(self.totals)
+        for row in rows:
+            key = tuple(sorted(row["_id"].items()))
+            previous = totals.get(key, {"total": 0})["total"]
+            totals[key] = {"_id": row["_id"], "total": previous + (row["total"] or 0)}
+        self.totals = totals
+        return list(totals.values())
+
+
+class WindowedCollector(RangeCollector):
+    """Exports counts over trailing windows (e.g. the last 1h, 24h and 7d) of an append-only collection.
+
+    Counts are kept in memory per label set in `bucketSeconds` wide time buckets, covering the longest window.
+    Each fetch only aggregates the documents whose `timestamp` is newer than the watermark into buckets and adds
+    them to the ring, so the windows cost O(new documents) per cycle. A reconcile rebuilds the ring from the
+    longest window.
+    """
+
+    labelnames = ["guild_id", "window"]
+
+    def __init__(self, db, **kwargs):
+        super().__init__(db, **kwargs)
+        windows = self.settings.get("windows") or ["1h", "24h", "7d"]
+        if isinstance(windows, str):
+            windows = [window.strip() for window in windows.split(",") if window.strip()]
+        self.windows = {str(window): parse_duration(window) for window in windows}
+        self.span = max(self.windows.values())
+        self.bucket_seconds = int(self.settings.get("bucketSeconds", 300))
+        self.buffer = None
+
+    def reconcile_from(self, until):
+        return until - self.span
+
+    def read(self, after, until):
+        return getattr(self.db, self.query)(after=after, until=until, bucket_seconds=self.bucket_seconds)
+
+    def commit(self, rows: list, reconcile: bool, until) -> list:
+        buffer = RingBuffer(self.bucket_seconds, self.span) if reconcile else self.buffer
+        buffer.advance(until)
+        for row in rows:
+            key = tuple(row["_id"].get(name) for name in self.labelnames if name != "window")
+            buffer.add(key, int(row["_id"]["bucket"]), row["total"] or 0)
+        buffer.prune()
+        self.buffer = buffer
+
+        results = []
+        for key in buffer.keys():
+            labels = dict(zip([name for name in self.labelnames if name != "window"], key))
+            for window, seconds in self.windows.items():
+                results.append({"_id": {**labels, "window": window}, "total": buffer.total(key, seconds)})
+        return results
+
+    def apply(self, rows, context: dict):
+        for row in rows:
+            self.set(row["total"], **row["_id"])
+
+
+class Registry:
+    def __init__(
+        self,
+        db,
+        settings: typing.Optional[dict] = None,
+        namespace: str = "tacobot",
+        registry=REGISTRY,
+        defaults: typing.Optional[dict] = None,
+        users=None,
+        include_global: bool = True,
+    ):
+        self.settings = settings or {}
+        self.collectors = []
+        for cls in COLLECTORS:
+            if cls.global_metric and not include_global:
+                continue
+            # collector settings fall back to the settings for the collector's tier, then the exporter wide defaults
+            defaults = defaults or {}
+            own = self.settings.get(cls.name) or {}
+            tier = own.get("tier", cls.tier)
+            collector_settings = {**defaults, **((defaults.get("byTier") or {}).get(tier) or {}), **own}
+            if not collector_settings.get("enabled", cls.enabled_by_default):
+                print(f"collector {cls.name} is disabled")
+                continue
+            self.collectors.append(
+                cls(db, namespace=namespace, registry=registry, settings=collector_settings, users=users)
+            )
+
+    def __iter__(self):
+        return iter(self.collectors)
+
+    def __len__(self):
+        return len(self.collectors)
+
+    def get(self, name: str) -> typing.Optional[Collector]:
+        for collector in self.collectors:
+            if collector.name == name:
+                return collector
+        return None
+
+
+# collectors with `needs_guilds` are applied after guilds when both run in a cycle, so they can zero fill for
+# every known guild. the list is kept in the context between cycles, as the other collectors may refresh more
+# often. until guilds has been read once it is empty and those collectors only set the series they read.
+@register
+class GuildsCollector(Collector):
+    name = "guilds"
+    documentation = "The number of guilds"
+    labelnames = ["guild_id", "name"]
+    query = "get_guilds"
+    tier = "slow"
+
+    def apply(self, rows, context: dict):
+        known_guilds = []
+        for row in rows:
+            known_guilds.append(row["guild_id"])
+            self.set(1, guild_id=row["guild_id"], name=row["name"])
+        context["known_guilds"] = known_guilds
+
+
+@register
+class TacosCollector(Collector):
+    name = "tacos"
+    documentation = "The number of tacos give to users"
+    query = "get_sum_all_tacos"
+
+
+@register
+class TacoGiftsCollector(Collector):
+    name = "taco_gifts"
+    documentation = "The number of tacos gifted to users"
+    query = "get_sum_all_gift_tacos"
+
+
+@register
+class TacoReactionsCollector(Collector):
+    name = "taco_reactions"
+    documentation = "The number of tacos given to users via reactions"
+    query = "get_sum_all_taco_reactions"
+
+
+@register
+class LiveNowCollector(Collector):
+    name = "live_now"
+    documentation = "The number of people currently live"
+    query = "get_live_now_count"
+    tier = "fast"
+    # set when change streams are enabled, the counts are then read from memory instead of aggregated
+    live_tracker = None
+
+    def fetch(self):
+        if self.live_tracker is not None and self.live_tracker.ready:
+            return self.live_tracker.live_now_rows()
+        return super().fetch()
+
+    def plan(self):
+        if self.live_tracker is not None and self.live_tracker.ready:
+            return None
+        return super().plan()
+
+
+@register
+class TwitchChannelsCollector(Collector):
+    name = "twitch_channels"
+    documentation = "The number of twitch channels the bot is watching"
+    query = "get_twitch_channel_bot_count"
+    tier = "slow"
+
+
+@register
+class TwitchTacosCollector(Collector):
+    name = "twitch_tacos"
+    documentation = "The number of tacos given to twitch users"
+    query = "get_sum_all_twitch_tacos"
+
+
+@register
+class TwitchLinkedAccountsCollector(Collector):
+    name = "twitch_linked_accounts"
+    documentation = "The number of twitch accounts linked to discord accounts"
+    labelnames = []
+    query = "get_twitch_linked_accounts_count"
+    global_metric = True
+    tier = "slow"
+
+    def apply(self, rows, context: dict):
+        self.gauge.set(rows or 0)
+
+
+@register
+class TqotdCollector(Collector):
+    name = "tqotd"
+    documentation = "The number of questions in the TQOTD database"
+    query = "get_tqotd_questions_count"
+    tier = "slow"
+
+
+@register
+class TqotdAnswersCollector(Collector):
+    name = "tqotd_answers"
+    documentation = "The number of answers in the TQOTD database"
+    query = "get_tqotd_answers_count"
+    tier = "slow"
+
+
+@register
+class InvitedUsersCollector(Collector):
+    name = "invited_users"
+    documentation = "The number of users invited to the server"
+    query = "get_invited_users_count"
+
+
+@register
+class LivePlatformCollector(Collector):
+    name = "live_platform"
+    documentation = "The number of users that have gone live on a platform"
+    labelnames = ["guild_id", "platform"]
+    query = "get_sum_live_by_platform"
+    tier = "fast"
+    live_tracker = None
+
+    def fetch(self):
+        if self.live_tracker is not None and self.live_tracker.ready:
+            return self.live_tracker.live_platform_rows()
+        return super().fetch()
+
+    def plan(self):
+        if self.live_tracker is not None and self.live_tracker.ready:
+            return None
+        return super().plan()
+
+    def apply(self, rows, context: dict):
+        for row in rows:
+            self.set(row["total"], guild_id=row["_id"]["guild_id"], platform=row["_id"]["platform"])
+
+
+@register
+class WdyctwQuestionsCollector(Collector):
+    name = "wdyctw_questions"
+    documentation = "The number of questions in the WDYCTW database"
+    query = "get_wdyctw_questions_count"
+    tier = "slow"
+
+
+@register
+class WdyctwAnswersCollector(Collector):
+    name = "wdyctw_answers"
+    documentation = "The number of answers in the WDYCTW database"
+    query = "get_wdyctw_answers_count"
+    tier = "slow"
+
+
+@register
+class TechThursCollector(Collector):
+    name = "techthurs"
+    documentation = "The number of questions in the TechThurs database"
+    query = "get_techthurs_questions_count"
+    tier = "slow"
+
+
+@register
+class TechThursAnswersCollector(Collector):
+    name = "techthurs_answers"
+    documentation = "The number of answers in the TechThurs database"
+    query = "get_techthurs_answers_count"
+    tier = "slow"
+
+
+@register
+class MentalMondaysCollector(Collector):
+    name = "mentalmondays"
+    documentation = "The number of questions in the MentalMondays database"
+    query = "get_mentalmondays_questions_count"
+    tier = "slow"
+
+
+@register
+class MentalMondaysAnswersCollector(Collector):
+    name = "mentalmondays_answers"
+    documentation = "The number of answers in the MentalMondays database"
+    query = "get_mentalmondays_answers_count"
+    tier = "slow"
+
+
+@register
+class TacoTuesdayCollector(Collector):
+    name = "tacotuesday"
+    documentation = "The number of featured posts for TacoTuesday"
+    query = "get_tacotuesday_questions_count"
+    tier = "slow"
+
+
+@register
+class TacoTuesdayAnswersCollector(Collector):
+    name = "tacotuesday_answers"
+    documentation = "The number of interactions in the TacoTuesday database"
+    query = "get_tacotuesday_answers_count"
+    tier = "slow"
+
+
+@register
+class GameKeysAvailableCollector(Collector):
+    name = "game_keys_available"
+    documentation = "The number of game keys available"
+    query = "get_game_keys_available_count"
+    tier = "slow"
+
+
+@register
+class GameKeysRedeemedCollector(Collector):
+    name = "game_keys_redeemed"
+    documentation = "The number of game keys claimed"
+    query = "get_game_keys_redeemed_count"
+    tier = "slow"
+
+
+@register
+class MinecraftWhitelistCollector(Collector):
+    name = "minecraft_whitelist"
+    documentation = "The number of users on the minecraft whitelist"
+    query = "get_minecraft_whitelisted_count"
+    tier = "slow"
+
+
+@register
+class TeamRequestsCollector(Collector):
+    name = "team_requests"
+    documentation = "The number of stream team requests"
+    query = "get_team_requests_count"
+    tier = "slow"
+
+
+@register
+class BirthdaysCollector(Collector):
+    name = "birthdays"
+    documentation = "The number of birthdays"
+    query = "get_birthdays_count"
+    tier = "slow"
+
+
+@register
+class FirstMessagesTodayCollector(RangeCollector):
+    """Counts each guild's first messages since midnight in the guild's timezone.
+
+    The counts of the current day are kept in memory and each fetch only aggregates the first messages newer
+    than the watermark, in 15 minute buckets so every bucket falls on a single local day whatever the guild's
+    UTC offset. When a guild's day rolls over its count starts again from 0 and the final count of the day
+    before is exported as first_messages_previous_day. A reconcile rebuilds both days from the start of
+    yesterday.
+    """
+
+    name = "first_messages_today"
+    documentation = "The number of first messages today"
+    query = "get_first_message_buckets"
+
+    # every UTC offset in use is a multiple of 15 minutes
+    bucket_seconds = 900
+
+    def __init__(self, db, namespace: str = "tacobot", registry=REGISTRY, **kwargs):
+        super().__init__(db, namespace=namespace, registry=registry, **kwargs)
+        self.previous_gauge = Gauge(
+            namespace=namespace,
+            name="first_messages_previous_day",
+            documentation="The number of first messages on the previous day",
+            labelnames=self.labelnames,
+            registry=registry,
+        )
+        self.timezone = pytz.timezone(self.settings.get("timezone") or "UTC")
+        timezones = self.settings.get("timezones") or {}
+        if isinstance(timezones, str):
+            # `guild_id:timezone,guild_id:timezone` from the environment
+            timezones = dict(pair.split(":", 1) for pair in timezones.split(",") if ":" in pair)
+        self.timezones = {str(guild_id).strip(): pytz.timezone(str(tz).strip()) for guild_id, tz in timezones.items()}
+        # guild id -> (date, count) for the guild's current day and the day before it
+        self.days = {}
+        self.previous = {}
+        self.previous_exported = set()
+
+    def local_date(self, guild_id, timestamp: float) -> datetime.date:
+        return datetime.datetime.fromtimestamp(timestamp, self.timezones.get(guild_id, self.timezone)).date()
+
+    def reconcile_from(self, until: float) -> float:
+        # the earliest local midnight of yesterday across the configured timezones
+        starts = []
+        for tz in [self.timezone, *self.timezones.values()]:
+            yesterday = datetime.datetime.fromtimestamp(until, tz).date() - datetime.timedelta(days=1)
+            starts.append(tz.localize(datetime.datetime.combine(yesterday, datetime.time.min)).timestamp())
+        return min(starts)
+
+    def roll(self, days: dict, previous: dict, guild_id, date: datetime.date):
+        current = days.get(guild_id)
+        if current is not None and current[0] >= date:
+            return
+        if current is not None:
+            # the day the guild is leaving is final, unless a day without any messages went by in between
+            yesterday = date - datetime.timedelta(days=1)
+            previous[guild_id] = current if current[0] == yesterday else (yesterday, 0)
+        days[guild_id] = (date, 0)
+
+    def read(self, after: float, until: float):
+        return getattr(self.db, self.query)(after=after, until=until, bucket_seconds=self.bucket_seconds)
+
+    def commit(self, rows: list, reconcile: bool, until: float) -> list:
+        days = {} if reconcile else dict(self.days)
+        previous = {} if reconcile else dict(self.previous)
+        for row in sorted(rows, key=lambda row: row["_id"]["bucket"]):
+            guild_id = row["_id"]["guild_id"]
+            date = self.local_date(guild_id, row["_id"]["bucket"] * self.bucket_seconds)
+            self.roll(days, previous, guild_id, date)
+            current = days[guild_id]
+            if current[0] == date:
+                days[guild_id] = (date, current[1] + row["total"])
+            elif previous.get(guild_id, (None,))[0] == date:
+                # settled late into the day that already rolled over
+                previous[guild_id] = (date, previous[guild_id][1] + row["total"])
+        for guild_id in list(days):
+            self.roll(days, previous, guild_id, self.local_date(guild_id, until))
+
+        # swap in the new day in one go
+        self.days = days
+        self.previous = previous
+        return [
+            {"_id": guild_id, "total": count, "previous": previous.get(guild_id, (None, 0))[1]}
+            for guild_id, (date, count) in days.items()
+        ]
+
+    def apply(self, rows, context: dict):
+        exported = set()
+        for row in rows:
+            self.set(row["total"], guild_id=row["_id"])
+            self.previous_gauge.labels(guild_id=row["_id"]).set(row["previous"])
+            exported.add(row["_id"])
+        for guild_id in self.previous_exported - exported:
+            try:
+                self.previous_gauge.remove(guild_id)
+            except KeyError:
+                pass
+        self.previous_exported = exported
+
+
+@register
+class LogsCollector(IncrementalCollector):
+    name = "logs"
+    documentation = "The number of logs"
+    labelnames = ["guild_id", "level"]
+    query = "get_logs"
+    needs_guilds = True
+
+    def apply(self, rows, context: dict):
+        for gid in context["known_guilds"]:
+            for level in ["INFO", "WARNING", "ERROR", "DEBUG"]:
+                self.set(0, guild_id=gid, level=level)
+        for row in rows:
+            self.set(row["total"], guild_id=row["_id"]["guild_id"], level=row["_id"]["level"])
+
+
+@register
+class KnownUsersCollector(Collector):
+    name = "known_users"
+    documentation = "The number of known users"
+    labelnames = ["guild_id", "type"]
+    query = "get_known_users"
+
+    def apply(self, rows, context: dict):
+        for row in rows:
+            self.set(row["total"], guild_id=row["_id"]["guild_id"], type=row["_id"]["type"])
+
+
+@register
+class MessagesCollector(LeaderboardCollector):
+    name = "messages"
+    documentation = "The number of top messages"
+    query = "get_user_messages_tracked"
+    tier = "slow"
+
+
+@register
+class GiftersCollector(LeaderboardCollector):
+    name = "gifters"
+    documentation = "The number of top gifters"
+    query = "get_top_taco_gifters"
+    tier = "slow"
+
+
+@register
+class ReactorsCollector(LeaderboardCollector):
+    name = "reactors"
+    documentation = "The number of top reactors"
+    query = "get_top_taco_reactors"
+    tier = "slow"
+
+
+@register
+class TopTacosCollector(LeaderboardCollector):
+    name = "top_tacos"
+    documentation = "The number of top tacos"
+    query = "get_top_taco_receivers"
+    tier = "slow"
+
+
+@register
+class LiveActivityCollector(UserCollector):
+    name = "live_activity"
+    documentation = "The number of top live activity"
+    labelnames = live_labels
+    query = "get_live_activity"
+    tier = "fast"
+
+    def apply(self, rows, context: dict):
+        for row in rows:
+            user = self.resolve_user(row)
+            labels = {
+                "guild_id": row["_id"]["guild_id"],
+                "user_id": user["user_id"],
+                "username": user["username"],
+                "platform": row["_id"]["platform"],
+            }
+            self.set(row["total"], **labels)
+
+
+@register
+class SuggestionsCollector(Collector):
+    name = "suggestions"
+    documentation = "The number of suggestions"
+    labelnames = ["guild_id", "status"]
+    query = "get_suggestions"
+    needs_guilds = True
+
+    def apply(self, rows, context: dict):
+        for gid in context["known_guilds"]:
+            for state in ["ACTIVE", "APPROVED", "REJECTED", "IMPLEMENTED", "CONSIDERED", "DELETED", "CLOSED"]:
+                self.set(0, guild_id=gid, status=state)
+        for row in rows:
+            self.set(row["total"], guild_id=row["_id"]["guild_id"], status=row["_id"]["state"])
+
+
+@register
+class UserJoinLeaveCollector(Collector):
+    name = "user_join_leave"
+    documentation = "The number of users that have joined or left"
+    labelnames = ["guild_id", "action"]
+    query = "get_user_join_leave"
+    needs_guilds = True
+
+    def apply(self, rows, context: dict):
+        for gid in context["known_guilds"]:
+            for state in ["JOIN", "LEAVE"]:
+                self.set(0, guild_id=gid, action=state)
+        for row in rows:
+            self.set(row["total"], guild_id=row["_id"]["guild_id"], action=row["_id"]["action"])
+
+
+@register
+class FoodPostsCollector(LeaderboardCollector):
+    name = "food_posts"
+    documentation = "The number of food posts"
+    query = "get_food_posts_count"
+    tier = "slow"
+
+
+@register
+class TacoLogsCollector(IncrementalCollector):
+    name = "taco_logs"
+    documentation = "The number of taco logs"
+    labelnames = ["guild_id", "type"]
+    query = "get_taco_logs_counts"
+
+    def apply(self, rows, context: dict):
+        for row in rows:
+            self.set(row["total"], guild_id=row["_id"]["guild_id"], type=row["_id"]["type"] or "UNKNOWN")
+
+
+@register
+class TriviaQuestionsCollector(Collector):
+    name = "trivia_questions"
+    documentation = "The number of trivia questions"
+    labelnames = ["guild_id", "difficulty", "category", "starter_id", "starter_name"]
+    query = "get_trivia_questions"
+    tier = "slow"
+    fold_labels = ["starter_id", "starter_name"]
+
+    def fetch(self):
+        rows = list(getattr(self.db, self.query)())
+        starters = self.users.resolve([(row["_id"]["guild_id"], row["_id"]["starter_id"]) for row in rows])
+        for row in rows:
+            starter = starters.get((row["_id"]["guild_id"], row["_id"]["starter_id"]))
+            row["starter_name"] = starter.username if starter is not None else row["_id"]["starter_id"]
+        return rows
+
+    def apply(self, rows, context: dict):
+        for row in rows:
+            labels = {
+                "guild_id": row["_id"]["guild_id"],
+                "category": row["_id"]["category"],
+                "difficulty": row["_id"]["difficulty"],
+                "starter_id": row["_id"]["starter_id"],
+                "starter_name": row["starter_name"],
+            }
+            self.set(row["total"], **labels)
+
+
+@register
+class TriviaAnswersCollector(UserCollector):
+    name = "trivia_answers"
+    documentation = "The number of trivia answers"
+    labelnames = ["guild_id", "user_id", "username", "state"]
+    query = "get_trivia_answer_status_per_user"
+    tier = "slow"
+    # a series per user and answer state, enable it under `collectors.trivia_answers`
+    enabled_by_default = False
+
+    def apply(self, rows, context: dict):
+        for row in rows:
+            user = self.resolve_user(row)
+            labels = {
+                "guild_id": row["_id"]["guild_id"],
+                "user_id": user["user_id"],
+                "username": user["username"],
+                "state": row["_id"]["state"],
+            }
+            self.set(row["total"], **labels)
+
+
+@register
+class InvitesCollector(LeaderboardCollector):
+    name = "invites"
+    documentation = "The number of invites"
+    query = "get_invites_by_user"
+    tier = "slow"
+
+    def apply(self, rows, context: dict):
+        for row in rows:
+            if row["total"] is None or row["total"] <= 0:
+                continue
+            user = self.resolve_user(row)
+            labels = {"guild_id": row["_id"]["guild_id"], "user_id": user["user_id"], "username": user["username"]}
+            self.set(row["total"], **labels)
+
+
+@register
+class SystemActionsCollector(IncrementalCollector):
+    name = "system_actions"
+    documentation = "The number of system actions"
+    labelnames = ["guild_id", "action"]
+    query = "get_system_action_counts"
+
+    def apply(self, rows, context: dict):
+        for row in rows:
+            if row["total"] is None or row["total"] <= 0:
+                continue
+            self.set(row["total"], guild_id=row["_id"]["guild_id"], action=row["_id"]["action"])
+
+
+@register
+class TacoLogsWindowCollector(WindowedCollector):
+    name = "taco_logs_window"
+    documentation = "The number of tacos given in the trailing window"
+    labelnames = ["guild_id", "type", "window"]
+    query = "get_taco_logs_buckets"
+
+    def apply(self, rows, context: dict):
+        for row in rows:
+            labels = {"guild_id": row["_id"]["guild_id"], "type": row["_id"]["type"] or "UNKNOWN"}
+            self.set(row["total"], window=row["_id"]["window"], **labels)
+
+
+@register
+class SystemActionsWindowCollector(WindowedCollector):
+    name = "system_actions_window"
+    documentation = "The number of system actions in the trailing window"
+    labelnames = ["guild_id", "action", "window"]
+    query = "get_system_action_buckets"
@@ -0,0 +1,107 @@
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+from wsgiref.simple_server import make_server, WSGIRequestHandler, WSGIServer
+import gzip
+import hashlib
+import threading
+import time
+import typing
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+
+
+class ExpositionCache:
+    """The /metrics body, rendered once per refresh generation and kept as plain and gzip bytes.
+
+    `invalidate()` is called when a cycle has updated the gauges; the next scrape renders and compresses the
+    exposition once and every scrape after it is served the same bytes. The body is also re-rendered once it
+    is older than `max_age`, so the exporter's own metrics (e.g. the data age) keep moving between cycles.
+    """
+
+    def __init__(self, registry=REGISTRY, max_age: float = 30, refresh: typing.Optional[typing.Callable] = None):
+        self.registry = registry
+        self.max_age = max_age
+        # called before serving, e.g. the scrape mode refresh, which invalidates the cache when it runs
+        self.refresh = refresh
+        self.generation = 0
+        self._rendered = None
+        self._rendered_generation = None
+        self._rendered_at = 0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self.generation += 1
+
+    def get(self) -> typing.Tuple[bytes, bytes, str]:
+        """Return the plain body, the gzip body and the plain body's ETag, rendering them if they are out of date"""
+        if self.refresh is not None:
+            self.refresh()
+        with self._lock:
+            if (
+                self._rendered is None
+                or self._rendered_generation != self.generation
+                or (self.max_age and time.monotonic() - self._rendered_at >= self.max_age)
+            ):
+                generation = self.generation
+                body = generate_latest(self.registry)
+                self._rendered = (body, gzip.compress(body, compresslevel=6), f'"{hashlib.sha1(body).hexdigest()}"')
+                self._rendered_generation = generation
+                self._rendered_at = time.monotonic()
+            return self._rendered
+
+
+def respond(cache: ExpositionCache, query_string: str = "", accept_encoding: str = "", if_none_match: str = ""):
+    """Build the `(status, headers, body)` of a /metrics response, shared by the threaded and asyncio servers"""
+    names = parse_qs(query_string).get("name[]")
+    if names:
+        # filtered scrapes are rare and can't share the cached body
+        body = generate_latest(cache.registry.restricted_registry(names))
+        return "200 OK", [("Content-Type", CONTENT_TYPE_LATEST), ("Content-Length", str(len(body)))], body
+
+    body, compressed, etag = cache.get()
+    headers = [("Content-Type", CONTENT_TYPE_LATEST), ("Vary", "Accept-Encoding")]
+    if "gzip" in accept_encoding:
+        # the gzip bytes are a different representation, so they get their own strong tag
+        etag = etag[:-1] + '-gzip"'
+        headers.append(("Content-Encoding", "gzip"))
+        body = compressed
+    headers.append(("ETag", etag))
+    if etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return "304 Not Modified", headers, b""
+    headers.append(("Content-Length", str(len(body))))
+    return "200 OK", headers, body
+
+
+def make_wsgi_app(cache: ExpositionCache):
+    def app(environ, start_response):
+        if environ.get("PATH_INFO") == "/favicon.ico":
+            start_response("200 OK", [])
+            return [b""]
+
+        status, headers, body = respond(
+            cache,
+            query_string=environ.get("QUERY_STRING", ""),
+            accept_encoding=environ.get("HTTP_ACCEPT_ENCODING", ""),
+            if_none_match=environ.get("HTTP_IF_NONE_MATCH", ""),
+        )
+        start_response(status, headers)
+        return [body]
+
+    return app
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class SilentHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port: int, cache: ExpositionCache, addr: str = "0.0.0.0"):
+    """Serve the cached exposition on a daemon thread, like prometheus_client.start_http_server"""
+    httpd = make_server(addr, port, make_wsgi_app(cache), ThreadingWSGIServer, handler_class=SilentHandler)
+    thread = threading.Thread(target=httpd.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    return httpd, thread
@@ -0,0 +1,141 @@
+import traceback
+import typing
+
+# indexes that keep the exporter's $match and user lookups off collection scans.
+# each entry is (collection, keys), keys in the order pymongo's create_index takes them.
+RECOMMENDED_INDEXES = [
+    ("users", [("guild_id", 1), ("user_id", 1)]),
+    ("first_message", [("timestamp", 1)]),
+    ("live_activity", [("status", 1), ("guild_id", 1), ("platform", 1)]),
+    ("game_keys", [("redeemed_by", 1)]),
+    ("minecraft_users", [("whitelist", 1)]),
+    ("tacos_log", [("timestamp", 1)]),
+    ("system_actions", [("timestamp", 1)]),
+]
+
+
+class PlanReport:
+    def __init__(self, collector: str, collection: str):
+        self.collector = collector
+        self.collection = collection
+        self.stages = []
+        self.indexes = []
+        self.docs_examined = 0
+        self.keys_examined = 0
+        self.returned = 0
+        self.error = None
+
+    @property
+    def collscan(self) -> bool:
+        return "COLLSCAN" in self.stages
+
+    def __str__(self):
+        if self.error:
+            return f"{self.collector:<28} {self.collection:<22} explain failed: {self.error}"
+        plan = "COLLSCAN" if self.collscan else "IXSCAN " + ",".join(self.indexes) if self.indexes else "-"
+        return (
+            f"{self.collector:<28} {self.collection:<22} {plan:<40} "
+            f"{self.docs_examined:>12} {self.keys_examined:>12} {self.returned:>12}"
+        )
+
+
+def explain_collectors(db, collectors) -> typing.List[PlanReport]:
+    """Explain the pipeline every registered collector runs, with executionStats"""
+    reports = []
+    for collector in collectors:
+        try:
+            plan = collector.explain_plan()
+        except Exception as ex:
+            print(f"unable to plan {collector.name}: {ex}")
+            continue
+        if plan is None:
+            continue
+        collection, pipeline = plan[:2]
+        report = PlanReport(collector.name, collection)
+        try:
+            summarize(db.explain(collection, pipeline), report)
+        except Exception as ex:
+            report.error = str(ex)
+        reports.append(report)
+    return reports
+
+
+def summarize(explain: dict, report: PlanReport):
+    # the stats sit at the top level, under a $cursor stage or per shard depending on the server version
+    # and topology, so walk the whole document
+    if isinstance(explain, list):
+        for item in explain:
+            summarize(item, report)
+        return
+    if not isinstance(explain, dict):
+        return
+    if "stage" in explain:
+        report.stages.append(explain["stage"])
+        if explain.get("indexName"):
+            report.indexes.append(explain["indexName"])
+    stats = explain.get("executionStats")
+    if isinstance(stats, dict) and "totalDocsExamined" in stats:
+        report.docs_examined += stats.get("totalDocsExamined", 0)
+        report.keys_examined += stats.get("totalKeysExamined", 0)
+        report.returned += stats.get("nReturned", 0)
+    for key, value in explain.items():
+        if key != "executionStats" or not isinstance(value, dict) or "totalDocsExamined" not in value:
+            summarize(value, report)
+
+
+def missing_indexes(db) -> typing.List[tuple]:
+    missing = []
+    for collection, keys in RECOMMENDED_INDEXES:
+        existing = [index["key"] for index in db.index_information(collection).values()]
+        # an existing index starting with the same keys covers the recommendation
+        if not any(list(index)[: len(keys)] == keys for index in existing):
+            missing.append((collection, keys))
+    return missing
+
+
+def check(db, collectors, create: bool = False) -> bool:
+    """Print the query plan of every collector and the recommended indexes that are missing.
+
+    With `create`, the missing indexes are created. Returns True when every pipeline was explained and no
+    recommended index is missing, or all the missing ones were created. Collection scans are only reported, a
+    $group over a whole collection has to read every document whatever is indexed.
+    """
+    reports = explain_collectors(db, collectors)
+    print(
+        f"{'collector':<28} {'collection':<22} {'plan':<40} "
+        f"{'docs examined':>12} {'keys examined':>12} {'returned':>12}"
+    )
+    for report in reports:
+        print(str(report))
+
+    scans = [report for report in reports if report.collscan]
+    if scans:
+        print(f"{len(scans)} of {len(reports)} pipelines scan their whole collection")
+    failed = [report for report in reports if report.error]
+    if failed:
+        print(f"{len(failed)} of {len(reports)} pipelines could not be explained")
+
+    try:
+        missing = missing_indexes(db)
+    except Exception as ex:
+        print(f"unable to list indexes: {ex}")
+        traceback.print_exc()
+        return False
+
+    uncreated = []
+    for collection, keys in missing:
+        spec = ", ".join(f"{field}: {direction}" for field, direction in keys)
+        if create:
+            print(f"creating index on {collection} {{{spec}}}")
+            try:
+                db.create_index(collection, keys)
+            except Exception as ex:
+                print(f"unable to create index on {collection}: {ex}")
+                traceback.print_exc()
+                uncreated.append((collection, keys))
+        else:
+            print(f"missing recommended index on {collection} {{{spec}}}")
+
+    if uncreated:
+        print(f"{len(uncreated)} of {len(missing)} recommended indexes could not be created")
+    return not failed and not (uncreated if create else missing)
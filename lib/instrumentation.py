@@ -0,0 +1,109 @@
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY
+
+QUERY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CYCLE_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class ExporterMetrics:
+    """Metrics the exporter publishes about itself, under `<namespace>_exporter_`"""
+
+    def __init__(self, namespace: str = "tacobot", registry=REGISTRY):
+        self.subsystem = "exporter"
+
+        self.collector_errors = Counter(
+            namespace=namespace,
+            subsystem=self.subsystem,
+            name="collector_errors",
+            documentation="The number of failed collector queries and updates",
+            labelnames=["collector"],
+            registry=registry,
+        )
+
+        self.collector_circuit_open = Gauge(
+            namespace=namespace,
+            subsystem=self.subsystem,
+            name="collector_circuit_open",
+            documentation="1 while a collector is skipped because it keeps failing",
+            labelnames=["collector"],
+            registry=registry,
+        )
+
+        self.collector_timeouts = Counter(
+            namespace=namespace,
+            subsystem=self.subsystem,
+            name="collector_timeouts",
+            documentation="The number of collector queries abandoned at their timeout or the cycle budget",
+            labelnames=["collector"],
+            registry=registry,
+        )
+
+        self.collector_stale = Gauge(
+            namespace=namespace,
+            subsystem=self.subsystem,
+            name="collector_stale",
+            documentation="1 while a collector exports the values of an earlier cycle because its last run failed",
+            labelnames=["collector"],
+            registry=registry,
+        )
+
+        self.collector_series_dropped = Gauge(
+            namespace=namespace,
+            subsystem=self.subsystem,
+            name="collector_series_dropped",
+            documentation="The number of series the last update folded into `other` to stay within the maxSeries budget",
+            labelnames=["collector"],
+            registry=registry,
+        )
+
+        self.collector_duration = Histogram(
+            namespace=namespace,
+            subsystem=self.subsystem,
+            name="collector_duration_seconds",
+            documentation="The time taken by each collector query, including reading all rows",
+            labelnames=["collector"],
+            buckets=QUERY_BUCKETS,
+            registry=registry,
+        )
+
+        self.collector_rows = Gauge(
+            namespace=namespace,
+            subsystem=self.subsystem,
+            name="collector_rows",
+            documentation="The number of rows returned by the last successful collector query",
+            labelnames=["collector"],
+            registry=registry,
+        )
+
+        self.collector_last_success = Gauge(
+            namespace=namespace,
+            subsystem=self.subsystem,
+            name="collector_last_success_timestamp_seconds",
+            documentation="The unix time a collector last updated its metrics",
+            labelnames=["collector"],
+            registry=registry,
+        )
+
+        self.cycle_duration = Histogram(
+            namespace=namespace,
+            subsystem=self.subsystem,
+            name="cycle_duration_seconds",
+            documentation="The time taken by a full metrics fetch cycle",
+            buckets=CYCLE_BUCKETS,
+            registry=registry,
+        )
+
+        self.cycle_overruns = Counter(
+            namespace=namespace,
+            subsystem=self.subsystem,
+            name="cycle_overruns",
+            documentation="The number of fetch cycles that took longer than the polling interval",
+            registry=registry,
+        )
+
+        self.data_age = Gauge(
+            namespace=namespace,
+            subsystem=self.subsystem,
+            name="data_age_seconds",
+            documentation="Seconds since the exported values were collected, including values restored from a snapshot",
+            registry=registry,
+        )
@@ -0,0 +1,138 @@
+from collections import Counter
+import threading
+import traceback
+import typing
+
+from pymongo.errors import OperationFailure
+
+# server errors meaning change streams can't be used at all: IllegalOperation, CommandNotSupported,
+# unrecognized pipeline stage and $changeStream only supported on replica sets
+UNSUPPORTED_CODES = {20, 115, 40324, 40573}
+
+
+class LiveTracker:
+    """Keeps live_tracked and live_activity counters up to date from mongodb change streams.
+
+    Each collection is watched on its own thread. The stream is opened before the current documents are loaded
+    so nothing written in between is lost, and every event is applied by document id so replaying one is
+    harmless. When change streams are not supported (e.g. a standalone server) the tracker marks itself
+    unavailable and the live collectors keep polling. Any other error, like a failover, closes the stream and
+    it is reopened and resynced after `retry_delay` seconds, with the collectors polling in between.
+    """
+
+    def __init__(self, db, retry_delay: float = 5):
+        self.db = db
+        self.retry_delay = retry_delay
+        self.available = True
+        self._ready = {"live_tracked": False, "live_activity": False}
+        self._lock = threading.Lock()
+        # document id -> counter key, so updates and deletes can take back the previous contribution
+        self._documents = {"live_tracked": {}, "live_activity": {}}
+        self._counts = {"live_tracked": Counter(), "live_activity": Counter()}
+        self._threads = []
+        self._stopped = threading.Event()
+
+    @property
+    def ready(self) -> bool:
+        return self.available and all(self._ready.values())
+
+    def start(self):
+        for collection in self._documents.keys():
+            thread = threading.Thread(target=self._run, args=(collection,), name=f"watch-{collection}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+
+    def live_now_rows(self) -> list:
+        with self._lock:
+            return [{"_id": guild_id, "total": total} for guild_id, total in self._counts["live_tracked"].items()]
+
+    def live_platform_rows(self) -> list:
+        with self._lock:
+            return [
+                {"_id": {"guild_id": guild_id, "platform": platform}, "total": total}
+                for (guild_id, platform), total in self._counts["live_activity"].items()
+            ]
+
+    def _run(self, collection: str):
+        while not self._stopped.is_set() and self.available:
+            stream = None
+            try:
+                stream = self.db.watch(collection, full_document="updateLookup")
+            except Exception as ex:
+                if unsupported(ex):
+                    print(f"change streams are not available for {collection}, live metrics will be polled: {ex}")
+                    self.available = False
+                    return
+                # e.g. a failover or network error, the live collectors poll until the stream is back
+                print(f"unable to watch {collection}, retrying in {self.retry_delay}s: {ex}")
+                self._stopped.wait(self.retry_delay)
+                continue
+
+            try:
+                self._load(collection)
+                self._ready[collection] = True
+                print(f"watching {collection} for changes")
+                for change in stream:
+                    if self._stopped.is_set():
+                        break
+                    self.apply_change(collection, change)
+            except Exception as ex:
+                print(f"change stream for {collection} failed, resyncing in {self.retry_delay}s: {ex}")
+                traceback.print_exc()
+                self._stopped.wait(self.retry_delay)
+            finally:
+                self._ready[collection] = False
+                stream.close()
+
+    def _load(self, collection: str):
+        if collection == "live_tracked":
+            documents = self.db.get_live_tracked()
+        else:
+            documents = self.db.get_live_activity_status()
+        with self._lock:
+            self._documents[collection] = {}
+            self._counts[collection] = Counter()
+            for document in documents:
+                self._set(collection, document["_id"], document)
+
+    def apply_change(self, collection: str, change: dict):
+        """Apply a single change stream event to the counters"""
+        document_id = change["documentKey"]["_id"]
+        with self._lock:
+            if change["operationType"] == "delete":
+                self._set(collection, document_id, None)
+            elif change["operationType"] in ["insert", "replace", "update"]:
+                # the full document is missing when it was deleted before the update could be looked up
+                self._set(collection, document_id, change.get("fullDocument"))
+
+    def _set(self, collection: str, document_id, document: typing.Optional[dict]):
+        previous = self._documents[collection].pop(document_id, None)
+        if previous is not None:
+            self._counts[collection][previous] -= 1
+            if self._counts[collection][previous] <= 0:
+                del self._counts[collection][previous]
+
+        key = self._key(collection, document) if document else None
+        if key is not None:
+            self._documents[collection][document_id] = key
+            self._counts[collection][key] += 1
+
+    def _key(self, collection: str, document: dict):
+        # the change streams see every guild, only count the ones this replica exports
+        if not self.db.owns_guild(document.get("guild_id")):
+            return None
+        if collection == "live_tracked":
+            return document.get("guild_id")
+        if document.get("status") != "ONLINE":
+            return None
+        return (document.get("guild_id"), document.get("platform"))
+
+
+def unsupported(ex: Exception) -> bool:
+    """Whether a watch() error means the server does not support change streams"""
+    if isinstance(ex, NotImplementedError):
+        return True
+    return isinstance(ex, OperationFailure) and ex.code in UNSUPPORTED_CODES
@@ -1,1003 +1,1063 @@
 from pymongo import MongoClient
+from pymongo import read_preferences
+from pymongo.errors import ExecutionTimeout, OperationFailure
+from pymongo.read_concern import ReadConcern
 from bson.objectid import ObjectId
+import contextlib
 import traceback
 import json
 import typing
 import datetime
-import pytz
+import threading
+import time
 import os
 import uuid
 
 # from .mongodb import migration
 
+# user_id and username of the row that leaderboards fold everything below their top N into
+OTHER = "other"
+
+# settings that are passed straight through to the MongoClient
+CLIENT_OPTIONS = [
+    "maxPoolSize",
+    "minPoolSize",
+    "maxIdleTimeMS",
+    "connectTimeoutMS",
+    "serverSelectionTimeoutMS",
+    "socketTimeoutMS",
+    "heartbeatFrequencyMS",
+]
+
+# per collector query settings, set with MongoDatabase.query_options around a fetch
+QUERY_OPTIONS = [
+    "readPreference",
+    "readPreferenceTags",
+    "maxStalenessSeconds",
+    "readConcern",
+    "maxTimeMS",
+    "allowDiskUse",
+]
+
+READ_PREFERENCES = {
+    "primary": read_preferences.Primary,
+    "primarypreferred": read_preferences.PrimaryPreferred,
+    "secondary": read_preferences.Secondary,
+    "secondarypreferred": read_preferences.SecondaryPreferred,
+    "nearest": read_preferences.Nearest,
+}
+
+# collections whose pipelines, when due in the same cycle, are run together as a single $facet
+BATCH_COLLECTIONS = [
+    "tqotd",
+    "wdyctw",
+    "techthurs",
+    "mentalmondays",
+    "taco_tuesday",
+    "game_keys",
+    "tacos",
+    "taco_gifts",
+    "tacos_reactions",
+]
+
+
+# collections without a guild_id, left out of the shard filter and only exported by shard 0
+GLOBAL_COLLECTIONS = ["twitch_user"]
+
+
+class CapturedQuery(Exception):
+    """Raised in place of running a query while MongoDatabase.capture is planning"""
+
+    def __init__(self, collection: str, pipeline: typing.Optional[list] = None):
+        super().__init__(collection)
+        self.collection = collection
+        self.pipeline = pipeline
+
 
 class MongoDatabase:
-    def __init__(self):
+    def __init__(self, settings: typing.Optional[dict] = None):
         self.client = None
         self.connection = None
-        pass
+        self.settings = settings or {}
+        # when persistent, a single pooled client is kept open and shared by every query.
+        # otherwise a client is opened and closed around each query.
+        self.persistent = bool(self.settings.get("persistent", False))
+        self.last_health_check = 0
+        self._lock = threading.Lock()
+        self.batch_collections = self.settings.get("batchCollections", BATCH_COLLECTIONS) or []
+        # batched collections whose $facet the server rejected, e.g. over the 16MB document limit, run unbatched
+        self.unbatched = set()
+        # results of the current cycle's $facet queries, consumed by the first matching _aggregate
+        self._prefetched = {}
+        self._prefetch_lock = threading.Lock()
+        self._local = threading.local()
+        # lib.sharding.GuildSharding, when set every query is limited to this replica's guilds
+        self.sharding = None
+        # lib.rollups.RollupJob, when set the pipelines it has materialized are read from the rollup collection
+        self.rollups = None
 
     def open(self):
         if "MONGODB_URL" not in os.environ or os.environ["MONGODB_URL"] == "":
             raise ValueError("MONGODB_URL is not set")
-        self.client = MongoClient(os.environ["MONGODB_URL"])
-        self.connection = self.client.tacobot
+        with self._lock:
+            if self.client is None:
+                options = {k: self.settings[k] for k in CLIENT_OPTIONS if self.settings.get(k) is not None}
+                self.client = MongoClient(os.environ["MONGODB_URL"], appname="tacobot-exporter", **options)
+                self.connection = self.client.tacobot
 
     def close(self):
         try:
-            if self.client:
-                self.client.close()
+            with self._lock:
+                if self.client:
+                    self.client.close()
+                self.client = None
+                self.connection = None
         except Exception as ex:
             print(ex)
             traceback.print_exc()
 
-    def get_sum_all_tacos(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.tacos.aggregate([{"$group": {"_id": "$guild_id", "total": {"$sum": "$count"}}}])
+    def release(self):
+        # only tear down the client when we are not holding a persistent connection
+        if not self.persistent and self.connection:
+            self.close()
 
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
+    def ensure_connected(self) -> bool:
+        """Ping the server, reconnecting with a fresh client if the ping fails"""
+        interval = self.settings.get("healthCheckInterval", 30)
+        if self.client is not None and time.time() - self.last_health_check < interval:
+            return True
+        for attempt in range(2):
+            try:
+                if self.connection is None:
+                    self.open()
+                self.client.admin.command("ping")
+                self.last_health_check = time.time()
+                return True
+            except Exception as ex:
+                print(f"mongodb health check failed (attempt {attempt + 1}): {ex}")
                 self.close()
+        return False
 
-    def get_sum_all_gift_tacos(self):
+    @contextlib.contextmanager
+    def query_options(self, options: typing.Optional[dict] = None):
+        """Apply read preference, read concern, maxTimeMS and allowDiskUse to the queries made in this block"""
+        previous = getattr(self._local, "options", None)
+        self._local.options = options or {}
         try:
-            if self.connection is None:
-                self.open()
-            return self.connection.taco_gifts.aggregate([{"$group": {"_id": "$guild_id", "total": {"$sum": "$count"}}}])
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
+            yield
         finally:
-            if self.connection:
-                self.close()
+            self._local.options = previous
 
-    def get_sum_all_taco_reactions(self):
+    def capture(self, query: typing.Callable, *args, **kwargs) -> typing.Optional[tuple]:
+        """Call a query method without running it, returning the `(collection, pipeline, options)` it would
+        aggregate"""
+        self._local.capturing = True
         try:
-            if self.connection is None:
-                self.open()
-            return self.connection.tacos_reactions.aggregate([{"$group": {"_id": "$guild_id", "total": {"$sum": 1}}}])
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
+            query(*args, **kwargs)
+        except CapturedQuery as captured:
+            if captured.pipeline is not None:
+                return (captured.collection, captured.pipeline, getattr(self._local, "options", None) or {})
         finally:
-            if self.connection:
-                self.close()
+            self._local.capturing = False
+        return None
 
-    def get_sum_all_twitch_tacos(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.twitch_tacos_gifts.aggregate(
-                [
-                    {"$group": {"_id": "$guild_id", "total": {"$sum": "$count"}}},
-                ]
+    def prefetch(
+        self, plans: typing.Iterable[typing.Optional[tuple]], executor=None, deadline: typing.Optional[float] = None
+    ):
+        """Run the planned pipelines that share a collection as one $facet, so each collection is read once.
+
+        The results are held until the matching `_aggregate` call picks them up. Anything left over from the
+        previous cycle is dropped. If a $facet fails (e.g. its result is over the 16MB document limit) its
+        pipelines simply run on their own. With a `deadline` the server aborts the $facets still running then.
+        """
+        self.clear_prefetched()
+        batches = [
+            (collection, pipeline, keys, deadline_options(options, deadline))
+            for collection, pipeline, keys, options in self.batch(plans)
+            if len(keys) > 1
+        ]
+        if executor is None:
+            for batch in batches:
+                self._run_facet(*batch)
+        else:
+            list(executor.map(lambda batch: self._run_facet(*batch), batches))
+
+    def batch(self, plans: typing.Iterable[typing.Optional[tuple]], single: bool = False) -> typing.List[tuple]:
+        """Group planned `(collection, pipeline, options)`s into `(collection, pipeline, keys, options)` queries.
+
+        Pipelines on a batched collection with the same query options are merged into one $facet query
+        carrying every pipeline's key. With `single`, the remaining pipelines are returned as queries of their own.
+        """
+        by_collection = {}
+        singles = {}
+        for plan in plans:
+            if plan is None:
+                continue
+            collection, pipeline, options = plan
+            if self.rollups is not None and self.rollups.covers(collection, pipeline):
+                # already a handful of pre-aggregated documents
+                continue
+            if collection in self.batch_collections and collection not in self.unbatched:
+                group = by_collection.setdefault((collection, json.dumps(options, sort_keys=True)), (options, {}))
+                group[1][pipeline_key(collection, pipeline)] = pipeline
+            else:
+                singles[pipeline_key(collection, pipeline)] = (collection, pipeline, options)
+
+        queries = []
+        for (collection, _), (options, pipelines) in by_collection.items():
+            if len(pipelines) > 1:
+                facets = {f"q{i}": pipeline for i, pipeline in enumerate(pipelines.values())}
+                queries.append((collection, facet_pipeline(facets), list(pipelines.keys()), options))
+            elif single:
+                key, pipeline = next(iter(pipelines.items()))
+                queries.append((collection, pipeline, [key], options))
+        if single:
+            queries.extend(
+                (collection, pipeline, [key], options) for key, (collection, pipeline, options) in singles.items()
             )
+        return queries
 
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+    def provide(self, keys: typing.List[str], rows: list):
+        """Hold the rows of a query from `batch` for the `_aggregate` calls it answers"""
+        with self._prefetch_lock:
+            if len(keys) == 1:
+                self._prefetched[keys[0]] = rows
+                return
+            for i, key in enumerate(keys):
+                self._prefetched[key] = rows[0][f"q{i}"] if rows else []
 
-    def get_live_now_count(self):
+    def prefetched(self, plan: typing.Optional[tuple]) -> bool:
+        """Whether the rows of a planned `(collection, pipeline, options)` are held from a prefetch"""
+        if plan is None:
+            return False
+        with self._prefetch_lock:
+            return pipeline_key(plan[0], plan[1]) in self._prefetched
+
+    def clear_prefetched(self):
+        with self._prefetch_lock:
+            self._prefetched = {}
+
+    def _run_facet(self, collection: str, pipeline: list, keys: typing.List[str], options: dict):
         try:
-            if self.connection is None:
-                self.open()
-            return self.connection.live_tracked.aggregate([{"$group": {"_id": "$guild_id", "total": {"$sum": 1}}}])
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+            with self.query_options(options):
+                rows = list(self._aggregate(collection, pipeline))
+        except ExecutionTimeout:
+            print(f"{collection} $facet timed out, its {len(keys)} queries will run on their own")
+            return
+        except OperationFailure as ex:
+            # the server will reject it again next cycle, stop paying for the failed scan
+            print(f"{collection} $facet failed, its queries will run on their own from now on: {ex}")
+            self.unbatched.add(collection)
+            return
+        except Exception:
+            print(f"{collection} $facet failed, its {len(keys)} queries will run on their own")
+            return
+        self.provide(keys, rows)
 
-    def get_twitch_channel_bot_count(self):
+    def _aggregate(self, collection: str, pipeline: list):
+        if getattr(self._local, "capturing", False):
+            raise CapturedQuery(collection, pipeline)
+        if self._prefetched:
+            with self._prefetch_lock:
+                rows = self._prefetched.pop(pipeline_key(collection, pipeline), None)
+            if rows is not None:
+                return rows
+        if self.rollups is not None:
+            rows = self.rollups.read(collection, pipeline)
+            if rows is not None:
+                return rows
         try:
+            pipeline = self.shard_pipeline(collection, pipeline)
             if self.connection is None:
                 self.open()
-            return self.connection.twitch_channels.aggregate(
-                [
-                    {"$group": {"_id": "$guild_id", "total": {"$sum": 1}}},
-                ]
-            )
+            options = self._options()
+            return self._collection(collection, options).aggregate(pipeline, **aggregate_options(options))
         except Exception as ex:
-            print(ex)
-            traceback.print_exc()
+            # let the caller decide how to handle the failure, the collectors retry and track errors
+            print(f"{collection} query failed: {ex}")
+            raise
         finally:
-            if self.connection:
-                self.close()
+            self.release()
 
-    def get_twitch_linked_accounts_count(self):
+    def _find(
+        self,
+        collection: str,
+        filter: typing.Optional[dict] = None,
+        projection: typing.Optional[dict] = None,
+        sharded: bool = True,
+    ):
+        if getattr(self._local, "capturing", False):
+            raise CapturedQuery(collection)
         try:
+            if sharded:
+                filter = self._shard_filter(collection, filter)
             if self.connection is None:
                 self.open()
-            return self.connection.twitch_user.count()
+            options = self._options()
+            cursor = self._collection(collection, options).find(filter or {}, projection)
+            if options.get("maxTimeMS"):
+                cursor = cursor.max_time_ms(int(options["maxTimeMS"]))
+            return cursor
         except Exception as ex:
-            print(ex)
-            traceback.print_exc()
+            print(f"{collection} query failed: {ex}")
+            raise
         finally:
-            if self.connection:
-                self.close()
+            self.release()
 
-    def get_tqotd_questions_count(self):
+    def _options(self) -> dict:
+        return getattr(self._local, "options", None) or {}
+
+    def _collection(self, collection: str, options: dict):
+        kwargs = collection_options(options)
+        if not kwargs:
+            return self.connection[collection]
+        return self.connection[collection].with_options(**kwargs)
+
+    def watch(self, collection: str, **kwargs):
+        # change streams need a long lived client, so this is only used in persistent mode
+        if self.connection is None:
+            self.open()
+        return self.connection[collection].watch(**kwargs)
+
+    def owns_guild(self, guild_id) -> bool:
+        return self.sharding is None or self.sharding.includes(guild_id)
+
+    def shard_pipeline(self, collection: str, pipeline: list) -> list:
+        if self.sharding is None or collection in GLOBAL_COLLECTIONS:
+            return pipeline
+        return [{"$match": self.sharding.filter()}] + pipeline
+
+    def _shard_filter(self, collection: str, filter: typing.Optional[dict]) -> typing.Optional[dict]:
+        if self.sharding is None or collection in GLOBAL_COLLECTIONS:
+            return filter
+        if not filter:
+            return self.sharding.filter()
+        return {"$and": [filter, self.sharding.filter()]}
+
+    def explain(self, collection: str, pipeline: list) -> dict:
         try:
             if self.connection is None:
                 self.open()
-            return self.connection.tqotd.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": "$guild_id",
-                            "total": {"$sum": 1},
-                        },
-                    },
-                ]
+            return self.connection.command(
+                "explain",
+                {"aggregate": collection, "pipeline": self.shard_pipeline(collection, pipeline), "cursor": {}},
+                verbosity="executionStats",
             )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
         finally:
-            if self.connection:
-                self.close()
+            self.release()
 
-    def get_tqotd_answers_count(self):
+    def index_information(self, collection: str) -> dict:
         try:
             if self.connection is None:
                 self.open()
-            return self.connection.tqotd.aggregate(
-                [
-                    {"$group": {"_id": "$guild_id", "total": {"$sum": {"$size": "$answered"}}}},
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
+            return self.connection[collection].index_information()
         finally:
-            if self.connection:
-                self.close()
+            self.release()
 
-    def get_invited_users_count(self):
+    def create_index(self, collection: str, keys: list):
         try:
             if self.connection is None:
                 self.open()
-            return self.connection.invite_codes.aggregate(
-                [
-                    {"$group": {"_id": "$guild_id", "total": {"$sum": {"$size": {"$ifNull": ["$invites", []]}}}}},
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
+            return self.connection[collection].create_index(keys)
         finally:
-            if self.connection:
-                self.close()
+            self.release()
 
-    def get_sum_live_by_platform(self):
+    def _count(self, collection: str, filter: typing.Optional[dict] = None):
+        if getattr(self._local, "capturing", False):
+            raise CapturedQuery(collection)
         try:
+            filter = self._shard_filter(collection, filter)
             if self.connection is None:
                 self.open()
-            return self.connection.live_activity.aggregate(
-                [
-                    {"$match": {"status": {"$eq": "ONLINE"}}},
-                    {"$group": {"_id": {"platform": "$platform", "guild_id": "$guild_id"}, "total": {"$sum": 1}}},
-                ]
-            )
+            options = self._options()
+            kwargs = {"maxTimeMS": int(options["maxTimeMS"])} if options.get("maxTimeMS") else {}
+            return self._collection(collection, options).count_documents(filter or {}, **kwargs)
         except Exception as ex:
-            print(ex)
-            traceback.print_exc()
+            print(f"{collection} query failed: {ex}")
+            raise
         finally:
-            if self.connection:
-                self.close()
+            self.release()
+
+    def get_sum_all_tacos(self):
+        return self._aggregate("tacos", [{"$group": {"_id": "$guild_id", "total": {"$sum": "$count"}}}])
+
+    def get_sum_all_gift_tacos(self):
+        return self._aggregate("taco_gifts", [{"$group": {"_id": "$guild_id", "total": {"$sum": "$count"}}}])
+
+    def get_sum_all_taco_reactions(self):
+        return self._aggregate("tacos_reactions", [{"$group": {"_id": "$guild_id", "total": {"$sum": 1}}}])
+
+    def get_sum_all_twitch_tacos(self):
+        return self._aggregate(
+            "twitch_tacos_gifts",
+            [
+                {"$group": {"_id": "$guild_id", "total": {"$sum": "$count"}}},
+            ]
+        )
+
+    def get_live_now_count(self):
+        return self._aggregate("live_tracked", [{"$group": {"_id": "$guild_id", "total": {"$sum": 1}}}])
+
+    def get_twitch_channel_bot_count(self):
+        return self._aggregate(
+            "twitch_channels",
+            [
+                {"$group": {"_id": "$guild_id", "total": {"$sum": 1}}},
+            ]
+        )
+
+    def get_twitch_linked_accounts_count(self):
+        return self._count("twitch_user")
+
+    def get_tqotd_questions_count(self):
+        return self._aggregate(
+            "tqotd",
+            [
+                {
+                    "$group": {
+                        "_id": "$guild_id",
+                        "total": {"$sum": 1},
+                    },
+                },
+            ]
+        )
+
+    def get_tqotd_answers_count(self):
+        return self._aggregate(
+            "tqotd",
+            [
+                {"$group": {"_id": "$guild_id", "total": {"$sum": {"$size": "$answered"}}}},
+            ]
+        )
+
+    def get_invited_users_count(self):
+        return self._aggregate(
+            "invite_codes",
+            [
+                {"$group": {"_id": "$guild_id", "total": {"$sum": {"$size": {"$ifNull": ["$invites", []]}}}}},
+            ]
+        )
+
+    def get_live_tracked(self):
+        return self._find("live_tracked", projection={"guild_id": 1})
+
+    def get_live_activity_status(self):
+        return self._find("live_activity", projection={"guild_id": 1, "platform": 1, "status": 1})
+
+    def get_sum_live_by_platform(self):
+        return self._aggregate(
+            "live_activity",
+            [
+                {"$match": {"status": {"$eq": "ONLINE"}}},
+                {"$group": {"_id": {"platform": "$platform", "guild_id": "$guild_id"}, "total": {"$sum": 1}}},
+            ]
+        )
 
     def get_wdyctw_questions_count(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.wdyctw.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": "$guild_id",
-                            "total": {"$sum": 1},
-                        },
+        return self._aggregate(
+            "wdyctw",
+            [
+                {
+                    "$group": {
+                        "_id": "$guild_id",
+                        "total": {"$sum": 1},
                     },
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+                },
+            ]
+        )
 
     def get_wdyctw_answers_count(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.wdyctw.aggregate(
-                [
-                    {"$group": {"_id": "$guild_id", "total": {"$sum": {"$size": "$answered"}}}},
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+        return self._aggregate(
+            "wdyctw",
+            [
+                {"$group": {"_id": "$guild_id", "total": {"$sum": {"$size": "$answered"}}}},
+            ]
+        )
 
     def get_techthurs_questions_count(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.techthurs.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": "$guild_id",
-                            "total": {"$sum": 1},
-                        },
+        return self._aggregate(
+            "techthurs",
+            [
+                {
+                    "$group": {
+                        "_id": "$guild_id",
+                        "total": {"$sum": 1},
                     },
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+                },
+            ]
+        )
 
     def get_techthurs_answers_count(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.techthurs.aggregate(
-                [
-                    {"$group": {"_id": "$guild_id", "total": {"$sum": {"$size": "$answered"}}}},
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+        return self._aggregate(
+            "techthurs",
+            [
+                {"$group": {"_id": "$guild_id", "total": {"$sum": {"$size": "$answered"}}}},
+            ]
+        )
 
     def get_mentalmondays_questions_count(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.mentalmondays.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": "$guild_id",
-                            "total": {"$sum": 1},
-                        },
+        return self._aggregate(
+            "mentalmondays",
+            [
+                {
+                    "$group": {
+                        "_id": "$guild_id",
+                        "total": {"$sum": 1},
                     },
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+                },
+            ]
+        )
 
     def get_mentalmondays_answers_count(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.mentalmondays.aggregate(
-                [
-                    {"$group": {"_id": "$guild_id", "total": {"$sum": {"$size": "$answered"}}}},
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+        return self._aggregate(
+            "mentalmondays",
+            [
+                {"$group": {"_id": "$guild_id", "total": {"$sum": {"$size": "$answered"}}}},
+            ]
+        )
 
     def get_tacotuesday_questions_count(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.taco_tuesday.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": "$guild_id",
-                            "total": {"$sum": 1},
-                        },
+        return self._aggregate(
+            "taco_tuesday",
+            [
+                {
+                    "$group": {
+                        "_id": "$guild_id",
+                        "total": {"$sum": 1},
                     },
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+                },
+            ]
+        )
 
     def get_tacotuesday_answers_count(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.taco_tuesday.aggregate(
-                [
-                    {"$group": {"_id": "$guild_id", "total": {"$sum": {"$size": "$answered"}}}},
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+        return self._aggregate(
+            "taco_tuesday",
+            [
+                {"$group": {"_id": "$guild_id", "total": {"$sum": {"$size": "$answered"}}}},
+            ]
+        )
 
     # need to update data here to include guild_id
     def get_game_keys_available_count(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.game_keys.aggregate(
-                [{"$match": {"redeemed_by": {"$eq": None}}}, {"$group": {"_id": "$guild_id", "total": {"$sum": 1}}}]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+        return self._aggregate(
+            "game_keys",
+            [{"$match": {"redeemed_by": {"$eq": None}}}, {"$group": {"_id": "$guild_id", "total": {"$sum": 1}}}]
+        )
 
     # need to update data here to include guild_id
     def get_game_keys_redeemed_count(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.game_keys.aggregate(
-                [{"$match": {"redeemed_by": {"$ne": None}}}, {"$group": {"_id": "$guild_id", "total": {"$sum": 1}}}]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+        return self._aggregate(
+            "game_keys",
+            [{"$match": {"redeemed_by": {"$ne": None}}}, {"$group": {"_id": "$guild_id", "total": {"$sum": 1}}}]
+        )
 
     # need to update data here to include guild_id
     def get_minecraft_whitelisted_count(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.minecraft_users.aggregate(
-                [{"$match": {"whitelist": {"$eq": True}}}, {"$group": {"_id": "$guild_id", "total": {"$sum": 1}}}]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+        return self._aggregate(
+            "minecraft_users",
+            [{"$match": {"whitelist": {"$eq": True}}}, {"$group": {"_id": "$guild_id", "total": {"$sum": 1}}}]
+        )
 
-    def get_logs(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.logs.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": {
-                                # if guild_id is None, then set it to 0
-                                "guild_id": { "$ifNull": ["$guild_id", 0] },
-                                "level": "$level",
-                            },
-                            "total": {"$sum": 1},
+    def get_logs(self, after: typing.Optional[ObjectId] = None, until: typing.Optional[ObjectId] = None):
+        return self._aggregate(
+            "logs",
+            id_range(after, until) + [
+                {
+                    "$group": {
+                        "_id": {
+                            # if guild_id is None, then set it to 0
+                            "guild_id": { "$ifNull": ["$guild_id", 0] },
+                            "level": "$level",
                         },
+                        "total": {"$sum": 1},
                     },
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+                },
+            ]
+        )
 
     def get_team_requests_count(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.stream_team_requests.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": "$guild_id",
-                            "total": {"$sum": 1},
-                        },
+        return self._aggregate(
+            "stream_team_requests",
+            [
+                {
+                    "$group": {
+                        "_id": "$guild_id",
+                        "total": {"$sum": 1},
                     },
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+                },
+            ]
+        )
 
     def get_birthdays_count(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.birthdays.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": "$guild_id",
-                            "total": {"$sum": 1},
-                        },
+        return self._aggregate(
+            "birthdays",
+            [
+                {
+                    "$group": {
+                        "_id": "$guild_id",
+                        "total": {"$sum": 1},
                     },
-                ]
-            )
-
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+                },
+            ]
+        )
 
-    def get_first_messages_today_count(self):
-        try:
-            if self.connection is None:
-                self.open()
-            # get UTC time for midnight today
-            utc_today = datetime.datetime.combine(datetime.datetime.utcnow().today(), datetime.datetime.min.time())
-            # convert utc_today to unix timestamp
-            utc_today_ts = int((utc_today - datetime.datetime(1970, 1, 1)).total_seconds())
-
-            return self.connection.first_message.aggregate(
-                [
-                    {"$match": {"timestamp": {"$gte": utc_today_ts}}},
-                    {
-                        "$group": {
-                            "_id": "$guild_id",
-                            "total": {"$sum": 1},
+    def get_first_message_buckets(self, after: float, until: float, bucket_seconds: int):
+        # first messages per guild in `bucket_seconds` wide buckets of the timestamp, for (after, until]
+        return self._aggregate(
+            "first_message",
+            [
+                {"$match": {"timestamp": {"$gt": after, "$lte": until}}},
+                {
+                    "$group": {
+                        "_id": {
+                            "guild_id": "$guild_id",
+                            "bucket": {"$floor": {"$divide": ["$timestamp", bucket_seconds]}},
                         },
-                    },
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+                        "total": {"$sum": 1},
+                    }
+                },
+            ]
+        )
 
     def get_messages_tracked_count(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.messages.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": "$guild_id",
-                            "total": {"$sum": {"$size": "$messages"}},
-                        },
+        return self._aggregate(
+            "messages",
+            [
+                {
+                    "$group": {
+                        "_id": "$guild_id",
+                        "total": {"$sum": {"$size": "$messages"}},
                     },
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+                },
+            ]
+        )
 
-    def get_user_messages_tracked(self):
-        try:
-            if self.connection is None:
-                self.open()
-            # get the top limit messages from users.
-            # join the users collection to get the username
-            # sort by count descending
+    def get_user_messages_tracked(self, limit: int = 0, other: bool = False, exclude: typing.Optional[list] = None):
+        # get the top limit messages from users.
+        # usernames are resolved by the exporter's user directory
+        # sort by count descending
 
-            return self.connection.messages.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": {
-                                "guild_id": "$guild_id",
-                                "user_id": "$user_id",
-                            },
-                            "total": {"$sum": {"$size": "$messages"}},
+        return self._aggregate(
+            "messages",
+            exclude_users("user_id", exclude)
+            + [
+                {
+                    "$group": {
+                        "_id": {
+                            "guild_id": "$guild_id",
+                            "user_id": "$user_id",
                         },
+                        "total": {"$sum": {"$size": "$messages"}},
                     },
-                    {
-                        "$lookup": {
-                            "from": "users",
-                            "let": {"user_id": "$_id.user_id", "guild_id": "$_id.guild_id"},
-                            "pipeline": [
-                                {"$match": {"$expr": {"$eq": ["$user_id", "$$user_id"]}}},
-                                {"$match": {"$expr": {"$eq": ["$guild_id", "$$guild_id"]}}},
-                            ],
-                            "as": "user",
-                        }
-                    },
-                    {"$match": {"user.bot": {"$ne": True}, "user.system": {"$ne": True}, "user": {"$ne": []}}},
-                    {"$sort": {"total": -1}},
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+                },
+            ]
+            + top_n(limit, other)
+            + [
+                {"$sort": {"total": -1}},
+            ]
+        )
+
+    def get_users(
+        self,
+        after_id: typing.Optional[ObjectId] = None,
+        updated_after: typing.Optional[float] = None,
+        updated_field: str = "timestamp",
+    ):
+        # every user, or only those inserted after `after_id` or updated after `updated_after`
+        clauses = []
+        if after_id is not None:
+            clauses.append({"_id": {"$gt": after_id}})
+        if updated_after is not None:
+            clauses.append({updated_field: {"$gt": updated_after}})
+        return self._find(
+            "users",
+            {"$or": clauses} if clauses else {},
+            projection={"guild_id": 1, "user_id": 1, "username": 1, "bot": 1, "system": 1, updated_field: 1},
+        )
+
+    def get_users_by_id(self, keys: typing.List[tuple]):
+        # keys are (guild_id, user_id) pairs
+        by_guild = {}
+        for guild_id, user_id in keys:
+            by_guild.setdefault(guild_id, []).append(user_id)
+        return self._find(
+            "users",
+            {"$or": [{"guild_id": guild_id, "user_id": {"$in": user_ids}} for guild_id, user_ids in by_guild.items()]},
+            projection={"guild_id": 1, "user_id": 1, "username": 1, "bot": 1, "system": 1},
+        )
 
     def get_known_users(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.users.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": {
-                                "guild_id": "$guild_id",
-                                # if bot is true, then type is bot.
-                                # if system is true, then type is system.
-                                # else type is user
-                                "type": {
-                                    "$cond": [
-                                        {"$eq": ["$bot", True]},
-                                        "bot",
-                                        {"$cond": [{"$eq": ["$system", True]}, "system", "user"]},
-                                    ]
-                                },
+        return self._aggregate(
+            "users",
+            [
+                {
+                    "$group": {
+                        "_id": {
+                            "guild_id": "$guild_id",
+                            # if bot is true, then type is bot.
+                            # if system is true, then type is system.
+                            # else type is user
+                            "type": {
+                                "$cond": [
+                                    {"$eq": ["$bot", True]},
+                                    "bot",
+                                    {"$cond": [{"$eq": ["$system", True]}, "system", "user"]},
+                                ]
                             },
-                            "total": {"$sum": 1},
                         },
+                        "total": {"$sum": 1},
                     },
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+                },
+            ]
+        )
 
-    def get_top_taco_gifters(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.taco_gifts.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": {
-                                "user_id": "$user_id",
-                                "guild_id": "$guild_id",
-                            },
-                            "total": {"$sum": "$count"},
-                        }
-                    },
-                    {
-                        "$lookup": {
-                            "from": "users",
-                            "let": {"user_id": "$_id.user_id", "guild_id": "$_id.guild_id"},
-                            "pipeline": [
-                                {"$match": {"$expr": {"$eq": ["$user_id", "$$user_id"]}}},
-                                {"$match": {"$expr": {"$eq": ["$guild_id", "$$guild_id"]}}},
-                            ],
-                            "as": "user",
-                        }
-                    },
-                    {"$match": {"user.bot": {"$ne": True}, "user.system": {"$ne": True}, "user": {"$ne": []}}},
-                    {"$sort": {"total": -1}},
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+    def get_top_taco_gifters(self, limit: int = 0, other: bool = False, exclude: typing.Optional[list] = None):
+        return self._aggregate(
+            "taco_gifts",
+            exclude_users("user_id", exclude)
+            + [
+                {
+                    "$group": {
+                        "_id": {
+                            "user_id": "$user_id",
+                            "guild_id": "$guild_id",
+                        },
+                        "total": {"$sum": "$count"},
+                    }
+                },
+            ]
+            + top_n(limit, other)
+            + [
+                {"$sort": {"total": -1}},
+            ]
+        )
 
-    def get_top_taco_reactors(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.tacos_reactions.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": {
-                                "user_id": "$user_id",
-                                "guild_id": "$guild_id",
-                            },
-                            "total": {"$sum": 1},
-                        }
-                    },
-                    {
-                        "$lookup": {
-                            "from": "users",
-                            "let": {"user_id": "$_id.user_id", "guild_id": "$_id.guild_id"},
-                            "pipeline": [
-                                {"$match": {"$expr": {"$eq": ["$user_id", "$$user_id"]}}},
-                                {"$match": {"$expr": {"$eq": ["$guild_id", "$$guild_id"]}}},
-                            ],
-                            "as": "user",
-                        }
-                    },
-                    {"$match": {"user.bot": {"$ne": True}, "user.system": {"$ne": True}, "user": {"$ne": []}}},
-                    {"$sort": {"total": -1}},
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+    def get_top_taco_reactors(self, limit: int = 0, other: bool = False, exclude: typing.Optional[list] = None):
+        return self._aggregate(
+            "tacos_reactions",
+            exclude_users("user_id", exclude)
+            + [
+                {
+                    "$group": {
+                        "_id": {
+                            "user_id": "$user_id",
+                            "guild_id": "$guild_id",
+                        },
+                        "total": {"$sum": 1},
+                    }
+                },
+            ]
+            + top_n(limit, other)
+            + [
+                {"$sort": {"total": -1}},
+            ]
+        )
 
-    def get_top_taco_receivers(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.tacos.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": {
-                                "user_id": "$user_id",
-                                "guild_id": "$guild_id",
-                            },
-                            "total": {"$sum": "$count"},
-                        }
-                    },
-                    {
-                        "$lookup": {
-                            "from": "users",
-                            "let": {"user_id": "$_id.user_id", "guild_id": "$_id.guild_id"},
-                            "pipeline": [
-                                {"$match": {"$expr": {"$eq": ["$user_id", "$$user_id"]}}},
-                                {"$match": {"$expr": {"$eq": ["$guild_id", "$$guild_id"]}}},
-                            ],
-                            "as": "user",
-                        }
-                    },
-                    {"$match": {"user.bot": {"$ne": True}, "user.system": {"$ne": True}, "user": {"$ne": []}}},
-                    {"$sort": {"total": -1}},
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+    def get_top_taco_receivers(self, limit: int = 0, other: bool = False, exclude: typing.Optional[list] = None):
+        return self._aggregate(
+            "tacos",
+            exclude_users("user_id", exclude)
+            + [
+                {
+                    "$group": {
+                        "_id": {
+                            "user_id": "$user_id",
+                            "guild_id": "$guild_id",
+                        },
+                        "total": {"$sum": "$count"},
+                    }
+                },
+            ]
+            + top_n(limit, other)
+            + [
+                {"$sort": {"total": -1}},
+            ]
+        )
 
-    def get_live_activity(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.live_activity.aggregate(
-                [
-                    {"$match": {"status": "ONLINE"}},
-                    {
-                        "$group": {
-                            "_id": {
-                                "user_id": "$user_id",
-                                "guild_id": "$guild_id",
-                                "platform": "$platform",
-                            },
-                            "total": {"$sum": 1},
-                        }
-                    },
-                    {
-                        "$lookup": {
-                            "from": "users",
-                            "let": {"user_id": "$_id.user_id", "guild_id": "$_id.guild_id"},
-                            "pipeline": [
-                                {"$match": {"$expr": {"$eq": ["$user_id", "$$user_id"]}}},
-                                {"$match": {"$expr": {"$eq": ["$guild_id", "$$guild_id"]}}},
-                            ],
-                            "as": "user",
-                        }
-                    },
-                    {"$match": {"user.bot": {"$ne": True}, "user.system": {"$ne": True}, "user": {"$ne": []}}},
-                    {"$sort": {"total": -1}},
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+    def get_live_activity(self, exclude: typing.Optional[list] = None):
+        return self._aggregate(
+            "live_activity",
+            exclude_users("user_id", exclude)
+            + [
+                {"$match": {"status": "ONLINE"}},
+                {
+                    "$group": {
+                        "_id": {
+                            "user_id": "$user_id",
+                            "guild_id": "$guild_id",
+                            "platform": "$platform",
+                        },
+                        "total": {"$sum": 1},
+                    }
+                },
+                {"$sort": {"total": -1}},
+            ]
+        )
 
     def get_suggestions(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.suggestions.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": {
-                                "guild_id": "$guild_id",
-                                "state": "$state",
-                            },
-                            "total": {"$sum": 1},
+        return self._aggregate(
+            "suggestions",
+            [
+                {
+                    "$group": {
+                        "_id": {
+                            "guild_id": "$guild_id",
+                            "state": "$state",
                         },
+                        "total": {"$sum": 1},
                     },
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+                },
+            ]
+        )
 
     def get_user_join_leave(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.user_join_leave.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": {
-                                "guild_id": "$guild_id",
-                                "action": "$action",
-                            },
-                            "total": {"$sum": 1},
+        return self._aggregate(
+            "user_join_leave",
+            [
+                {
+                    "$group": {
+                        "_id": {
+                            "guild_id": "$guild_id",
+                            "action": "$action",
                         },
+                        "total": {"$sum": 1},
                     },
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+                },
+            ]
+        )
 
-    def get_food_posts_count(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.food_posts.aggregate(
-                [
-                    {"$group": {"_id": {"user_id": "$user_id", "guild_id": "$guild_id"}, "total": {"$sum": 1}}},
+    def get_food_posts_count(self, limit: int = 0, other: bool = False, exclude: typing.Optional[list] = None):
+        return self._aggregate(
+            "food_posts",
+            exclude_users("user_id", exclude)
+            + [
+                {"$group": {"_id": {"user_id": "$user_id", "guild_id": "$guild_id"}, "total": {"$sum": 1}}},
+            ]
+            + top_n(limit, other)
+            + [
+                {"$sort": {"total": -1}},
+            ]
+        )
+
+    def get_taco_logs_counts(
+        self, after: typing.Optional[ObjectId] = None, until: typing.Optional[ObjectId] = None
+    ):
+        # this is the log entry docuemnt
+        # {
+        #     _id: ObjectId('64823bc04b3af18f34e7e2ec'),
+        #     guild_id: '942532970613473293',
+        #     from_user_id: '592430549277343746',
+        #     to_user_id: '262031734260891648',
+        #     count: 1,
+        #     type: 'REACT_REWARD',
+        #     reason: 'reacting to darthminos\'s message with a 🌮',
+        #     timestamp: 1686256576.813649
+        # }
+
+        # aggregate all tacos_log entries for a guild, grouped by type, and sum the count
+        logs = self._aggregate(
+            "tacos_log",
+            id_range(after, until) + [
+                {"$group": {"_id": {"type": "$type", "guild_id": "$guild_id"}, "total": {"$sum": "$count"}}},
+                # "guild_id": "$guild_id",
+                {"$sort": {"total": -1}},
+            ]
+        )
+        return logs
+
+    def get_system_action_counts(
+        self, after: typing.Optional[ObjectId] = None, until: typing.Optional[ObjectId] = None
+    ):
+        return self._aggregate(
+            "system_actions",
+            id_range(after, until) + [
+                {"$group": {"_id": {"action": "$action", "guild_id": "$guild_id"}, "total": {"$sum": 1}}},
+                {"$sort": {"total": -1}},
+            ]
+        )
+
+    def get_taco_logs_buckets(self, after: float, until: float, bucket_seconds: int):
+        # taco counts per guild and type in `bucket_seconds` wide buckets of the timestamp, for (after, until]
+        return self._aggregate(
+            "tacos_log",
+            [
+                {"$match": {"timestamp": {"$gt": after, "$lte": until}}},
+                {
+                    "$group": {
+                        "_id": {
+                            "guild_id": "$guild_id",
+                            "type": "$type",
+                            "bucket": {"$floor": {"$divide": ["$timestamp", bucket_seconds]}},
+                        },
+                        "total": {"$sum": "$count"},
+                    }
+                },
+            ]
+        )
+
+    def get_system_action_buckets(self, after: float, until: float, bucket_seconds: int):
+        return self._aggregate(
+            "system_actions",
+            [
+                {"$match": {"timestamp": {"$gt": after, "$lte": until}}},
+                {
+                    "$group": {
+                        "_id": {
+                            "guild_id": "$guild_id",
+                            "action": "$action",
+                            "bucket": {"$floor": {"$divide": ["$timestamp", bucket_seconds]}},
+                        },
+                        "total": {"$sum": 1},
+                    }
+                },
+            ]
+        )
+
+    def get_guilds(self):
+        return self._find("guilds")
+
+    def merge_rollup(self, collection: str, pipeline: list, into: str, metric: str, shard: int, run: str):
+        # each result row is kept whole under `row`, keyed by the metric, the shard and the row's _id
+        return list(
+            self._aggregate(
+                collection,
+                pipeline
+                + [
                     {
-                        "$lookup": {
-                            "from": "users",
-                            "let": {"user_id": "$_id.user_id", "guild_id": "$_id.guild_id"},
-                            "pipeline": [
-                                {"$match": {"$expr": {"$eq": ["$user_id", "$$user_id"]}}},
-                                {"$match": {"$expr": {"$eq": ["$guild_id", "$$guild_id"]}}},
-                            ],
-                            "as": "user",
+                        "$project": {
+                            "_id": {"metric": {"$literal": metric}, "shard": {"$literal": shard}, "key": "$_id"},
+                            "metric": {"$literal": metric},
+                            "shard": {"$literal": shard},
+                            "run": {"$literal": run},
+                            "row": "$$ROOT",
                         }
                     },
-                    {"$match": {"user.bot": {"$ne": True}, "user.system": {"$ne": True}, "user": {"$ne": []}}},
-                    {"$sort": {"total": -1}},
-                ]
+                    {"$merge": {"into": into, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}},
+                ],
             )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+        )
 
-    def get_taco_logs_counts(self):
+    def delete_stale_rollups(self, into: str, metric: str, shard: int, run: str):
         try:
             if self.connection is None:
                 self.open()
-
-            # this is the log entry docuemnt
-            # {
-            #     _id: ObjectId('64823bc04b3af18f34e7e2ec'),
-            #     guild_id: '942532970613473293',
-            #     from_user_id: '592430549277343746',
-            #     to_user_id: '262031734260891648',
-            #     count: 1,
-            #     type: 'REACT_REWARD',
-            #     reason: 'reacting to darthminos\'s message with a 🌮',
-            #     timestamp: 1686256576.813649
-            # }
-
-            # aggregate all tacos_log entries for a guild, grouped by type, and sum the count
-            logs = self.connection.tacos_log.aggregate(
-                [
-                    {"$group": {"_id": {"type": "$type", "guild_id": "$guild_id"}, "total": {"$sum": "$count"}}},
-                    # "guild_id": "$guild_id",
-                    {"$sort": {"total": -1}},
-                ]
-            )
-            return logs
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
+            return self.connection[into].delete_many({"metric": metric, "shard": shard, "run": {"$ne": run}})
         finally:
-            if self.connection:
-                self.close()
+            self.release()
 
-    def get_system_action_counts(self):
+    def ensure_rollup_index(self, into: str):
         try:
             if self.connection is None:
                 self.open()
-            return self.connection.system_actions.aggregate(
-                [
-                    {"$group": {"_id": {"action": "$action", "guild_id": "$guild_id"}, "total": {"$sum": 1}}},
-                    {"$sort": {"total": -1}},
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
+            return self.connection[into].create_index([("metric", 1), ("shard", 1)])
         finally:
-            if self.connection:
-                self.close()
+            self.release()
 
-    def get_guilds(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.guilds.find()
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+    def get_rollup(self, into: str, metric: str, shard: int):
+        return self._find(into, {"metric": metric, "shard": shard}, projection={"row": 1}, sharded=False)
+
+    def get_guild_ids(self):
+        # every guild, whatever the shard, used to assign guilds to shards
+        return self._find("guilds", projection={"guild_id": 1}, sharded=False)
 
     # get trivia questions, expand the correct users and incorrect users into separate lists of user objects
     def get_trivia_questions(self) -> list:
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.trivia_questions.aggregate(
-                [
-                    {
-                        "$group": {
-                            "_id": {
-                                "guild_id": "$guild_id",
-                                "category": "$category",
-                                "difficulty": "$difficulty",
-                                "starter_id": "$starter_id",
-                            },
-                            "total": {"$sum": 1},
+        return self._aggregate(
+            "trivia_questions",
+            [
+                {
+                    "$group": {
+                        "_id": {
+                            "guild_id": "$guild_id",
+                            "category": "$category",
+                            "difficulty": "$difficulty",
+                            "starter_id": "$starter_id",
                         },
+                        "total": {"$sum": 1},
                     },
-                    {
-                        "$lookup": {
-                            "from": "users",
-                            "let": {"user_id": "$_id.starter_id", "guild_id": "$_id.guild_id"},
-                            "pipeline": [
-                                {"$match": {"$expr": {"$eq": ["$user_id", "$$user_id"]}}},
-                                {"$match": {"$expr": {"$eq": ["$guild_id", "$$guild_id"]}}},
-                            ],
-                            "as": "starter",
-                        }
-                    },
-                    # {
-                    #     "$lookup": {
-                    #         "from": "users",
-                    #         "let": {"correct_users": "$correct_users"},
-                    #         "pipeline": [
-                    #             {
-                    #                 "$match": {
-                    #                     "guild_id": "$guild_id",
-                    #                     "$expr": {"$in": ["$user_id", "$$correct_users"]},
-                    #                 }
-                    #             }
-                    #         ],
-                    #         "as": "correct_users",
-                    #     }
-                    # },
-                    # {
-                    #     "$lookup": {
-                    #         "from": "users",
-                    #         "let": {"incorrect_users": "$incorrect_users"},
-                    #         "pipeline": [
-                    #             {
-                    #                 "$match": {
-                    #                     "guild_id": "$guild_id",
-                    #                     "$expr": {"$in": ["$user_id", "$$incorrect_users"]},
-                    #                 }
-                    #             }
-                    #         ],
-                    #         "as": "incorrect_users",
-                    #     }
-                    # },
-                    {"$sort": {"timestamp": -1}},
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-            return []
-        finally:
-            if self.connection:
-                self.close()
+                },
+                # {
+                #     "$lookup": {
+                #         "from": "users",
+                #         "let": {"correct_users": "$correct_users"},
+                #         "pipeline": [
+                #             {
+                #                 "$match": {
+                #                     "guild_id": "$guild_id",
+                #                     "$expr": {"$in": ["$user_id", "$$correct_users"]},
+                #                 }
+                #             }
+                #         ],
+                #         "as": "correct_users",
+                #     }
+                # },
+                # {
+                #     "$lookup": {
+                #         "from": "users",
+                #         "let": {"incorrect_users": "$incorrect_users"},
+                #         "pipeline": [
+                #             {
+                #                 "$match": {
+                #                     "guild_id": "$guild_id",
+                #                     "$expr": {"$in": ["$user_id", "$$incorrect_users"]},
+                #                 }
+                #             }
+                #         ],
+                #         "as": "incorrect_users",
+                #     }
+                # },
+                {"$sort": {"timestamp": -1}},
+            ]
+        )
 
-    # TODO: this is not working
-    def get_trivia_answer_status_per_user(self):
-        try:
-            if self.connection is None:
-                self.open()
-            return self.connection.trivia_questions.aggregate(
-                [
-                    # unwind correct and incorrect users id.
-                    # look up the user document for each user id
-                    # add a new field to each document to indicate if the user was correct or incorrect
-                    # group by user id and count the number of correct and incorrect answers
-                    # sort by total correct answers
-                    {"$unwind": "$correct_users"},
-                    {
-                        "$lookup": {
-                            "from": "users",
-                            "let": {"user_id": "$correct_users", "guild_id": "$guild_id"},
-                            "pipeline": [
-                                {"$match": {"$expr": {"$eq": ["$user_id", "$$user_id"]}}},
-                                {"$match": {"$expr": {"$eq": ["$guild_id", "$$guild_id"]}}},
-                            ],
-                            "as": "user",
-                        }
-                    },
-                    {"$addFields": {"user.state": "CORRECT"}},
-                    {"$unwind": "$incorrect_users"},
-                    {
-                        "$lookup": {
-                            "from": "users",
-                            "let": {"user_id": "$incorrect_users", "guild_id": "$guild_id"},
-                            "pipeline": [
-                                {"$match": {"$expr": {"$eq": ["$user_id", "$$user_id"]}}},
-                                {"$match": {"$expr": {"$eq": ["$guild_id", "$$guild_id"]}}},
-                            ],
-                            "as": "user",
-                        }
-                    },
-                    {"$addFields": {"user.state": "INCORRECT"}},
-                    {"$unwind": "$user"},
-                    {
-                        "$group": {
-                            "_id": {
-                                "user_id": "$user.user_id",
-                                "username": "$user.username",
-                                "guild_id": "$user.guild_id",
-                                "state": "$user.state",
-                            },
-                            "total": {"$sum": 1},
-                        }
-                    },
-                    {"$sort": {"total": -1}},
-                ]
-            )
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+    def get_trivia_answer_status_per_user(self, exclude: typing.Optional[list] = None):
+        # every answer as {user_id, state} from the question's correct_users and incorrect_users,
+        # counted per user and state. usernames are resolved by the collector.
+        return self._aggregate(
+            "trivia_questions",
+            [
+                {
+                    "$project": {
+                        "guild_id": 1,
+                        "answers": {
+                            "$concatArrays": [
+                                {
+                                    "$map": {
+                                        "input": {"$ifNull": ["$correct_users", []]},
+                                        "as": "user_id",
+                                        "in": {"user_id": "$$user_id", "state": "CORRECT"},
+                                    }
+                                },
+                                {
+                                    "$map": {
+                                        "input": {"$ifNull": ["$incorrect_users", []]},
+                                        "as": "user_id",
+                                        "in": {"user_id": "$$user_id", "state": "INCORRECT"},
+                                    }
+                                },
+                            ]
+                        },
+                    }
+                },
+                {"$unwind": "$answers"},
+            ]
+            + exclude_users("answers.user_id", exclude)
+            + [
+                {
+                    "$group": {
+                        "_id": {
+                            "guild_id": "$guild_id",
+                            "user_id": "$answers.user_id",
+                            "state": "$answers.state",
+                        },
+                        "total": {"$sum": 1},
+                    }
+                },
+                {"$sort": {"total": -1}},
+            ]
+        )
 
-    def get_invites_by_user(self):
+    def get_invites_by_user(self, limit: int = 0, other: bool = False, exclude: typing.Optional[list] = None):
         # invite model:
         # {
         #  code: 'RejCsPqBvn',
@@ -1031,13 +1091,13 @@ class MongoDatabase:
         #      }
         #  ]
         # }
-        try:
-            if self.connection is None:
-                self.open()
-            # info.inviter_id is the user who created the invite
-            # info.uses is the number of times the invite was used
+        # info.inviter_id is the user who created the invite
+        # info.uses is the number of times the invite was used
 
-            return self.connection.invite_codes.aggregate([
+        return self._aggregate(
+            "invite_codes",
+            exclude_users("info.inviter_id", exclude)
+            + [
                 {
                     "$group": {
                         "_id": {
@@ -1047,23 +1107,124 @@ class MongoDatabase:
                         "total": {"$sum": "$info.uses"}
                     }
                 },
-                {
-                        "$lookup": {
-                            "from": "users",
-                            "let": {"user_id": "$_id.user_id", "guild_id": "$_id.guild_id"},
-                            "pipeline": [
-                                {"$match": {"$expr": {"$eq": ["$user_id", "$$user_id"]}}},
-                                {"$match": {"$expr": {"$eq": ["$guild_id", "$$guild_id"]}}},
-                            ],
-                            "as": "user",
-                        }
+            ]
+            + top_n(limit, other)
+            + [
+                {"$sort": {"total": -1}},
+            ]
+        )
+
+
+def id_range(after: typing.Optional[ObjectId] = None, until: typing.Optional[ObjectId] = None) -> list:
+    # limit an append-only collection to the documents inserted in (after, until]
+    match = {}
+    if after is not None:
+        match["$gt"] = after
+    if until is not None:
+        match["$lte"] = until
+    if not match:
+        return []
+    return [{"$match": {"_id": match}}]
+
+
+def top_n(limit: int = 0, other: bool = False) -> list:
+    # rank the grouped `{_id: {guild_id, user_id}, total}` rows within each guild and keep the top `limit`.
+    # with `other`, everything below the cut is folded into a single `other` row per guild.
+    # $setWindowFields needs mongodb 5.0 or newer.
+    if not limit:
+        return []
+    stages = [
+        {
+            "$setWindowFields": {
+                "partitionBy": "$_id.guild_id",
+                "sortBy": {"total": -1},
+                "output": {"rank": {"$documentNumber": {}}},
+            }
+        },
+    ]
+    if other:
+        stages.append(
+            {
+                "$group": {
+                    "_id": {
+                        "guild_id": "$_id.guild_id",
+                        "user_id": {"$cond": [{"$lte": ["$rank", limit]}, "$_id.user_id", OTHER]},
                     },
-                    {"$match": {"user.bot": {"$ne": True}, "user.system": {"$ne": True}, "user": {"$ne": []}}},
-                    {"$sort": {"total": -1}},
-            ])
-        except Exception as ex:
-            print(ex)
-            traceback.print_exc()
-        finally:
-            if self.connection:
-                self.close()
+                    "total": {"$sum": "$total"},
+                }
+            }
+        )
+    else:
+        stages.append({"$match": {"rank": {"$lte": limit}}})
+    return stages
+
+
+def exclude_users(field: str, exclude: typing.Optional[list] = None) -> list:
+    # leave out bots and system users before grouping, so they never take a leaderboard slot
+    if not exclude:
+        return []
+    return [{"$match": {field: {"$nin": exclude}}}]
+
+
+def pipeline_key(collection: str, pipeline: list) -> str:
+    return collection + ":" + json.dumps(pipeline, sort_keys=True, default=str)
+
+
+def facet_pipeline(facets: typing.Dict[str, list]) -> list:
+    # a $match every pipeline starts with is hoisted in front of the $facet, where it can still use an index
+    pipelines = list(facets.values())
+    first = pipelines[0][0] if pipelines[0] else None
+    if first is not None and "$match" in first and all(p and p[0] == first for p in pipelines):
+        return [first, {"$facet": {name: pipeline[1:] for name, pipeline in facets.items()}}]
+    return [{"$facet": facets}]
+
+
+def read_preference(mode: str, tags=None, max_staleness: typing.Optional[int] = None):
+    """Build a pymongo read preference from its name, tag sets and max staleness.
+
+    Tags are a list of tag sets (`[{"nodeType": "ANALYTICS"}, {}]`) or a single `key:value,key:value` string.
+    """
+    cls = READ_PREFERENCES.get(str(mode).lower())
+    if cls is None:
+        raise ValueError(f"unknown read preference {mode}")
+    if cls is read_preferences.Primary:
+        return cls()
+    if isinstance(tags, str):
+        tags = [dict(tag.split(":", 1) for tag in tags.split(",") if ":" in tag)] if tags.strip() else None
+    kwargs = {}
+    if tags:
+        kwargs["tag_sets"] = tags
+    if max_staleness:
+        kwargs["max_staleness"] = int(max_staleness)
+    return cls(**kwargs)
+
+
+def collection_options(options: dict) -> dict:
+    # Collection.with_options arguments, the same for pymongo and motor
+    kwargs = {}
+    if options.get("readPreference"):
+        kwargs["read_preference"] = read_preference(
+            options["readPreference"], options.get("readPreferenceTags"), options.get("maxStalenessSeconds")
+        )
+    if options.get("readConcern"):
+        kwargs["read_concern"] = ReadConcern(options["readConcern"])
+    return kwargs
+
+
+def deadline_options(options: dict, deadline: typing.Optional[float]) -> dict:
+    """Cap maxTimeMS at the time left until a `time.monotonic()` deadline"""
+    if deadline is None:
+        return options
+    remaining = max(1, int((deadline - time.monotonic()) * 1000))
+    if options.get("maxTimeMS") and int(options["maxTimeMS"]) <= remaining:
+        return options
+    return {**options, "maxTimeMS": remaining}
+
+
+def aggregate_options(options: dict) -> dict:
+    kwargs = {}
+    if options.get("maxTimeMS"):
+        kwargs["maxTimeMS"] = int(options["maxTimeMS"])
+    if options.get("allowDiskUse"):
+        kwargs["allowDiskUse"] = True
+    return kwargs
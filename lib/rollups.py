@@ -0,0 +1,88 @@
+import threading
+import time
+import traceback
+import typing
+import uuid
+
+from lib.mongo import pipeline_key
+
+
+class RollupJob:
+    """Materializes collector results into an exporter owned collection with $merge.
+
+    On its own thread, every `interval` seconds, the pipeline of each eligible collector is run with its rows
+    merged into `collection` under `{metric, shard, key}`, then the rows the run did not write are deleted.
+    Once a pipeline has been materialized, MongoDatabase answers it from the rollup with one indexed read
+    instead of aggregating the source collection, until the pipeline changes (e.g. a new bot user is
+    excluded) and it runs live again until the next rollup.
+
+    Eligible collectors are the ones in `tiers` that run a single aggregate; `collectors.<name>.rollup`
+    overrides that per collector.
+    """
+
+    def __init__(self, db, collectors, settings: typing.Optional[dict] = None, shard: int = 0):
+        self.db = db
+        self.collectors = collectors
+        self.settings = settings or {}
+        self.collection = self.settings.get("collection", "exporter_rollups")
+        self.interval = self.settings.get("interval", 300)
+        self.tiers = self.settings.get("tiers", ["default", "slow"])
+        self.shard = shard
+        # pipeline key -> collector name, for the pipelines whose rows are in the rollup collection
+        self._materialized = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def eligible(self, collector) -> bool:
+        return bool(collector.settings.get("rollup", collector.tier in self.tiers))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="rollups", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def covers(self, collection: str, pipeline: list) -> bool:
+        return pipeline_key(collection, pipeline) in self._materialized
+
+    def read(self, collection: str, pipeline: list) -> typing.Optional[list]:
+        """The rolled up rows for a pipeline, or None when it has not been materialized"""
+        name = self._materialized.get(pipeline_key(collection, pipeline))
+        if name is None:
+            return None
+        return [document["row"] for document in self.db.get_rollup(self.collection, name, self.shard)]
+
+    def _run(self):
+        try:
+            self.db.ensure_rollup_index(self.collection)
+        except Exception as ex:
+            print(f"unable to index {self.collection}: {ex}")
+        while not self._stopped.is_set():
+            start = time.monotonic()
+            self.run_once()
+            print(f"rolled up {len(self._materialized)} pipelines in {time.monotonic() - start:.2f}s")
+            self._stopped.wait(self.interval)
+
+    def run_once(self):
+        for collector in self.collectors:
+            if not self.eligible(collector):
+                continue
+            try:
+                plan = collector.plan()
+                if plan is None:
+                    continue
+                collection, pipeline, options = plan
+                run = uuid.uuid4().hex
+                with self.db.query_options(options):
+                    self.db.merge_rollup(collection, pipeline, self.collection, collector.name, self.shard, run)
+                self.db.delete_stale_rollups(self.collection, collector.name, self.shard, run)
+                with self._lock:
+                    # a collector has one pipeline at a time, drop the key it was materialized under before
+                    self._materialized = {k: v for k, v in self._materialized.items() if v != collector.name}
+                    self._materialized[pipeline_key(collection, pipeline)] = collector.name
+            except Exception as ex:
+                # the collector keeps reading its last rollup, or the source when there is none
+                print(f"rollup of {collector.name} failed: {ex}")
+                traceback.print_exc()
@@ -0,0 +1,191 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import random
+import threading
+import time
+import traceback
+import typing
+
+
+class CircuitBreaker:
+    def __init__(self, threshold: int = 5, cooldown: float = 300):
+        self.threshold = max(1, int(threshold))
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.failures >= self.threshold
+
+    def allow(self) -> bool:
+        # once the cooldown passes a single attempt is let through; it closes or re-opens the breaker
+        return not self.is_open or time.time() >= self.open_until
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.open_until = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.is_open:
+                self.open_until = time.time() + self.cooldown
+
+
+class CollectorScheduler:
+    def __init__(
+        self,
+        concurrency: int = 4,
+        retries: int = 2,
+        backoff: float = 0.5,
+        failure_threshold: int = 5,
+        cooldown: float = 300,
+        jitter: float = 0.1,
+        exporter_metrics=None,
+    ):
+        self.concurrency = max(1, int(concurrency))
+        self.retries = max(0, int(retries))
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.jitter = jitter
+        self.exporter_metrics = exporter_metrics
+        self.breakers = {}
+        # monotonic time each collector is next due, collectors that have never run are due immediately
+        self.next_run = {}
+        # the last future of each collector, a query abandoned at a deadline may still be running on the pool
+        self.running = {}
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="collector")
+
+    def breaker(self, name: str) -> CircuitBreaker:
+        if name not in self.breakers:
+            self.breakers[name] = CircuitBreaker(self.failure_threshold, self.cooldown)
+        return self.breakers[name]
+
+    def is_due(self, name: str) -> bool:
+        return time.monotonic() >= self.next_run.get(name, 0)
+
+    def reschedule(self, name: str, interval: float):
+        # spread collectors that share an interval so they don't all land on mongodb in the same cycle
+        spread = interval * self.jitter
+        self.next_run[name] = time.monotonic() + interval + random.uniform(-spread, spread)
+
+    def seconds_until(self, name: str) -> float:
+        return max(0, self.next_run.get(name, 0) - time.monotonic())
+
+    def seconds_until_due(self) -> float:
+        if not self.next_run:
+            return 0
+        return max(0, min(self.next_run.values()) - time.monotonic())
+
+    def run(
+        self,
+        queries: typing.Dict[str, typing.Callable],
+        deadlines: typing.Optional[typing.Dict[str, typing.Optional[float]]] = None,
+        on_result: typing.Optional[typing.Callable] = None,
+    ) -> dict:
+        """Run every query on the worker pool and return the fully read results keyed by name.
+
+        Queries that fail after their retries, or whose circuit breaker is open, are left out of the results
+        so the caller keeps the previous values for them. So are queries still running at their `time.monotonic()`
+        deadline in `deadlines`, which are abandoned and counted as failures. `on_result(name, result)` is called
+        as soon as each query completes.
+        """
+        deadlines = deadlines or {}
+        futures = {}
+        for name, query in queries.items():
+            if not self.breaker(name).allow():
+                print(f"collector {name} skipped, circuit breaker is open")
+                continue
+            if name in self.running and not self.running[name].done():
+                print(f"collector {name} skipped, its query from an earlier cycle is still running")
+                continue
+            future = self.executor.submit(self.attempt, name, query, deadlines.get(name))
+            futures[future] = name
+            self.running[name] = future
+
+        results = {}
+        pending = set(futures)
+        while pending:
+            waiting = [deadlines[futures[future]] for future in pending if deadlines.get(futures[future]) is not None]
+            timeout = max(0, min(waiting) - time.monotonic()) if waiting else None
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures[future]
+                try:
+                    results[name] = future.result()
+                except Exception as ex:
+                    print(f"collector {name} failed: {ex}")
+                    traceback.print_exc()
+                    self.record_failure(name)
+                    continue
+                if on_result is not None:
+                    on_result(name, results[name])
+            now = time.monotonic()
+            for future in list(pending):
+                name = futures[future]
+                if deadlines.get(name) is not None and now >= deadlines[name]:
+                    # a query that has not started is dropped, one that has is left to finish or hit its maxTimeMS
+                    future.cancel()
+                    pending.discard(future)
+                    print(f"collector {name} missed its deadline, keeping its previous values")
+                    if self.exporter_metrics:
+                        self.exporter_metrics.collector_timeouts.labels(collector=name).inc()
+                    self.record_failure(name)
+        return results
+
+    def attempt(self, name: str, query: typing.Callable, deadline: typing.Optional[float] = None):
+        for attempt in range(self.retries + 1):
+            start = time.monotonic()
+            try:
+                result = materialize(query)
+                if self.exporter_metrics:
+                    self.exporter_metrics.collector_duration.labels(collector=name).observe(time.monotonic() - start)
+                    self.exporter_metrics.collector_rows.labels(collector=name).set(row_count(result))
+                return result
+            except Exception as ex:
+                if self.exporter_metrics:
+                    self.exporter_metrics.collector_duration.labels(collector=name).observe(time.monotonic() - start)
+                    self.exporter_metrics.collector_errors.labels(collector=name).inc()
+                delay = self.backoff * (2**attempt)
+                # no retry that could not finish before the deadline
+                if attempt >= self.retries or (deadline is not None and time.monotonic() + delay >= deadline):
+                    raise
+                print(f"collector {name} attempt {attempt + 1} failed, retrying in {delay}s: {ex}")
+                time.sleep(delay)
+
+    def record_success(self, name: str):
+        self.breaker(name).record_success()
+        if self.exporter_metrics:
+            self.exporter_metrics.collector_circuit_open.labels(collector=name).set(0)
+            self.exporter_metrics.collector_stale.labels(collector=name).set(0)
+            self.exporter_metrics.collector_last_success.labels(collector=name).set_to_current_time()
+
+    def record_failure(self, name: str):
+        breaker = self.breaker(name)
+        breaker.record_failure()
+        if self.exporter_metrics:
+            self.exporter_metrics.collector_circuit_open.labels(collector=name).set(1 if breaker.is_open else 0)
+            # the collector keeps the values of its last successful cycle
+            self.exporter_metrics.collector_stale.labels(collector=name).set(1)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+def materialize(query: typing.Callable):
+    # read the whole cursor inside the worker so the query cost is paid on the pool, not in the apply phase
+    result = query()
+    if result is None or isinstance(result, (int, float)):
+        return result
+    return list(result)
+
+
+def row_count(result) -> int:
+    if result is None:
+        return 0
+    if isinstance(result, (int, float)):
+        return 1
+    return len(result)
@@ -0,0 +1,46 @@
+import threading
+import time
+import traceback
+import typing
+
+
+class ScrapeCollector:
+    """Custom prometheus_client collector that refreshes the metrics when /metrics is scraped.
+
+    Concurrent scrapes are single-flighted: the first one runs the refresh while the others wait on the lock and
+    then serve the same values. A refresh is skipped entirely while the last one is younger than `min_interval`.
+    While `warm` (values were restored from a snapshot) scrapes don't wait for the first refresh, they serve
+    the restored values.
+    """
+
+    def __init__(self, refresh: typing.Callable, registry, min_interval: float = 10):
+        self.refresh = refresh
+        self.registry = registry
+        self.min_interval = min_interval
+        self.last_refresh = None
+        self.warm = False
+        self._lock = threading.Lock()
+
+    def describe(self):
+        # returning nothing keeps the default registry from calling collect(), and querying mongodb, on register
+        return []
+
+    def collect(self):
+        self.refresh_if_stale()
+        return self.registry.collect()
+
+    def refresh_if_stale(self):
+        if not self._lock.acquire(blocking=not (self.warm and self.last_refresh is None)):
+            return
+        try:
+            if self.last_refresh is not None and time.monotonic() - self.last_refresh < self.min_interval:
+                return
+            try:
+                self.refresh()
+            except Exception as ex:
+                print(f"scrape refresh failed: {ex}")
+                traceback.print_exc()
+            finally:
+                self.last_refresh = time.monotonic()
+        finally:
+            self._lock.release()
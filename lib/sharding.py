@@ -0,0 +1,75 @@
+import hashlib
+import threading
+import time
+import typing
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash (Lamping & Veach): only 1/n of the keys move when a bucket is added"""
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def guild_key(guild_id) -> int:
+    return int.from_bytes(hashlib.sha1(str(guild_id).encode("utf-8")).digest()[:8], "big")
+
+
+class GuildSharding:
+    """Splits the guilds between exporter replicas, each replica only queries and exports its own guilds.
+
+    Guilds are assigned with a jump consistent hash of the guild id. The guild list is read from the guilds
+    collection and refreshed every `refresh_interval` seconds. Shard 0 also owns every document that does
+    not belong to a known guild, e.g. logs without a guild id, so a new guild moves from shard 0 to its owner
+    once the list is refreshed. `version` changes whenever the guilds a shard exports change.
+    """
+
+    def __init__(self, db, index: int = 0, count: int = 1, refresh_interval: float = 300):
+        self.db = db
+        self.index = int(index)
+        self.count = max(1, int(count))
+        if not 0 <= self.index < self.count:
+            raise ValueError(f"shard index {self.index} is out of range for {self.count} shards")
+        self.refresh_interval = refresh_interval
+        self._all = []
+        self._owned = []
+        self._all_set = set()
+        self._owned_set = set()
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def owns(self, guild_id) -> bool:
+        return jump_hash(guild_key(guild_id), self.count) == self.index
+
+    def guilds(self) -> typing.Tuple[list, list]:
+        """Every known guild id and the ones this shard owns"""
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.refresh_interval:
+                all_guilds = sorted({row["guild_id"] for row in self.db.get_guild_ids() if row.get("guild_id")})
+                owned = [guild_id for guild_id in all_guilds if self.owns(guild_id)]
+                if self._loaded_at is None or set(all_guilds) != self._all_set or set(owned) != self._owned_set:
+                    self.version += 1
+                    print(f"shard {self.index}/{self.count} owns {len(owned)} of {len(all_guilds)} guilds")
+                self._all = all_guilds
+                self._owned = owned
+                self._all_set = set(all_guilds)
+                self._owned_set = set(owned)
+                self._loaded_at = time.monotonic()
+            return self._all, self._owned
+
+    def includes(self, guild_id) -> bool:
+        """Whether this shard exports the guild, matching `filter()`"""
+        self.guilds()
+        if guild_id in self._owned_set:
+            return True
+        return self.index == 0 and guild_id not in self._all_set
+
+    def filter(self, field: str = "guild_id") -> dict:
+        all_guilds, owned = self.guilds()
+        if self.index == 0:
+            return {"$or": [{field: {"$in": owned}}, {field: {"$nin": all_guilds}}]}
+        return {field: {"$in": owned}}
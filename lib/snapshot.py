@@ -0,0 +1,71 @@
+import json
+import os
+import time
+import traceback
+import typing
+
+VERSION = 1
+
+
+class Snapshot:
+    """Last-known collector values, written after each cycle and restored on startup.
+
+    The file holds the label values and value of every series, keyed by collector name, and the time the
+    values were collected. It is written to a temporary file first and then renamed, so a crash mid-write
+    leaves the previous snapshot in place.
+    """
+
+    def __init__(self, path: str, max_age: float = 86400):
+        self.path = path
+        self.max_age = max_age
+
+    def save(self, collectors, collected_at: float):
+        data = {"version": VERSION, "timestamp": collected_at, "collectors": {}}
+        for collector in collectors:
+            series = []
+            for metric in collector.gauge.collect():
+                for sample in metric.samples:
+                    series.append([[sample.labels[name] for name in collector.labelnames], sample.value])
+            data["collectors"][collector.name] = series
+
+        try:
+            temp = f"{self.path}.tmp"
+            with open(temp, "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(temp, self.path)
+        except Exception as ex:
+            print(f"unable to write snapshot {self.path}: {ex}")
+            traceback.print_exc()
+
+    def restore(self, collectors) -> typing.Optional[float]:
+        """Set the gauges from the snapshot, returning the time the values were collected or None"""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except Exception as ex:
+            print(f"unable to read snapshot {self.path}: {ex}")
+            return None
+
+        if data.get("version") != VERSION:
+            print(f"ignoring snapshot {self.path}, it was written by another version")
+            return None
+        timestamp = data.get("timestamp") or 0
+        if self.max_age and time.time() - timestamp > self.max_age:
+            print(f"ignoring snapshot {self.path}, it is older than {self.max_age}s")
+            return None
+
+        restored = 0
+        for collector in collectors:
+            for values, value in data["collectors"].get(collector.name, []):
+                if len(values) != len(collector.labelnames):
+                    # the labels changed since the snapshot was written
+                    break
+                if collector.labelnames:
+                    collector.set(value, **dict(zip(collector.labelnames, values)))
+                else:
+                    collector.gauge.set(value)
+                restored += 1
+        print(f"restored {restored} series from snapshot {self.path}")
+        return timestamp
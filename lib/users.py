@@ -0,0 +1,125 @@
+from collections import OrderedDict
+import threading
+import time
+import typing
+
+
+class UserEntry:
+    __slots__ = ("username", "bot", "system")
+
+    def __init__(self, username: str, bot: bool = False, system: bool = False):
+        self.username = username
+        self.bot = bot
+        self.system = system
+
+
+class UserDirectory:
+    """In-process cache of the users collection, keyed by `(guild_id, user_id)`.
+
+    Replaces the per-row `$lookup` against users in the leaderboard pipelines. The directory is loaded once,
+    then refreshed with only the users inserted or updated since the last refresh, and reloaded in full every
+    `fullReloadInterval` seconds. Entries are evicted least recently used first once `maxSize` is reached;
+    evicted or unknown users are fetched on demand, and users that are not found are not asked for again until
+    the next refresh or reload. Bot and system user ids are kept separately so the pipelines can leave them out
+    before grouping.
+    """
+
+    def __init__(self, db, settings: typing.Optional[dict] = None):
+        self.db = db
+        self.settings = settings or {}
+        self.max_size = int(self.settings.get("maxSize", 100000))
+        self.refresh_interval = self.settings.get("refreshInterval", 60)
+        self.full_reload_interval = self.settings.get("fullReloadInterval", 3600)
+        self.updated_field = self.settings.get("updatedField", "timestamp")
+        self._entries = OrderedDict()
+        self._excluded = set()
+        self._misses = set()
+        self._last_id = None
+        self._last_updated = None
+        self._last_refresh = None
+        self._last_full_reload = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def excluded(self) -> list:
+        """User ids of bots and system users"""
+        with self._lock:
+            self.maybe_refresh()
+            return sorted(self._excluded)
+
+    def resolve(self, keys: typing.Iterable[tuple]) -> typing.Dict[tuple, typing.Optional[UserEntry]]:
+        """Look up `(guild_id, user_id)` pairs, fetching any that are not cached. Unknown users map to None."""
+        with self._lock:
+            self.maybe_refresh()
+            found = {}
+            missing = []
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    if key not in self._misses:
+                        missing.append(key)
+                else:
+                    self._entries.move_to_end(key)
+                found[key] = entry
+
+            if missing:
+                for document in self.db.get_users_by_id(missing):
+                    entry = self._put(document)
+                    found[(document.get("guild_id"), document.get("user_id"))] = entry
+                self._misses.update(key for key in missing if found[key] is None)
+            return found
+
+    def maybe_refresh(self):
+        now = time.monotonic()
+        if self._last_full_reload is None or now - self._last_full_reload >= self.full_reload_interval:
+            self.reload()
+        elif now - self._last_refresh >= self.refresh_interval:
+            self.refresh()
+
+    def reload(self):
+        with self._lock:
+            self._entries = OrderedDict()
+            self._excluded = set()
+            self._misses = set()
+            self._last_id = None
+            self._last_updated = None
+            self._load(self.db.get_users(updated_field=self.updated_field))
+            self._last_full_reload = self._last_refresh = time.monotonic()
+            print(f"loaded {len(self._entries)} users into the user directory")
+
+    def refresh(self):
+        with self._lock:
+            self._load(
+                self.db.get_users(
+                    after_id=self._last_id, updated_after=self._last_updated, updated_field=self.updated_field
+                )
+            )
+            # users missing before may have been added since
+            self._misses = set()
+            self._last_refresh = time.monotonic()
+
+    def _load(self, documents):
+        for document in documents:
+            self._put(document)
+            if self._last_id is None or document["_id"] > self._last_id:
+                self._last_id = document["_id"]
+            updated = document.get(self.updated_field)
+            if isinstance(updated, (int, float)) and (self._last_updated is None or updated > self._last_updated):
+                self._last_updated = updated
+
+    def _put(self, document: dict) -> UserEntry:
+        key = (document.get("guild_id"), document.get("user_id"))
+        entry = UserEntry(
+            document.get("username") or document.get("user_id"),
+            bot=document.get("bot") is True,
+            system=document.get("system") is True,
+        )
+        if entry.bot or entry.system:
+            self._excluded.add(document.get("user_id"))
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        return entry
@@ -0,0 +1,71 @@
+import array
+import math
+import typing
+
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_duration(value) -> int:
+    """Seconds in a duration like `90`, `15m`, `1h`, `24h` or `7d`"""
+    value = str(value).strip().lower()
+    if value and value[-1] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(float(value))
+
+
+class RingBuffer:
+    """Per key event counts in fixed size time buckets, covering the last `span` seconds.
+
+    Each key holds one counter per bucket in a list used as a ring, indexed by the absolute bucket number
+    modulo the ring size. Moving to a newer bucket clears the slots that fell out of the span, so memory is
+    `keys * span / bucket_seconds` doubles whatever the event rate. Window totals are summed from whole
+    buckets, so they are accurate to one bucket.
+    """
+
+    def __init__(self, bucket_seconds: int = 300, span: int = 604800):
+        self.bucket_seconds = max(1, int(bucket_seconds))
+        self.size = math.ceil(span / self.bucket_seconds) + 1
+        # absolute number of the newest bucket
+        self.head = None
+        self.counts = {}
+
+    def bucket(self, timestamp: float) -> int:
+        return int(timestamp // self.bucket_seconds)
+
+    def advance(self, now: float):
+        index = self.bucket(now)
+        if self.head is None:
+            self.head = index
+            return
+        if index <= self.head:
+            return
+        cleared = range(self.head + 1, index + 1) if index - self.head < self.size else range(self.size)
+        for counts in self.counts.values():
+            for slot in cleared:
+                counts[slot % self.size] = 0
+        self.head = index
+
+    def add(self, key: tuple, bucket: int, count: float):
+        """Add `count` to an absolute bucket number, anything outside the span is dropped"""
+        if self.head is None or bucket > self.head:
+            self.advance(bucket * self.bucket_seconds)
+        if bucket <= self.head - self.size:
+            return
+        if key not in self.counts:
+            self.counts[key] = array.array("d", [0]) * self.size
+        self.counts[key][bucket % self.size] += count
+
+    def total(self, key: tuple, seconds: int) -> float:
+        counts = self.counts.get(key)
+        if counts is None or self.head is None:
+            return 0
+        buckets = min(self.size, max(1, math.ceil(seconds / self.bucket_seconds)))
+        return sum(counts[(self.head - i) % self.size] for i in range(buckets))
+
+    def prune(self):
+        # keys without any event left in the span
+        for key in [key for key, counts in self.counts.items() if not any(counts)]:
+            del self.counts[key]
+
+    def keys(self) -> typing.List[tuple]:
+        return list(self.counts.keys())
@@ -13,8 +13,11 @@
 # limitations under the License.
 
 
-from prometheus_client import start_http_server, Gauge, Enum
+from prometheus_client import start_http_server, Gauge, Enum, CollectorRegistry, REGISTRY
+import argparse
+import asyncio
 import codecs
+import functools
 import signal
 import ssl
 import pytz
@@ -22,11 +25,25 @@ import yaml
 import traceback
 import re
 import os
+import threading
 import time
+import typing
 from dotenv import load_dotenv, find_dotenv
 import datetime
 
+from lib import aio as aio
+from lib import collectors as collectors
+from lib import exposition as exposition
+from lib import indexes as indexes
+from lib import instrumentation as instrumentation
+from lib import live as live
 from lib import mongo as mongo
+from lib import rollups as rollups
+from lib import scrape as scrape
+from lib import sharding as sharding
+from lib import snapshot as snapshot
+from lib import users as users
+from lib import scheduler as scheduler
 
 load_dotenv(find_dotenv())
 
@@ -37,320 +54,323 @@ class AppConfig:
         self.metrics = {
             "port": int(dict_get(os.environ, "TBE_CONFIG_METRICS_PORT", "8932")),
             "pollingInterval": int(dict_get(os.environ, "TBE_CONFIG_METRICS_POLLING_INTERVAL", "30")),
+            # number of queries that run against mongodb at the same time
+            "concurrency": int(dict_get(os.environ, "TBE_CONFIG_METRICS_CONCURRENCY", "4")),
+            # failed queries are retried with an exponential backoff (seconds) before the collector gives up
+            "retries": int(dict_get(os.environ, "TBE_CONFIG_METRICS_RETRIES", "2")),
+            "retryBackoff": float(dict_get(os.environ, "TBE_CONFIG_METRICS_RETRY_BACKOFF", "0.5")),
+            # after this many failed cycles in a row a collector is skipped for the cooldown (seconds)
+            "circuitBreakerThreshold": int(dict_get(os.environ, "TBE_CONFIG_METRICS_CIRCUIT_BREAKER_THRESHOLD", "5")),
+            "circuitBreakerCooldown": int(dict_get(os.environ, "TBE_CONFIG_METRICS_CIRCUIT_BREAKER_COOLDOWN", "300")),
+            # poll: refresh every pollingInterval. scrape: refresh when /metrics is requested
+            "mode": dict_get(os.environ, "TBE_CONFIG_METRICS_MODE", "poll"),
+            # in scrape mode, scrapes within this many seconds of the last refresh reuse its values
+            "minRefreshInterval": int(dict_get(os.environ, "TBE_CONFIG_METRICS_MIN_REFRESH_INTERVAL", "10")),
+            # refresh intervals (seconds) for the fast and slow collector tiers, the default tier uses pollingInterval
+            "fastInterval": int(dict_get(os.environ, "TBE_CONFIG_METRICS_FAST_INTERVAL", "15")),
+            "slowInterval": int(dict_get(os.environ, "TBE_CONFIG_METRICS_SLOW_INTERVAL", "300")),
+            # each collector's next run is moved by up to this fraction of its interval
+            "jitter": float(dict_get(os.environ, "TBE_CONFIG_METRICS_JITTER", "0.1")),
+            # "threads" or "asyncio", which runs the queries on motor and serves /metrics with aiohttp
+            "runtime": dict_get(os.environ, "TBE_CONFIG_METRICS_RUNTIME", "threads"),
+            # seconds before a query on the asyncio runtime is cancelled
+            "queryTimeout": int(dict_get(os.environ, "TBE_CONFIG_METRICS_QUERY_TIMEOUT", "60")),
+            # seconds a fetch cycle waits for its collectors, the ones still running keep their previous values.
+            # 0 uses pollingInterval
+            "cycleBudget": int(dict_get(os.environ, "TBE_CONFIG_METRICS_CYCLE_BUDGET", "0")),
+            # render /metrics once per refresh and serve the cached plain or gzip body, with ETag support
+            "expositionCache": to_bool(dict_get(os.environ, "TBE_CONFIG_METRICS_EXPOSITION_CACHE", "true")),
+            # seconds before the cached body is rendered again even without a refresh
+            "expositionMaxAge": int(dict_get(os.environ, "TBE_CONFIG_METRICS_EXPOSITION_MAX_AGE", "30")),
         }
 
-        try:
-            # check if file exists
-            if os.path.exists(file):
-                print(f"Loading config from {file}")
-                with codecs.open(file, encoding="utf-8-sig", mode="r") as f:
-                    settings = yaml.safe_load(f)
-                    self.__dict__.update(settings)
-        except yaml.YAMLError as exc:
-            print(exc)
-
-
-class TacoBotMetrics:
-    def __init__(self, config):
-        self.namespace = "tacobot"
-        self.polling_interval_seconds = config.metrics["pollingInterval"]
-        self.config = config
-        labels = [
-            "guild_id",
-        ]
-
-        user_labels = [
-            "guild_id",
-            "user_id",
-            "username",
-        ]
-
-        live_labels = [
-            "guild_id",
-            "user_id",
-            "username",
-            "platform",
-        ]
-
-        # merge labels and config labels
-        # labels = labels + [x['name'] for x in self.config.labels]
+        self.mongodb = {
+            # keep a single pooled client open for the life of the process
+            "persistent": to_bool(dict_get(os.environ, "TBE_CONFIG_MONGODB_PERSISTENT", "true")),
+            "maxPoolSize": int(dict_get(os.environ, "TBE_CONFIG_MONGODB_MAX_POOL_SIZE", "10")),
+            "minPoolSize": int(dict_get(os.environ, "TBE_CONFIG_MONGODB_MIN_POOL_SIZE", "1")),
+            "maxIdleTimeMS": int(dict_get(os.environ, "TBE_CONFIG_MONGODB_MAX_IDLE_TIME_MS", "300000")),
+            "connectTimeoutMS": int(dict_get(os.environ, "TBE_CONFIG_MONGODB_CONNECT_TIMEOUT_MS", "10000")),
+            "serverSelectionTimeoutMS": int(
+                dict_get(os.environ, "TBE_CONFIG_MONGODB_SERVER_SELECTION_TIMEOUT_MS", "10000")
+            ),
+            "socketTimeoutMS": int(dict_get(os.environ, "TBE_CONFIG_MONGODB_SOCKET_TIMEOUT_MS", "60000")),
+            "heartbeatFrequencyMS": int(dict_get(os.environ, "TBE_CONFIG_MONGODB_HEARTBEAT_FREQUENCY_MS", "10000")),
+            # seconds between pings of the persistent client before a cycle
+            "healthCheckInterval": int(dict_get(os.environ, "TBE_CONFIG_MONGODB_HEALTH_CHECK_INTERVAL", "30")),
+            # collections whose pipelines are combined into one $facet per cycle, empty to run every query alone
+            "batchCollections": [
+                name.strip()
+                for name in dict_get(
+                    os.environ, "TBE_CONFIG_MONGODB_BATCH_COLLECTIONS", ",".join(mongo.BATCH_COLLECTIONS)
+                ).split(",")
+                if name.strip()
+            ],
+        }
 
-        self.db = mongo.MongoDatabase()
+        # per collector settings keyed by collector name, e.g. `collectors: { top_tacos: { enabled: false } }`
+        self.collectors = {
+            name.strip(): {"enabled": False}
+            for name in dict_get(os.environ, "TBE_CONFIG_COLLECTORS_DISABLED", "").split(",")
+            if name.strip()
+        }
 
-        self.sum_tacos = Gauge(
-            namespace=self.namespace,
-            name=f"tacos",
-            documentation="The number of tacos give to users",
-            labelnames=labels,
-        )
+        self.incremental = {
+            # keep running totals for the append-only collections (logs, tacos_log, system_actions)
+            "incremental": to_bool(dict_get(os.environ, "TBE_CONFIG_INCREMENTAL_ENABLED", "true")),
+            # seconds between full scans that rebuild the running totals
+            "reconcileInterval": int(dict_get(os.environ, "TBE_CONFIG_INCREMENTAL_RECONCILE_INTERVAL", "3600")),
+            # documents younger than this many seconds are left for the next fetch
+            "settleSeconds": int(dict_get(os.environ, "TBE_CONFIG_INCREMENTAL_SETTLE_SECONDS", "5")),
+        }
 
-        self.sum_taco_gifts = Gauge(
-            namespace=self.namespace,
-            name=f"taco_gifts",
-            documentation="The number of tacos gifted to users",
-            labelnames=labels,
-        )
+        self.windows = {
+            # trailing windows exported by taco_logs_window and system_actions_window, e.g. 15m, 1h, 24h, 7d
+            "windows": [
+                window.strip()
+                for window in dict_get(os.environ, "TBE_CONFIG_WINDOWS_WINDOWS", "1h,24h,7d").split(",")
+                if window.strip()
+            ],
+            # width of the in-memory time buckets, the windows are accurate to one bucket
+            "bucketSeconds": int(dict_get(os.environ, "TBE_CONFIG_WINDOWS_BUCKET_SECONDS", "300")),
+        }
 
-        self.sum_taco_reactions = Gauge(
-            namespace=self.namespace,
-            name=f"taco_reactions",
-            documentation="The number of tacos given to users via reactions",
-            labelnames=labels,
-        )
+        self.today = {
+            # timezone of the midnight first_messages_today counts from
+            "timezone": dict_get(os.environ, "TBE_CONFIG_TODAY_TIMEZONE", "UTC"),
+            # per guild timezones, `{guild_id: timezone}`, `guild_id:timezone,guild_id:timezone` in the environment
+            "timezones": dict_get(os.environ, "TBE_CONFIG_TODAY_TIMEZONES", ""),
+        }
 
-        self.sum_live_now = Gauge(
-            namespace=self.namespace,
-            name=f"live_now",
-            documentation="The number of people currently live",
-            labelnames=labels,
-        )
+        self.live = {
+            # follow live_tracked and live_activity with change streams instead of aggregating them every poll
+            "changeStreams": to_bool(dict_get(os.environ, "TBE_CONFIG_LIVE_CHANGE_STREAMS", "false")),
+        }
 
-        self.sum_twitch_channels = Gauge(
-            namespace=self.namespace,
-            name=f"twitch_channels",
-            documentation="The number of twitch channels the bot is watching",
-            labelnames=labels,
-        )
+        self.series = {
+            # remove label sets that are no longer returned, e.g. users that left or streams that went offline
+            "evictStale": to_bool(dict_get(os.environ, "TBE_CONFIG_SERIES_EVICT_STALE", "true")),
+            # seconds a missing series is kept before it is removed
+            "staleGracePeriod": int(dict_get(os.environ, "TBE_CONFIG_SERIES_STALE_GRACE_PERIOD", "0")),
+            # most series a user labelled collector exports, the smallest ones are added up into a `user_id: other`
+            # series per guild. 0 for no limit
+            "maxSeries": int(dict_get(os.environ, "TBE_CONFIG_SERIES_MAX_SERIES", "10000")),
+        }
 
-        self.sum_twitch_tacos = Gauge(
-            namespace=self.namespace,
-            name=f"twitch_tacos",
-            documentation="The number of tacos given to twitch users",
-            labelnames=labels,
-        )
+        self.leaderboards = {
+            # per guild limit for the user leaderboards, 0 exports every user
+            "topN": int(dict_get(os.environ, "TBE_CONFIG_LEADERBOARDS_TOP_N", "0")),
+            # users ranked past the limit, in place of the users dropped because the user directory does not know them
+            "topNMargin": int(dict_get(os.environ, "TBE_CONFIG_LEADERBOARDS_TOP_N_MARGIN", "20")),
+            # fold the users below the limit into a single `other` series
+            "topNOther": to_bool(dict_get(os.environ, "TBE_CONFIG_LEADERBOARDS_TOP_N_OTHER", "true")),
+        }
 
-        self.sum_twitch_linked_accounts = Gauge(
-            namespace=self.namespace,
-            name=f"twitch_linked_accounts",
-            documentation="The number of twitch accounts linked to discord accounts",
-            labelnames=[],
-        )
+        self.indexes = {
+            # explain every collector's pipeline at startup and report collection scans and missing indexes
+            "checkOnStartup": to_bool(dict_get(os.environ, "TBE_CONFIG_INDEXES_CHECK_ON_STARTUP", "false")),
+            # create the recommended indexes that are missing
+            "create": to_bool(dict_get(os.environ, "TBE_CONFIG_INDEXES_CREATE", "false")),
+        }
 
-        self.sum_tqotd_questions = Gauge(
-            namespace=self.namespace,
-            name=f"tqotd",
-            documentation="The number of questions in the TQOTD database",
-            labelnames=labels,
-        )
+        self.queries = {
+            # primary, primaryPreferred, secondary, secondaryPreferred or nearest, empty to use the connection string
+            "readPreference": dict_get(os.environ, "TBE_CONFIG_QUERIES_READ_PREFERENCE", ""),
+            # tag set for the read preference, e.g. `nodeType:ANALYTICS` to use a dedicated analytics node
+            "readPreferenceTags": dict_get(os.environ, "TBE_CONFIG_QUERIES_READ_PREFERENCE_TAGS", ""),
+            "maxStalenessSeconds": int(dict_get(os.environ, "TBE_CONFIG_QUERIES_MAX_STALENESS_SECONDS", "0")),
+            # local, available, majority, ... empty for the server default
+            "readConcern": dict_get(os.environ, "TBE_CONFIG_QUERIES_READ_CONCERN", ""),
+            # milliseconds the server may spend on a query before aborting it, 0 for no limit
+            "maxTimeMS": int(dict_get(os.environ, "TBE_CONFIG_QUERIES_MAX_TIME_MS", "0")),
+            "allowDiskUse": to_bool(dict_get(os.environ, "TBE_CONFIG_QUERIES_ALLOW_DISK_USE", "false")),
+            # seconds the exporter waits for a collector before abandoning it, 0 waits for the cycle budget
+            "timeout": int(dict_get(os.environ, "TBE_CONFIG_QUERIES_TIMEOUT", "0")),
+            # the same settings per refresh tier, e.g. `byTier: { slow: { readPreference: secondaryPreferred } }`
+            "byTier": {},
+        }
 
-        self.sum_tqotd_answers = Gauge(
-            namespace=self.namespace,
-            name=f"tqotd_answers",
-            documentation="The number of answers in the TQOTD database",
-            labelnames=labels,
-        )
+        self.rollups = {
+            # materialize the collectors' results into an exporter owned collection with $merge on a background
+            # thread, so the fetch cycle reads a few pre-aggregated documents instead of scanning the sources
+            "enabled": to_bool(dict_get(os.environ, "TBE_CONFIG_ROLLUPS_ENABLED", "false")),
+            "collection": dict_get(os.environ, "TBE_CONFIG_ROLLUPS_COLLECTION", "exporter_rollups"),
+            # seconds between rollups
+            "interval": int(dict_get(os.environ, "TBE_CONFIG_ROLLUPS_INTERVAL", "300")),
+            # refresh tiers whose collectors are rolled up, `collectors.<name>.rollup` overrides it per collector
+            "tiers": [
+                tier.strip()
+                for tier in dict_get(os.environ, "TBE_CONFIG_ROLLUPS_TIERS", "default,slow").split(",")
+                if tier.strip()
+            ],
+        }
 
-        self.sum_invited_users = Gauge(
-            namespace=self.namespace,
-            name=f"invited_users",
-            documentation="The number of users invited to the server",
-            labelnames=labels,
-        )
+        self.sharding = {
+            # split the guilds between `count` exporter replicas, each running with its own `index`
+            "index": int(dict_get(os.environ, "TBE_CONFIG_SHARDING_INDEX", "0")),
+            "count": int(dict_get(os.environ, "TBE_CONFIG_SHARDING_COUNT", "1")),
+            # seconds between reloads of the guild list the shards are assigned from
+            "refreshInterval": int(dict_get(os.environ, "TBE_CONFIG_SHARDING_REFRESH_INTERVAL", "300")),
+        }
 
-        self.sum_live_platform = Gauge(
-            namespace=self.namespace,
-            name=f"live_platform",
-            documentation="The number of users that have gone live on a platform",
-            labelnames=["guild_id", "platform"],
-        )
+        self.snapshot = {
+            # write the last-known values after every cycle and serve them on startup until the first refresh
+            "enabled": to_bool(dict_get(os.environ, "TBE_CONFIG_SNAPSHOT_ENABLED", "true")),
+            "path": dict_get(
+                os.environ, "TBE_CONFIG_SNAPSHOT_PATH", os.path.join(os.path.dirname(file) or ".", ".snapshot.json")
+            ),
+            # snapshots older than this many seconds are not restored
+            "maxAge": int(dict_get(os.environ, "TBE_CONFIG_SNAPSHOT_MAX_AGE", "86400")),
+        }
 
-        self.sum_wdyctw = Gauge(
-            namespace=self.namespace,
-            name=f"wdyctw_questions",
-            documentation="The number of questions in the WDYCTW database",
-            labelnames=labels,
-        )
+        self.users = {
+            # the user directory replaces the users $lookup in the leaderboard pipelines
+            "maxSize": int(dict_get(os.environ, "TBE_CONFIG_USERS_MAX_SIZE", "100000")),
+            # seconds between refreshes that load only new and updated users
+            "refreshInterval": int(dict_get(os.environ, "TBE_CONFIG_USERS_REFRESH_INTERVAL", "60")),
+            # seconds between full reloads of the directory
+            "fullReloadInterval": int(dict_get(os.environ, "TBE_CONFIG_USERS_FULL_RELOAD_INTERVAL", "3600")),
+            # user document field holding the unix time the user was last updated
+            "updatedField": dict_get(os.environ, "TBE_CONFIG_USERS_UPDATED_FIELD", "timestamp"),
+        }
 
-        self.sum_wdyctw_answers = Gauge(
-            namespace=self.namespace,
-            name=f"wdyctw_answers",
-            documentation="The number of answers in the WDYCTW database",
-            labelnames=labels,
-        )
+        try:
+            # check if file exists
+            if os.path.exists(file):
+                print(f"Loading config from {file}")
+                with codecs.open(file, encoding="utf-8-sig", mode="r") as f:
+                    settings = yaml.safe_load(f) or {}
+                    for key, value in settings.items():
+                        # merge sections so a partial section in the file keeps the remaining defaults
+                        if isinstance(value, dict) and isinstance(self.__dict__.get(key), dict):
+                            self.__dict__[key].update(value)
+                        else:
+                            self.__dict__[key] = value
+        except yaml.YAMLError as exc:
+            print(exc)
 
 
-        self.sum_techthurs = Gauge(
-            namespace=self.namespace,
-            name=f"techthurs",
-            documentation="The number of questions in the TechThurs database",
-            labelnames=labels,
-        )
+class TacoBotMetrics:
+    def __init__(self, config):
+        self.namespace = "tacobot"
+        self.polling_interval_seconds = config.metrics["pollingInterval"]
+        # 0 leaves cycles unbounded, a default from one tier's interval would cut the slower tiers' queries short
+        self.cycle_budget = config.metrics["cycleBudget"]
+        self.config = config
 
-        self.sum_techthurs_answers = Gauge(
-            namespace=self.namespace,
-            name=f"techthurs_answers",
-            documentation="The number of answers in the TechThurs database",
-            labelnames=labels,
-        )
+        # merge labels and config labels
+        # labels = labels + [x['name'] for x in self.config.labels]
 
-        self.sum_mentalmondays = Gauge(
-            namespace=self.namespace,
-            name=f"mentalmondays",
-            documentation="The number of questions in the MentalMondays database",
-            labelnames=labels,
+        self.db = mongo.MongoDatabase(config.mongodb)
+        shard_index = config.sharding["index"]
+        if config.sharding["count"] > 1:
+            self.db.sharding = sharding.GuildSharding(
+                self.db,
+                index=shard_index,
+                count=config.sharding["count"],
+                refresh_interval=config.sharding["refreshInterval"],
+            )
+
+        concurrency = config.metrics["concurrency"]
+        if not self.db.persistent and concurrency > 1:
+            # a per-query client is torn down after each call, so it can't be shared by parallel queries
+            print("mongodb.persistent is disabled, running collectors one at a time")
+            concurrency = 1
+        self.exporter_metrics = instrumentation.ExporterMetrics(namespace=self.namespace)
+        self.scheduler = scheduler.CollectorScheduler(
+            concurrency,
+            retries=config.metrics["retries"],
+            backoff=config.metrics["retryBackoff"],
+            failure_threshold=config.metrics["circuitBreakerThreshold"],
+            cooldown=config.metrics["circuitBreakerCooldown"],
+            jitter=config.metrics["jitter"],
+            exporter_metrics=self.exporter_metrics,
         )
-
-        self.sum_mentalmondays_answers = Gauge(
-            namespace=self.namespace,
-            name=f"mentalmondays_answers",
-            documentation="The number of answers in the MentalMondays database",
-            labelnames=labels,
+        self.lock = threading.Lock()
+        # shared between collectors and kept across cycles, e.g. the known guilds for zero filling
+        self.context = {"known_guilds": []}
+
+        self.mode = str(config.metrics["mode"]).lower()
+        self.registry = REGISTRY
+        self.scrape_collector = None
+        if self.mode == "scrape":
+            # the collector gauges live in their own registry and are only exposed through the scrape collector,
+            # which refreshes them before they are read
+            self.registry = CollectorRegistry()
+            self.scrape_collector = scrape.ScrapeCollector(
+                self.fetch, self.registry, min_interval=config.metrics["minRefreshInterval"]
+            )
+            REGISTRY.register(self.scrape_collector)
+
+        self.exposition = exposition.ExpositionCache(
+            REGISTRY,
+            max_age=config.metrics["expositionMaxAge"],
+            refresh=self.scrape_collector.refresh_if_stale if self.scrape_collector is not None else None,
         )
 
-        self.sum_tacotuesday = Gauge(
-            namespace=self.namespace,
-            name=f"tacotuesday",
-            documentation="The number of featured posts for TacoTuesday",
-            labelnames=labels,
+        self.users = users.UserDirectory(self.db, config.users)
+
+        # each collector owns its gauge, its query and the mapping of rows to labels
+        self.collectors = collectors.Registry(
+            self.db,
+            config.collectors,
+            namespace=self.namespace,
+            registry=self.registry,
+            defaults={
+                **config.incremental,
+                **config.windows,
+                **config.today,
+                **config.series,
+                **config.leaderboards,
+                **config.queries,
+            },
+            users=self.users,
+            include_global=shard_index == 0,
         )
-
-        self.sum_tacotuesday_answers = Gauge(
-            namespace=self.namespace,
-            name=f"tacotuesday_answers",
-            documentation="The number of interactions in the TacoTuesday database",
-            labelnames=labels,
+        print(f"registered {len(self.collectors)} collectors")
+
+        self.live_tracker = None
+        if config.live["changeStreams"]:
+            if self.db.persistent:
+                self.live_tracker = live.LiveTracker(self.db)
+                for name in ["live_now", "live_platform"]:
+                    collector = self.collectors.get(name)
+                    if collector is not None:
+                        collector.live_tracker = self.live_tracker
+                self.live_tracker.start()
+            else:
+                print("live.changeStreams needs mongodb.persistent, live metrics will be polled")
+
+        self.rollups = None
+        if config.rollups["enabled"]:
+            self.rollups = rollups.RollupJob(self.db, self.collectors, config.rollups, shard=shard_index)
+            self.db.rollups = self.rollups
+            self.rollups.start()
+
+        tiers = {
+            "fast": config.metrics["fastInterval"],
+            "default": self.polling_interval_seconds,
+            "slow": config.metrics["slowInterval"],
+        }
+        self.intervals = {c.name: c.interval(tiers) for c in self.collectors}
+        # collection each collector aggregates, learned from its plans
+        self.collections = {}
+        # the plan of each collector in the current cycle
+        self.planned = {}
+
+        # unix time the exported values were collected, restored from the snapshot until the first cycle completes
+        self.collected_at = None
+        self.snapshot = None
+        if config.snapshot["enabled"]:
+            self.snapshot = snapshot.Snapshot(config.snapshot["path"], max_age=config.snapshot["maxAge"])
+            with self.lock:
+                self.collected_at = self.snapshot.restore(self.collectors)
+            if self.collected_at is not None and self.scrape_collector is not None:
+                self.scrape_collector.warm = True
+        self.exporter_metrics.data_age.set_function(
+            lambda: time.time() - self.collected_at if self.collected_at is not None else float("nan")
         )
 
-        self.sum_game_keys_available = Gauge(
-            namespace=self.namespace,
-            name=f"game_keys_available",
-            documentation="The number of game keys available",
-            labelnames=["guild_id"])
-
-        self.sum_game_keys_claimed = Gauge(
-            namespace=self.namespace,
-            name=f"game_keys_redeemed",
-            documentation="The number of game keys claimed",
-            labelnames=["guild_id"])
-
-        self.sum_minecraft_whitelist = Gauge(
-            namespace=self.namespace,
-            name=f"minecraft_whitelist",
-            documentation="The number of users on the minecraft whitelist",
-            labelnames=["guild_id"])
-
-        self.sum_logs = Gauge(
-            namespace=self.namespace,
-            name=f"logs",
-            documentation="The number of logs",
-            labelnames=["guild_id", "level"])
-
-        self.sum_stream_team_requests = Gauge(
-            namespace=self.namespace,
-            name=f"team_requests",
-            documentation="The number of stream team requests",
-            labelnames=labels)
-
-        self.sum_birthdays = Gauge(
-            namespace=self.namespace,
-            name=f"birthdays",
-            documentation="The number of birthdays",
-            labelnames=labels)
-
-        self.sum_first_messages = Gauge(
-            namespace=self.namespace,
-            name=f"first_messages_today",
-            documentation="The number of first messages today",
-            labelnames=labels)
-
-        # self.sum_messages_tracked = Gauge(
-        #     namespace=self.namespace,
-        #     name=f"messages_tracked",
-        #     documentation="The number of messages tracked",
-        #     labelnames=labels)
-
-        self.known_users = Gauge(
-            namespace=self.namespace,
-            name=f"known_users",
-            documentation="The number of known users",
-            labelnames=["guild_id", "type"])
-
-        self.top_messages = Gauge(
-            namespace=self.namespace,
-            name=f"messages",
-            documentation="The number of top messages",
-            labelnames=user_labels)
-
-        self.top_gifters = Gauge(
-            namespace=self.namespace,
-            name=f"gifters",
-            documentation="The number of top gifters",
-            labelnames=user_labels)
-
-        self.top_reactors = Gauge(
-            namespace=self.namespace,
-            name=f"reactors",
-            documentation="The number of top reactors",
-            labelnames=user_labels)
-
-        self.top_tacos = Gauge(
-            namespace=self.namespace,
-            name=f"top_tacos",
-            documentation="The number of top tacos",
-            labelnames=user_labels)
-
-        self.taco_logs = Gauge(
-            namespace=self.namespace,
-            name=f"taco_logs",
-            documentation="The number of taco logs",
-            labelnames=["guild_id", "type"])
-
-        self.top_live_activity = Gauge(
-            namespace=self.namespace,
-            name=f"live_activity",
-            documentation="The number of top live activity",
-            labelnames=live_labels)
-
-        self.suggestions = Gauge(
-            namespace=self.namespace,
-            name=f"suggestions",
-            documentation="The number of suggestions",
-            labelnames=["guild_id", "status"])
-
-        self.user_join_leave = Gauge(
-            namespace=self.namespace,
-            name=f"user_join_leave",
-            documentation="The number of users that have joined or left",
-            labelnames=["guild_id", "action"])
-
-        self.food_posts = Gauge(
-            namespace=self.namespace,
-            name=f"food_posts",
-            documentation="The number of food posts",
-            labelnames=user_labels)
-
-        self.guilds = Gauge(
-            namespace=self.namespace,
-            name=f"guilds",
-            documentation="The number of guilds",
-            labelnames=["guild_id", "name"])
-
-        # result is either correct or incorrect
-        trivia_labels = ["guild_id", "difficulty", "category", "starter_id", "starter_name"]
-        self.trivia_questions = Gauge(
-            namespace=self.namespace,
-            name=f"trivia_questions",
-            documentation="The number of trivia questions",
-            labelnames=trivia_labels)
-
-        self.trivia_answers = Gauge(
-            namespace=self.namespace,
-            name=f"trivia_answers",
-            documentation="The number of trivia answers",
-            labelnames=["guild_id", "user_id", "username", "state"])
-
-        self.invites = Gauge(
-            namespace=self.namespace,
-            name=f"invites",
-            documentation="The number of invites",
-            labelnames=["guild_id", "user_id", "username"])
-
-        self.system_actions = Gauge(
-            namespace=self.namespace,
-            name=f"system_actions",
-            documentation="The number of system actions",
-            labelnames=["guild_id", "action"])
-
         self.build_info = Gauge(
             namespace=self.namespace,
             name=f"build_info",
@@ -365,291 +385,155 @@ class TacoBotMetrics:
         sha = dict_get(os.environ, "APP_BUILD_SHA", "unknown")
         self.build_info.labels(version=ver, ref=ref, build_date=build_date, sha=sha).set(1)
 
+    def run(self):
+        if self.mode == "scrape":
+            print("collecting metrics when /metrics is scraped")
+            if self.scrape_collector.warm:
+                # serve the restored values right away and refresh them in the background
+                threading.Thread(target=self.scrape_collector.refresh_if_stale, name="warm-start", daemon=True).start()
+            while True:
+                time.sleep(3600)
+        else:
+            self.run_metrics_loop()
+
     def run_metrics_loop(self):
         """Metrics fetching loop"""
         while True:
             print(f"begin metrics fetch")
             self.fetch()
             print(f"end metrics fetch")
-            time.sleep(self.polling_interval_seconds)
+            # wake up when the next collector is due
+            time.sleep(max(1, self.scheduler.seconds_until_due()))
 
     def fetch(self):
-        error_count = 0
+        start = time.monotonic()
         try:
+            if self.db.persistent and not self.db.ensure_connected():
+                print("unable to reach mongodb, skipping metrics fetch")
+                return
 
-            q_guilds = self.db.get_guilds()
-            known_guilds = []
-            for row in q_guilds:
-                known_guilds.append(row['guild_id'])
-                self.guilds.labels(guild_id=row['guild_id'], name=row['name']).set(1)
-
-            q_all_tacos = self.db.get_sum_all_tacos()
-            for row in q_all_tacos:
-                self.sum_tacos.labels(guild_id=row['_id']).set(row['total'])
-
-            q_all_gift_tacos = self.db.get_sum_all_gift_tacos()
-            for row in q_all_gift_tacos:
-                self.sum_taco_gifts.labels(guild_id=row['_id']).set(row['total'])
-
-            q_all_reaction_tacos = self.db.get_sum_all_taco_reactions()
-            for row in q_all_reaction_tacos:
-                self.sum_taco_reactions.labels(guild_id=row['_id']).set(row['total'])
-
-            q_live_now = self.db.get_live_now_count()
-            for row in q_live_now:
-                self.sum_live_now.labels(guild_id=row['_id']).set(row['total'])
-
-            # self.sum_twitch_channels.labels(**labels).set(guage_values['twitch_channels'])
-            q_twitch_channels = self.db.get_twitch_channel_bot_count()
-            for row in q_twitch_channels:
-                self.sum_twitch_channels.labels(guild_id=row['_id']).set(row['total'])
-
-            q_all_twitch_tacos = self.db.get_sum_all_twitch_tacos()
-            for row in q_all_twitch_tacos:
-                self.sum_twitch_tacos.labels(guild_id=row['_id']).set(row['total'])
-
-            q_twitch_linked_accounts = self.db.get_twitch_linked_accounts_count()
-            self.sum_twitch_linked_accounts.set(q_twitch_linked_accounts or 0)
-
-            q_tqotd_questions = self.db.get_tqotd_questions_count()
-            for row in q_tqotd_questions:
-                self.sum_tqotd_questions.labels(guild_id=row['_id']).set(row['total'])
-
-            q_tqotd_answers = self.db.get_tqotd_answers_count()
-            for row in q_tqotd_answers:
-                self.sum_tqotd_answers.labels(guild_id=row['_id']).set(row['total'])
-
-            q_invited_users = self.db.get_invited_users_count()
-            for row in q_invited_users:
-                self.sum_invited_users.labels(guild_id=row['_id']).set(row['total'])
-
-            q_live_platform = self.db.get_sum_live_by_platform()
-            for row in q_live_platform:
-                self.sum_live_platform.labels(guild_id=row['_id']['guild_id'], platform=row['_id']['platform']).set(row['total'])
-
-            q_wdyctw = self.db.get_wdyctw_questions_count()
-            for row in q_wdyctw:
-                self.sum_wdyctw.labels(guild_id=row['_id']).set(row['total'])
-
-            q_wdyctw_answers = self.db.get_wdyctw_answers_count()
-            for row in q_wdyctw_answers:
-                self.sum_wdyctw_answers.labels(guild_id=row['_id']).set(row['total'])
-
-            # self.sum_techthurs.labels(**labels).set(guage_values['techthurs'])
-            q_techthurs = self.db.get_techthurs_questions_count()
-            for row in q_techthurs:
-                self.sum_techthurs.labels(guild_id=row['_id']).set(row['total'])
-
-            # self.sum_techthurs_answers.labels(**labels).set(guage_values['techthurs_answers'])
-            q_techthurs_answers = self.db.get_techthurs_answers_count()
-            for row in q_techthurs_answers:
-                self.sum_techthurs_answers.labels(guild_id=row['_id']).set(row['total'])
-
-            # self.sum_mentalmondays.labels(**labels).set(guage_values['mentalmondays'])
-            q_mentalmondays = self.db.get_mentalmondays_questions_count()
-            for row in q_mentalmondays:
-                self.sum_mentalmondays.labels(guild_id=row['_id']).set(row['total'])
-
-            # self.sum_mentalmondays_answers.labels(**labels).set(guage_values['mentalmondays_answers'])
-            q_mentalmondays_answers = self.db.get_mentalmondays_answers_count()
-            for row in q_mentalmondays_answers:
-                self.sum_mentalmondays_answers.labels(guild_id=row['_id']).set(row['total'])
-
-            # self.sum_tacotuesday.labels(**labels).set(guage_values['tacotuesday'])
-            q_tacotuesday = self.db.get_tacotuesday_questions_count()
-            for row in q_tacotuesday:
-                self.sum_tacotuesday.labels(guild_id=row['_id']).set(row['total'])
-
-            # self.sum_tacotuesday_answers.labels(**labels).set(guage_values['tacotuesday_answers'])
-            q_tacotuesday_answers = self.db.get_tacotuesday_answers_count()
-            for row in q_tacotuesday_answers:
-                self.sum_tacotuesday_answers.labels(guild_id=row['_id']).set(row['total'])
-
-            q_game_keys_available = self.db.get_game_keys_available_count()
-            for row in q_game_keys_available:
-                self.sum_game_keys_available.labels(guild_id=row['_id']).set(row['total'])
-
-            q_game_keys_claimed = self.db.get_game_keys_redeemed_count()
-            for row in q_game_keys_claimed:
-                self.sum_game_keys_claimed.labels(guild_id=row['_id']).set(row['total'])
-
-            q_minecraft_whitelisted = self.db.get_minecraft_whitelisted_count()
-            for row in q_minecraft_whitelisted:
-                self.sum_minecraft_whitelist.labels(guild_id=row['_id']).set(row['total'])
-
-            q_stream_team_requests = self.db.get_team_requests_count()
-            for row in q_stream_team_requests:
-                self.sum_stream_team_requests.labels(guild_id=row['_id']).set(row['total'])
-
-            q_birthdays = self.db.get_birthdays_count()
-            for row in q_birthdays:
-                self.sum_birthdays.labels(guild_id=row['_id']).set(row['total'])
-
-            q_first_messages_today = self.db.get_first_messages_today_count()
-            for row in q_first_messages_today:
-                self.sum_first_messages.labels(guild_id=row['_id']).set(row['total'])
-
-            logs = self.db.get_logs()
-            for gid in known_guilds:
-                for level in ['INFO', 'WARNING', 'ERROR', 'DEBUG']:
-                    t_labels = { "guild_id": gid, "level": level }
-                    self.sum_logs.labels(**t_labels).set(0)
-            for row in logs:
-                self.sum_logs.labels(guild_id=row['_id']['guild_id'], level=row['_id']['level']).set(row["total"])
-
-            q_known_users = self.db.get_known_users()
-            for row in q_known_users:
-                self.known_users.labels(guild_id=row['_id']['guild_id'], type=row['_id']['type']).set(row['total'])
-
-            # loop top messages and add to histogram
-            q_top_messages = self.db.get_user_messages_tracked()
-            for u in q_top_messages:
-                user = {
-                    "user_id": u["_id"]['user_id'],
-                    "username": u["_id"]['user_id']
-                }
-                if u["user"] is not None and len(u["user"]) > 0:
-                    user = u["user"][0]
-
-                user_labels = { "guild_id": u['_id']['guild_id'], "user_id": user['user_id'], "username": user['username'] }
-                self.top_messages.labels(**user_labels).set(u["total"])
-
-
-            q_top_gifters = self.db.get_top_taco_gifters()
-            for u in q_top_gifters:
-                user = {
-                    "user_id": u["_id"]['user_id'],
-                    "username": u["_id"]['user_id']
-                }
-                if u["user"] is not None and len(u["user"]) > 0:
-                    user = u["user"][0]
-
-                user_labels = { "guild_id": u['_id']['guild_id'], "user_id": u["_id"]['user_id'], "username": user['username'] }
-                self.top_gifters.labels(**user_labels).set(u["total"])
-
-            q_top_reactors = self.db.get_top_taco_reactors()
-            for u in q_top_reactors:
-                user = {
-                    "user_id": u["_id"]['user_id'],
-                    "username": u["_id"]['user_id']
-                }
-                if u["user"] is not None and len(u["user"]) > 0:
-                    user = u["user"][0]
-
-                user_labels = { "guild_id": u['_id']['guild_id'], "user_id": user['user_id'], "username": user['username'] }
-                self.top_reactors.labels(**user_labels).set(u["total"])
-
-            q_top_tacos = self.db.get_top_taco_receivers()
-            for u in q_top_tacos:
-                user = {
-                    "user_id": u["_id"]['user_id'],
-                    "username": u["_id"]['user_id']
-                }
-                if u["user"] is not None and len(u["user"]) > 0:
-                    user = u["user"][0]
-
-                user_labels = { "guild_id": u['_id']['guild_id'], "user_id": user['user_id'], "username": user['username'] }
-                self.top_tacos.labels(**user_labels).set(u["total"])
-
-            q_top_live = self.db.get_live_activity()
-            for u in q_top_live:
-                user = {
-                    "user_id": u["_id"]['user_id'],
-                    "username": u["_id"]['user_id']
-                }
-                if u["user"] is not None and len(u["user"]) > 0:
-                    user = u["user"][0]
-
-                user_labels = { "guild_id": u['_id']['guild_id'], "user_id": user['user_id'], "username": user['username'], "platform": u["_id"]['platform'] }
-                self.top_live_activity.labels(**user_labels).set(u["total"])
-
-            q_suggestions = self.db.get_suggestions()
-            for gid in known_guilds:
-                for state in ["ACTIVE", "APPROVED", "REJECTED", "IMPLEMENTED", "CONSIDERED", "DELETED", "CLOSED"]:
-                    suggestion_labels = { "guild_id": gid, "status": state }
-                    self.suggestions.labels(**suggestion_labels).set(0)
-            for row in q_suggestions:
-                suggestion_labels = { "guild_id": row['_id']['guild_id'], "status": row['_id']['state'] }
-                self.suggestions.labels(**suggestion_labels).set(row["total"])
-
-            q_join_leave = self.db.get_user_join_leave()
-            for gid in known_guilds:
-                for state in ["JOIN", "LEAVE"]:
-                    join_leave_labels = { "guild_id": gid, "action": state }
-                    self.user_join_leave.labels(**join_leave_labels).set(0)
-
-            for row in q_join_leave:
-                join_leave_labels = { "guild_id": row['_id']['guild_id'], "action": row['_id']['action'] }
-                self.user_join_leave.labels(**join_leave_labels).set(row["total"])
-
-            q_food = self.db.get_food_posts_count()
-            for u in q_food:
-                user = {
-                    "user_id": u["_id"]['user_id'],
-                    "username": u["_id"]['user_id']
-                }
-                if u["user"] is not None and len(u["user"]) > 0:
-                    user = u["user"][0]
-
-                user_labels = { "guild_id": u['_id']['guild_id'], "user_id": user['user_id'], "username": user['username'] }
-                self.food_posts.labels(**user_labels).set(u["total"])
-
-            q_taco_logs = self.db.get_taco_logs_counts()
-            for t in q_taco_logs:
-                taco_labels = { "guild_id": t["_id"]['guild_id'], "type": t["_id"]['type'] or "UNKNOWN" }
-                self.taco_logs.labels(**taco_labels).set(t["total"])
-
-            q_trivia = self.db.get_trivia_questions()
-            for t in q_trivia:
-                trivia_labels = {
-                    "guild_id": t['_id']["guild_id"],
-                    "category": t['_id']["category"],
-                    "difficulty": t['_id']["difficulty"],
-                    "starter_id": t['_id']["starter_id"],
-                    "starter_name": t['starter'][0]["username"], }
-                self.trivia_questions.labels(**trivia_labels).set(t["total"])
-
-            # q_trivia = self.db.get_trivia_answer_status_per_user()
-            # print(q_trivia)
-            # for t in q_trivia:
-            #     trivia_labels = {
-            #         "guild_id": t['_id']["guild_id"],
-            #         "user_id": t['_id']["user_id"],
-            #         "username": t['user'][0]["username"],
-            #         "state": t['_id']["status"],
-            #     }
-            #     self.trivia_answers.labels(**trivia_labels).set(t["total"])
-
-            q_invites = self.db.get_invites_by_user()
-            for row in q_invites:
-                user = {
-                    "user_id": row["_id"]['user_id'],
-                    "username": row["_id"]['user_id']
-                }
-                if row["user"] is not None and len(row["user"]) > 0:
-                    user = row["user"][0]
-
-                invite_labels = {
-                    "guild_id": row['_id']["guild_id"],
-                    "user_id": row['_id']["user_id"],
-                    "username": row['user'][0]["username"],
-                }
-                total_count = row["total"]
-                if total_count is not None and total_count > 0:
-                    self.invites.labels(**invite_labels).set(row["total"])
-
-            q_system_actions = self.db.get_system_action_counts()
-            for row in q_system_actions:
-                action_labels = {
-                    "guild_id": row['_id']["guild_id"],
-                    "action": row['_id']["action"],
-                }
-                total_count = row["total"]
-                if total_count is not None and total_count > 0:
-                    self.system_actions.labels(**action_labels).set(row["total"])
+            due = self.due_collectors()
+            deadline = self.cycle_deadline(start)
 
+            # collectors reading the same collection share a single $facet query
+            self.db.prefetch(self.plans(due), executor=self.scheduler.executor, deadline=deadline)
+
+            self.run_collectors(due, start, deadline)
         except Exception as e:
             traceback.print_exc()
+        finally:
+            self.observe_cycle(start)
+
+    def due_collectors(self) -> list:
+        due = {c.name for c in self.collectors if self.scheduler.is_due(c.name)}
+        # collectors on a batched collection that would be due before the due ones on it run again are pulled
+        # into this cycle, so their jitter and tiers don't keep them from sharing the collection's $facet
+        window = {}
+        for name in due:
+            collection = self.collections.get(name)
+            if collection in self.db.batch_collections:
+                window[collection] = min(window.get(collection, float("inf")), self.intervals[name])
+        for collector in self.collectors:
+            collection = self.collections.get(collector.name)
+            if collection in window and self.scheduler.seconds_until(collector.name) <= window[collection]:
+                due.add(collector.name)
+
+        return [c for c in self.collectors if c.name in due]
+
+    def plans(self, due: list) -> list:
+        plans = []
+        self.planned = {}
+        for collector in due:
+            if not self.scheduler.breaker(collector.name).allow():
+                continue
+            try:
+                plan = collector.plan()
+            except Exception as e:
+                # e.g. the user directory failing to load, the collector runs its query unbatched instead
+                print(f"collector {collector.name} failed to plan: {e}")
+                traceback.print_exc()
+                continue
+            if plan is not None:
+                self.collections[collector.name] = plan[0]
+                self.planned[collector.name] = plan
+            plans.append(plan)
+        return plans
+
+    def cycle_deadline(self, start: float) -> typing.Optional[float]:
+        return start + self.cycle_budget if self.cycle_budget > 0 else None
+
+    def run_collectors(self, due: list, start: float, deadline: typing.Optional[float] = None) -> dict:
+        """Run the collectors' queries on the worker pool, publishing each result as soon as it is read.
+
+        Collectors that fail, or are still running at their timeout or the cycle deadline, are missing from the
+        results and keep their previous values. Collectors whose rows were prefetched only map them, they are
+        not held to the deadline the prefetch may have used up.
+        """
+        # collectors are rescheduled once they are dispatched, a cycle that fails before this runs them again
+        for collector in due:
+            self.scheduler.reschedule(collector.name, self.intervals[collector.name])
+        deadlines = {
+            c.name: None if self.db.prefetched(self.planned.get(c.name)) else c.deadline(start, deadline) for c in due
+        }
+        # results are published in completion order, except that collectors zero filling for the known guilds
+        # wait for guilds when it runs in this cycle, and are published without it if it fails
+        waiting = {c.name for c in due if c.needs_guilds} if any(c.name == "guilds" for c in due) else set()
+        held = {}
+
+        def on_result(name: str, result):
+            if name in waiting:
+                held[name] = result
+                return
+            self.publish({name: result}, save=False)
+            if name == "guilds":
+                waiting.clear()
+                if held:
+                    self.publish(dict(held), save=False)
+                    held.clear()
+
+        results = self.scheduler.run(
+            {c.name: functools.partial(c.run, deadlines[c.name]) for c in due},
+            deadlines=deadlines,
+            on_result=on_result,
+        )
+        if held:
+            self.publish(held, save=False)
+        if results and self.snapshot is not None:
+            with self.lock:
+                self.snapshot.save(self.collectors, self.collected_at)
+        return results
+
+    def publish(self, results: dict, save: bool = True):
+        with self.lock:
+            self.apply(results)
+            if results:
+                self.collected_at = time.time()
+                if save and self.snapshot is not None:
+                    self.snapshot.save(self.collectors, self.collected_at)
+                self.exposition.invalidate()
+
+    def observe_cycle(self, start: float):
+        duration = time.monotonic() - start
+        self.exporter_metrics.cycle_duration.observe(duration)
+        if duration > self.polling_interval_seconds:
+            print(f"metrics fetch took {duration:.2f}s, longer than the {self.polling_interval_seconds}s polling interval")
+            self.exporter_metrics.cycle_overruns.inc()
+
+    def apply(self, results: dict):
+        for collector in self.collectors:
+            if collector.name not in results:
+                continue
+            try:
+                collector.update(results[collector.name], self.context)
+                if collector.fold_labels:
+                    dropped = self.exporter_metrics.collector_series_dropped
+                    dropped.labels(collector=collector.name).set(collector.dropped)
+                self.scheduler.record_success(collector.name)
+            except Exception as e:
+                print(f"collector {collector.name} failed to update: {e}")
+                traceback.print_exc()
+                self.exporter_metrics.collector_errors.labels(collector=collector.name).inc()
+                self.scheduler.record_failure(collector.name)
 
 
 def dict_get(dictionary, key, default_value=None):
@@ -659,6 +543,12 @@ def dict_get(dictionary, key, default_value=None):
         return default_value
 
 
+def to_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ["true", "yes", "1", "on"]
+
+
 def sighandler(signum, frame):
     print("<SIGTERM received>")
     exit(0)
@@ -667,15 +557,55 @@ def sighandler(signum, frame):
 def main():
     signal.signal(signal.SIGTERM, sighandler)
 
+    parser = argparse.ArgumentParser(description="Prometheus exporter for TacoBot")
+    parser.add_argument(
+        "--check-indexes",
+        action="store_true",
+        help="explain every collector's pipeline, report collection scans and missing indexes, then exit",
+    )
+    parser.add_argument(
+        "--create-indexes", action="store_true", help="with --check-indexes, create the missing recommended indexes"
+    )
+    args = parser.parse_args()
+
     try:
         config_file = dict_get(os.environ, "TBE_CONFIG_FILE", default_value="./config/.configuration.yaml")
 
         config = AppConfig(config_file)
 
+        if args.check_indexes or args.create_indexes:
+            # only the pipelines are needed, don't start following the live collections
+            config.live["changeStreams"] = False
+            config.rollups["enabled"] = False
+            app_metrics = TacoBotMetrics(config)
+            try:
+                ok = indexes.check(app_metrics.db, app_metrics.collectors, create=args.create_indexes)
+            finally:
+                app_metrics.db.close()
+            exit(0 if ok else 1)
+
         print(f"start listening on :{config.metrics['port']}")
         app_metrics = TacoBotMetrics(config)
-        start_http_server(config.metrics["port"])
-        app_metrics.run_metrics_loop()
+        if config.indexes["checkOnStartup"] or config.indexes["create"]:
+            try:
+                indexes.check(app_metrics.db, app_metrics.collectors, create=config.indexes["create"])
+            except Exception as ex:
+                print(f"index check failed: {ex}")
+                traceback.print_exc()
+        try:
+            if str(config.metrics["runtime"]).lower() == "asyncio":
+                runtime = aio.AsyncRuntime(
+                    app_metrics, config.metrics["port"], query_timeout=config.metrics["queryTimeout"]
+                )
+                asyncio.run(runtime.run())
+            else:
+                if config.metrics["expositionCache"]:
+                    exposition.start_http_server(config.metrics["port"], app_metrics.exposition)
+                else:
+                    start_http_server(config.metrics["port"])
+                app_metrics.run()
+        finally:
+            app_metrics.db.close()
 
     except KeyboardInterrupt:
         exit(0)